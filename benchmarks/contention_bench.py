@@ -0,0 +1,109 @@
+# Latency of API writes while sync worker writes offers to the same SQLite file in another process.
+#
+#   $ python -m benchmarks.contention_bench
+#   $ python -m benchmarks.contention_bench --journal-mode DELETE --busy-timeout 5    # SQLite defaults
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+from multiprocessing import Event, Process, Value
+from time import perf_counter, time
+
+PRODUCTS = 1000
+OFFERS = 10  # offers per product
+SYNC_BATCH = 100  # products written by sync worker at once
+
+
+def sync_load(uri: str, stop, written) -> None:
+    """ Sync worker writing batches of changed offers, as fast as it can. """
+    from ms import create_app, db
+    from ms.offersWriter import OffersWriter
+    from ms.reconciliation import Reconciliation
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        while not stop.is_set():
+            start = random.randrange(1, PRODUCTS - SYNC_BATCH)
+            batch = [Reconciliation(
+                inserts=[{'prod_id': prod_id, 'remote_id': i, 'price': random.randint(1, 1000), 'items_in_stock': 1}
+                         for i in range(OFFERS)],
+                updates=[], deletes=[],
+                summary={'prod_id': prod_id, 'best_price': 1, 'offer_count': OFFERS, 'total_stock': OFFERS,
+                         'last_synced': time()})
+                for prod_id in range(start, start + SYNC_BATCH)]
+            OffersWriter.write(db, batch)
+            with written.get_lock():
+                written.value += SYNC_BATCH * OFFERS
+
+
+def measure(duration: float = 5.) -> dict:
+    """ Latencies of product updates via API in seconds while sync load runs. """
+    from ms import create_app, db, init_all
+    from ms.dbModels import Product
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+        with app.app_context():
+            init_all()
+            db.session.add_all([Product(name='p{}'.format(i), description='bench') for i in range(PRODUCTS)])
+            db.session.commit()
+            db.session.remove()
+            db.engine.dispose()  # connections must not be shared with forked process
+
+        stop = Event()
+        written = Value('q', 0)
+        worker = Process(target=sync_load, args=(uri, stop, written))
+        worker.start()
+
+        client = app.test_client()
+        latencies = []
+        errors = 0
+        start = perf_counter()
+        try:
+            while perf_counter() - start < duration:
+                request_start = perf_counter()
+                response = client.post('/product/{}'.format(random.randint(1, PRODUCTS)),
+                                       json={'name': 'updated', 'description': 'bench'})
+                latencies.append(perf_counter() - request_start)
+                if response.status_code != 200:
+                    errors += 1
+        finally:
+            stop.set()
+            worker.join()
+        elapsed = perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50': statistics.median(latencies),
+        'p99': latencies[int(len(latencies) * 0.99)],
+        'max': latencies[-1],
+        'sync_offers_per_s': written.value / elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='API write latency under sync load.')
+    parser.add_argument('--duration', type=float, default=5.)
+    parser.add_argument('--journal-mode', help='SQLITE_JOURNAL_MODE')
+    parser.add_argument('--busy-timeout', help='SQLITE_BUSY_TIMEOUT')
+    args = parser.parse_args()
+    # storage settings are read when ms is imported
+    if args.journal_mode:
+        os.environ['SQLITE_JOURNAL_MODE'] = args.journal_mode
+    if args.busy_timeout:
+        os.environ['SQLITE_BUSY_TIMEOUT'] = args.busy_timeout
+
+    result = measure(args.duration)
+    print('requests {requests}, errors {errors}, sync offers/s {sync_offers_per_s:.0f}'.format(**result))
+    print('p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+        result['p50'] * 1000., result['p99'] * 1000., result['max'] * 1000.))
+    sys.exit(1 if result['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# Aggregation of price/stock history of one product with millions of samples.
+#
+#   $ python -m benchmarks.history_bench
+import numpy as np
+from time import perf_counter
+
+from ms import create_app, db
+from ms.dbModels import Product
+from ms.history import HistoryStore, HISTORY_CHUNK_SIZE
+
+SIZES = (100000, 1000000, 3000000)
+APPEND_SIZE = 100000
+OFFERS = 20  # offers observed in one sync of product
+
+
+def main():
+    print('{:>10} {:>10} {:>16} {:>16}'.format('samples', 'chunks', 'aggregate [ms]', 'hourly [ms]'))
+    for n in SIZES:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+        with app.app_context():
+            db.create_all()
+            product = Product(name='bench', description='bench')
+            db.session.add(product)
+            db.session.commit()
+
+            rng = np.random.default_rng(0)
+            for i in range(0, n, APPEND_SIZE):
+                ts = np.arange(i, min(n, i + APPEND_SIZE), dtype=np.float64) // OFFERS * 60.
+                samples = list(zip(ts, np.arange(len(ts)) % OFFERS, rng.integers(1, 1000, len(ts)),
+                                   rng.integers(0, 50, len(ts))))
+                HistoryStore.append(db, {product.id: samples})
+                db.session.commit()
+
+            chunks = (n + HISTORY_CHUNK_SIZE - 1) // HISTORY_CHUNK_SIZE
+            start = perf_counter()
+            HistoryStore.aggregate(product.id, 0., float(n) * 60.)
+            whole = perf_counter() - start
+
+            start = perf_counter()
+            HistoryStore.aggregate(product.id, 0., float(n) * 60., bucket=3600.)
+            hourly = perf_counter() - start
+        print('{:>10} {:>10} {:>16.1f} {:>16.1f}'.format(n, chunks, whole * 1e3, hourly * 1e3))
+
+
+if __name__ == '__main__':
+    main()
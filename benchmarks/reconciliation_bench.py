@@ -0,0 +1,42 @@
+# Micro-benchmark of offers reconciliation. Time per offer should stay flat with growing number of offers.
+#
+#   $ python -m benchmarks.reconciliation_bench
+import random
+from timeit import Timer
+
+from ms.reconciliation import reconcile
+
+SIZES = (1000, 10000, 100000)
+REPEAT = 5
+
+
+def make_offers(n: int, changed: float = 0.1, removed: float = 0.05, added: float = 0.05):
+    local = [(i, i, random.randint(1, 1000), random.randint(0, 100)) for i in range(n)]
+    remote = []
+    for _, remote_id, price, items_in_stock in local:
+        r = random.random()
+        if r < removed:
+            continue
+        if r < removed + changed:
+            price += 1
+        remote.append({'id': remote_id, 'price': price, 'items_in_stock': items_in_stock})
+    remote.extend({'id': n + i, 'price': 1, 'items_in_stock': 1} for i in range(int(n * added)))
+    random.shuffle(remote)
+    return local, remote
+
+
+def measure(n: int) -> float:
+    """ Best time of reconciliation of n offers in seconds. """
+    local, remote = make_offers(n)
+    return min(Timer(lambda: reconcile(1, local, remote)).repeat(repeat=REPEAT, number=1))
+
+
+def main():
+    print('{:>10} {:>12} {:>14}'.format('offers', 'best [ms]', 'per offer [ns]'))
+    for n in SIZES:
+        best = measure(n)
+        print('{:>10} {:>12.2f} {:>14.0f}'.format(n, best * 1e3, best / n * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# Benchmark suite. Sync job talks to local fake offers service started in separate process.
+#
+#   $ python -m benchmarks.run                          # print results
+#   $ python -m benchmarks.run --save-baseline          # store results as baseline
+#   $ python -m benchmarks.run --compare                # exit with 1 if a metric regressed against baseline
+#   $ python -m benchmarks.run --sizes 100,1000,10000 --latency 0.05 --error-rate 0.01 --offers 20
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+
+# URL of offers service must be known before ms is imported
+with socket.socket() as _s:
+    _s.bind(('127.0.0.1', 0))
+    FAKE_OFFERS_PORT = _s.getsockname()[1]
+os.environ['OffersMS_BaseUrl'] = 'http://127.0.0.1:{}/api/v1'.format(FAKE_OFFERS_PORT)
+
+from benchmarks import reconciliation_bench, write_bench  # noqa: E402
+from ms import create_app, db  # noqa: E402
+from ms.core import Core  # noqa: E402
+from ms.dbModels import Product  # noqa: E402
+from ms.offersConnector import OffersConnector  # noqa: E402
+from ms.OffersSyncJob import OffersSyncJob  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+LOWER = 'lower'  # lower value is better
+HIGHER = 'higher'
+
+
+def start_offers_service(args) -> subprocess.Popen:
+    """ Fake offers service runs in own process, so it doesn't compete for GIL with measured code. """
+    service = subprocess.Popen([
+        sys.executable, '-m', 'ms.fakeOffersService', '--port', str(FAKE_OFFERS_PORT), '--auto-register',
+        '--latency', str(args.latency), '--error-rate', str(args.error_rate), '--offers', str(args.offers)
+    ], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', FAKE_OFFERS_PORT), timeout=1.).close()
+            return service
+        except OSError:
+            sleep(0.1)
+    service.kill()
+    raise RuntimeError('Fake offers service did not start.')
+
+
+def bench_sync(sizes, concurrency: int):
+    """ Duration of sync cycle of whole catalogue, the first cycle inserts offers, the second one updates them. """
+    ret = {}
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'bench.db')})
+            with app.app_context():
+                db.create_all()
+                db.session.add_all([Product(name='p{}'.format(i), description='bench') for i in range(n)])
+                db.session.commit()
+
+                OffersSyncJob.offersMS = OffersConnector(lambda: None, lambda token: None)
+                OffersSyncJob.db = db
+                OffersSyncJob.concurrency = concurrency
+                for cycle in ('insert', 'update'):
+                    start = perf_counter()
+                    OffersSyncJob.sync_cycle()
+                    ret['sync_cycle_{}_s/{}'.format(cycle, n)] = (perf_counter() - start, LOWER)
+                OffersSyncJob.offersMS.close()
+                db.session.remove()
+                db.engine.dispose()
+    return ret
+
+
+def bench_merge(sizes, offers: int):
+    """ Reconciliation cost of whole catalogue in one cycle. """
+    per_product = reconciliation_bench.measure(offers)
+    return {'merge_cycle_s/{}'.format(n): (per_product * n, LOWER) for n in sizes}
+
+
+def bench_write(sizes, offers: int):
+    return {'write_offers_per_s/{}'.format(n): (write_bench.measure(n * offers), HIGHER) for n in sizes}
+
+
+def bench_api(sizes, duration: float = 1.):
+    """ Requests per second of product read and create served by in-process test client. """
+    ret = {}
+    for n in sizes:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+        with app.app_context():
+            db.create_all()
+            db.session.add_all([Product(name='p{}'.format(i), description='bench') for i in range(n)])
+            db.session.commit()
+            Core.init(db, None)
+
+            client = app.test_client()
+            for name, request in (
+                    ('read', lambda i: client.get('/product/{}'.format(i % n + 1))),
+                    ('create', lambda i: client.post('/product', json={'name': 'new', 'description': 'bench'}))):
+                i = 0
+                start = perf_counter()
+                while perf_counter() - start < duration:
+                    request(i)
+                    i += 1
+                ret['api_{}_per_s/{}'.format(name, n)] = (i / (perf_counter() - start), HIGHER)
+    return ret
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, (value, better) in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]['value']
+        if (better == LOWER and value > base * (1. + tolerance)) or \
+                (better == HIGHER and value < base * (1. - tolerance)):
+            regressions.append('{}: {:.6g} (baseline {:.6g})'.format(name, value, base))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite.')
+    parser.add_argument('--sizes', default='100,1000', help='comma separated numbers of products')
+    parser.add_argument('--latency', type=float, default=0.01, help='latency of fake offers service in seconds')
+    parser.add_argument('--error-rate', type=float, default=0., help='fraction of 503 responses of offers service')
+    parser.add_argument('--offers', type=int, default=10, help='offers per product')
+    parser.add_argument('--concurrency', type=int, default=OffersSyncJob.concurrency)
+    parser.add_argument('--output', help='store results to JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='store results to ' + BASELINE)
+    parser.add_argument('--compare', action='store_true', help='compare results with ' + BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.sizes.split(',')]
+
+    service = start_offers_service(args)
+    try:
+        results = {}
+        results.update(bench_sync(sizes, args.concurrency))
+        results.update(bench_merge(sizes, args.offers))
+        results.update(bench_write(sizes, args.offers))
+        results.update(bench_api(sizes))
+    finally:
+        service.terminate()
+        service.wait()
+
+    for name, (value, better) in results.items():
+        print('{:<40} {:>14.6g}  ({} is better)'.format(name, value, better))
+
+    report = {
+        'meta': {'python': platform.python_version(), 'machine': platform.machine(), 'args': vars(args)},
+        'metrics': {name: {'value': value, 'better': better} for name, (value, better) in results.items()}
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(BASELINE, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Baseline saved to {}'.format(BASELINE))
+
+    if args.compare:
+        with open(BASELINE) as f:
+            baseline = json.load(f)['metrics']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('\nREGRESSIONS:\n' + '\n'.join(regressions))
+            sys.exit(1)
+        print('\nNo regressions against baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Cold start of API process: import of ms and create_app() in fresh interpreter, median of several runs.
+#
+#   $ python -m benchmarks.startup_bench
+#   $ python -m benchmarks.startup_bench --runs 20 --max-ms 400    # exit with 1 if startup is slower
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+RUNS = 10
+# modules which must not be imported by create_app(), they are loaded with the first use
+DEFERRED_MODULES = ('numpy', 'requests')
+
+SCRIPT = '''
+import json, sys
+from time import perf_counter
+start = perf_counter()
+from ms import create_app
+create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+print(json.dumps({'seconds': perf_counter() - start, 'loaded': [m for m in %r if m in sys.modules]}))
+''' % (DEFERRED_MODULES,)
+
+
+def measure(runs: int = RUNS) -> dict:
+    """ Median seconds of import and create_app() and deferred modules loaded anyway. Each run is a new process,
+    so nothing is cached in memory. """
+    samples, loaded = [], set()
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', SCRIPT], check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        samples.append(result['seconds'])
+        loaded.update(result['loaded'])
+    return {'seconds': statistics.median(samples), 'loaded': sorted(loaded)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time of API process.')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--max-ms', type=float, help='fail if median startup is slower')
+    args = parser.parse_args()
+
+    result = measure(args.runs)
+    print('create_app median [ms]: {:.1f}'.format(result['seconds'] * 1000.))
+    failed = False
+    if result['loaded']:
+        print('heavy modules imported at startup: {}'.format(', '.join(result['loaded'])))
+        failed = True
+    if args.max_ms is not None and result['seconds'] * 1000. > args.max_ms:
+        print('startup is slower than {} ms'.format(args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# Throughput of writing Offer rows: ORM object per row vs. OffersWriter bulk upsert.
+#
+#   $ python -m benchmarks.write_bench
+import os
+import tempfile
+from time import perf_counter
+
+from ms import create_app, db
+from ms.dbModels import Offer, Product
+from ms.offersWriter import OffersWriter
+
+SIZES = (1000, 10000, 100000)
+
+
+def orm_add(rows):
+    for row in rows:
+        db.session.add(Offer(**row))
+    db.session.commit()
+
+
+def bulk_upsert(rows):
+    OffersWriter.upsert(db, rows)
+
+
+def measure(n: int, write=bulk_upsert) -> float:
+    """ Offers written per second to fresh sqlite DB. """
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'bench.db')})
+        with app.app_context():
+            db.create_all()
+            product = Product(name='bench', description='bench')
+            db.session.add(product)
+            db.session.commit()
+            rows = [{'prod_id': product.id, 'remote_id': i, 'price': i, 'items_in_stock': 1} for i in range(n)]
+
+            start = perf_counter()
+            write(rows)
+            ret = n / (perf_counter() - start)
+            db.session.remove()
+            db.engine.dispose()
+    return ret
+
+
+def main():
+    print('{:>10} {:>16} {:>16}'.format('offers', 'orm [offers/s]', 'upsert [offers/s]'))
+    for n in SIZES:
+        print('{:>10} {:>16.0f} {:>16.0f}'.format(n, measure(n, orm_add), measure(n, bulk_upsert)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,38 @@
-import numpy as np
+import asyncio
+import json
+import signal
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from multiprocessing import Process
-from time import sleep
+from threading import Thread
+from os import getenv
+from time import perf_counter, sleep, time
+from typing import Iterable, Iterator, List, Optional, Set, Tuple, Dict
 
-from ms.dbModels import Product, Offer
+from ms.consts import SYNC_SCHEDULER_STATUS, METRICS_SNAPSHOT_PREFIX
+from ms.dbModels import Product, Offer, OfferSummary, Settings, SyncWorker
 from ms.offersConnector import OffersConnector
+from ms.offersWriter import OffersWriter
+from ms.metrics import REGISTRY, SYNC_CYCLE_SECONDS, SYNC_PRODUCTS, SYNC_OFFERS, SYNC_ERRORS
+from ms.reconciliation import Reconciliation, reconcile, offer_validation, PRICE, ITEMS_IN_STOCK, ID
+from ms.syncLeases import SyncLeases
+from ms.syncScheduler import SyncScheduler
 
-
-PRICE = 'price'
-ITEMS_IN_STOCK = 'items_in_stock'
-ID = 'id'
+# number of concurrent requests to offers service
+SYNC_CONCURRENCY = int(getenv('SYNC_CONCURRENCY') or 16)
+# the same with AsyncOffersConnector, requests wait in event loop instead of threads
+SYNC_ASYNC_CONCURRENCY = int(getenv('SYNC_ASYNC_CONCURRENCY') or 512)
+SYNC_ASYNC = getenv('SYNC_ASYNC') == '1'  # workers fetch offers by AsyncOffersConnector, needs httpx
+# number of changed products collected before they are written to DB
+SYNC_BATCH_SIZE = int(getenv('SYNC_BATCH_SIZE') or 100)
+# how often is list of products reloaded and scheduler state published
+SYNC_REFRESH_INTERVAL = float(getenv('SYNC_REFRESH_INTERVAL') or 30.)
+SYNC_MAX_SLEEP = 5.
+SYNC_PUSHED_QUERY_SIZE = 1000  # products whose last sync is read by one query
+SYNC_DEFAULT_WORKER = 'default'  # name of worker without leases in published status
 
 
 class OffersSyncJob:
@@ -17,60 +40,315 @@ class OffersSyncJob:
     offersMS = None
     db = None
     process = None
+    concurrency = SYNC_CONCURRENCY
+    batch_size = SYNC_BATCH_SIZE
+    scheduler = SyncScheduler()
+    leases = None  # SyncLeases of this worker, None syncs all products
+    leases_renew_at = 0.
+    loop = None  # event loop of async connector
+    executor = None  # threads of sync connector, reused by all cycles
+    started_at = 0.
+    synced_at = {}  # prod_id -> last_synced written by this worker
 
     @staticmethod
-    def start(offers_ms: OffersConnector, db: SQLAlchemy):
+    def start(offers_ms: OffersConnector, db: SQLAlchemy, concurrency: int = SYNC_CONCURRENCY,
+              batch_size: int = SYNC_BATCH_SIZE):
+        """ Run sync worker in child process. """
+        OffersSyncJob.process = Process(target=OffersSyncJob.run, args=(offers_ms, db, concurrency, batch_size))
+        OffersSyncJob.process.start()
+
+    @staticmethod
+    def run(offers_ms: OffersConnector, db: SQLAlchemy, concurrency: int = SYNC_CONCURRENCY,
+            batch_size: int = SYNC_BATCH_SIZE):
+        """ Run sync worker in this process. Any number of workers can run on one or more hosts, products are split
+        between them by SyncLeases. """
         OffersSyncJob.offersMS = offers_ms
         OffersSyncJob.db = db
-        OffersSyncJob.process = Process(target=OffersSyncJob.offers_sync)
-        OffersSyncJob.process.start()
+        OffersSyncJob.concurrency = max(1, concurrency)
+        OffersSyncJob.batch_size = max(1, batch_size)
+        OffersSyncJob.leases = SyncLeases(db)
+        OffersSyncJob.started_at = time()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # release leases on stop
+        try:
+            OffersSyncJob.offers_sync()
+        finally:
+            db.session.rollback()
+            OffersSyncJob.leases.release()
+            if OffersSyncJob.executor is not None:
+                OffersSyncJob.executor.shutdown(wait=False)
+                OffersSyncJob.executor = None
 
     @staticmethod
     def offers_sync():
+        REGISTRY.reset()
+        scheduler = OffersSyncJob.scheduler
+        next_refresh = 0.
         while True:
-            products = Product.query.all()
-            for product in products:
-                offers = OffersSyncJob.offersMS.product_offers(product.id)
-                offers = OffersSyncJob.merge_with_local_offers(prod_id=product.id, remote_offers=offers)
-                for offer in offers:
-                    # add new offers to local DB
-                    db_offer = Offer(prod_id=product.id, price=offer[PRICE], items_in_stock=offer[ITEMS_IN_STOCK],
-                                     remote_id=offer[ID])
-                    OffersSyncJob.db.session.add(db_offer)
-            OffersSyncJob.db.session.commit()
+            due = []
+            done = set()
+            try:
+                now = time()
+                if OffersSyncJob.heartbeat(now, rebalance=True):
+                    next_refresh = now  # owned buckets changed
 
-            sleep(60.)
+                if now >= next_refresh:
+                    scheduler.set_products(OffersSyncJob.owned_products(), now)
+                    OffersSyncJob.synced_at = {prod_id: synced_at for prod_id, synced_at
+                                               in OffersSyncJob.synced_at.items() if prod_id in scheduler.intervals}
+                    OffersSyncJob.publish_status(now)
+                    next_refresh = now + SYNC_REFRESH_INTERVAL
+
+                due = scheduler.pop_due(now)
+                if due:
+                    OffersSyncJob.sync_cycle(sorted(due), done)
+            except Exception as e:
+                # e.g. DB is unavailable, worker keeps running and products of failed cycle are retried later
+                current_app.logger.exception('Sync cycle failed: {}'.format(e))
+                OffersSyncJob.db.session.rollback()
+                for prod_id in due:
+                    if prod_id not in done:  # products written or rescheduled before failure keep their schedule
+                        scheduler.fail(prod_id, time())
+                sleep(SYNC_MAX_SLEEP)
+                continue
+
+            next_due = scheduler.next_due()
+            wait = SYNC_MAX_SLEEP if next_due is None else next_due - time()
+            sleep(min(max(wait, 0.), SYNC_MAX_SLEEP, max(next_refresh - time(), 0.),
+                      max(OffersSyncJob.leases_renew_at - time(), 0.)))
 
     @staticmethod
-    def offer_validation(offer: dict):
-        if PRICE in offer and ITEMS_IN_STOCK in offer and ID in offer:
+    def heartbeat(now: float, rebalance: bool = False) -> bool:
+        """ Renew leases every third of their TTL, rebalance buckets between workers if asked. Return True if set of
+        owned buckets changed. """
+        leases = OffersSyncJob.leases
+        if leases is None or now < OffersSyncJob.leases_renew_at:
+            return False
+
+        owned = leases.owned
+        if rebalance:
+            leases.rebalance(now)
+        else:
+            leases.renew(now)
+        OffersSyncJob.leases_renew_at = now + leases.ttl / 3.
+        if owned != leases.owned:
+            current_app.logger.info('Sync worker {} owns {} of {} buckets.'.format(
+                leases.owner, len(leases.owned), leases.buckets))
             return True
         return False
 
     @staticmethod
-    def merge_with_local_offers(prod_id: int, remote_offers: list):
-        local_offers = OffersSyncJob.db.session.query(Offer).filter_by(prod_id=prod_id)
-        ret = []
-        for offer in local_offers:
-            ret.append(offer.remote_id)
-        ret.sort()
+    def owned_products() -> List[int]:
+        query = OffersSyncJob.db.session.query(Product.id)
+        leases = OffersSyncJob.leases
+        if leases is not None:
+            if not leases.owned:
+                return []
+            query = query.filter((Product.id % leases.buckets).in_(leases.owned))
+        return [prod_id for prod_id, in query]
+
+    @staticmethod
+    def sync_cycle(prod_ids: List[int] = None, done: Set[int] = None):
+        """ Fetch offers of products (all by default) concurrently and store changes in batches ordered by product
+        id. Synced products are rescheduled according to whether their offers changed. Products whose sync was
+        completed (written, skipped or failed on their own) are added to done, so failure of cycle doesn't reschedule
+        them again. """
+        start = perf_counter()
+        if prod_ids is None:
+            prod_ids = [prod_id for prod_id, in OffersSyncJob.db.session.query(Product.id).order_by(Product.id)]
+        done = set() if done is None else done
+
+        fetched_at = time()  # offers pushed after it are newer than fetched ones
+        pushed = OffersSyncJob.pushed(prod_ids)
+        if pushed:
+            now = time()
+            for prod_id in pushed:
+                OffersSyncJob.scheduler.reschedule(prod_id, changed=False, now=now)
+            done.update(pushed)
+            prod_ids = [prod_id for prod_id in prod_ids if prod_id not in pushed]
+
+        batch = []
+        samples = {}
+        errors = {}
+        for prod_id, offers in OffersSyncJob.fetch_offers(prod_ids, errors):
+            now = time()
+            if offers is None:
+                OffersSyncJob.scheduler.fail(prod_id, now)  # last good offers stay in DB
+                done.add(prod_id)
+                continue
+            if not OffersSyncJob.owns(prod_id):
+                done.add(prod_id)
+                continue  # bucket was taken over by another worker during cycle
+            try:
+                changes = OffersSyncJob.reconcile(prod_id=prod_id, remote_offers=offers)
+                product_samples = [(now, offer[ID], offer[PRICE], offer[ITEMS_IN_STOCK])
+                                   for offer in offers if offer_validation(offer)]
+            except Exception as e:
+                # e.g. malformed response, the other products of batch are synced
+                SYNC_ERRORS.inc(type(e).__name__)
+                errors[prod_id] = e
+                OffersSyncJob.db.session.rollback()
+                OffersSyncJob.scheduler.fail(prod_id, now)
+                done.add(prod_id)
+                continue
+            OffersSyncJob.scheduler.reschedule(prod_id, changed=bool(changes), now=now)
+            SYNC_PRODUCTS.inc()
+            changes.summary['last_synced'] = now
+            OffersSyncJob.synced_at[prod_id] = now
+            batch.append(changes)  # summary is written even if offers didn't change
+            if changes:
+                SYNC_OFFERS.inc('insert', amount=len(changes.inserts))
+                SYNC_OFFERS.inc('update', amount=len(changes.updates))
+                SYNC_OFFERS.inc('delete', amount=len(changes.deletes))
+            samples[prod_id] = product_samples
+
+            if len(samples) >= OffersSyncJob.batch_size:
+                written = list(samples)
+                OffersSyncJob.write(batch, samples, fetched_at)
+                done.update(written)
+                batch = []
+                samples = {}
+        written = list(samples)
+        OffersSyncJob.write(batch, samples, fetched_at)
+        done.update(written)
+        SYNC_CYCLE_SECONDS.observe(perf_counter() - start)
+        if errors:
+            error = next(iter(errors.values()))
+            current_app.logger.warning('Sync of {} products failed, they will be retried. First error: {}'.format(
+                len(errors), getattr(error, 'msg', error)))
+
+    @staticmethod
+    def pushed(prod_ids: List[int]) -> Set[int]:
+        """ Products whose offers were pushed by POST /offers/ingest since this worker synced them (or since it
+        started). Their request is skipped and they are rescheduled as unchanged, so while pushes arrive polling backs
+        off to SYNC_MAX_INTERVAL and remains only as rare reconciliation. """
+        started_at = OffersSyncJob.started_at
+        synced_at = OffersSyncJob.synced_at
+        pushed = set()
+        for start in range(0, len(prod_ids), SYNC_PUSHED_QUERY_SIZE):
+            rows = OffersSyncJob.db.session.query(OfferSummary.prod_id, OfferSummary.last_synced) \
+                .filter(OfferSummary.prod_id.in_(prod_ids[start:start + SYNC_PUSHED_QUERY_SIZE]),
+                        OfferSummary.last_synced > started_at)
+            pushed.update(prod_id for prod_id, last_synced in rows
+                          if last_synced > synced_at.get(prod_id, started_at))
+        return pushed
+
+    @staticmethod
+    def write(batch: List[Reconciliation], samples: Dict, fetched_at: float = None):
+        """ Write batch with price history, products pushed by POST /offers/ingest after fetched_at are left out,
+        pushed offers are newer. """
+        if fetched_at is not None and batch:
+            superseded = OffersSyncJob.superseded([changes.summary['prod_id'] for changes in batch], fetched_at)
+            if superseded:
+                batch = [changes for changes in batch if changes.summary['prod_id'] not in superseded]
+                samples = {prod_id: s for prod_id, s in samples.items() if prod_id not in superseded}
+                for prod_id in superseded:
+                    OffersSyncJob.synced_at.pop(prod_id, None)  # the next cycle skips it as pushed
+        OffersWriter.write(OffersSyncJob.db, batch, samples=samples)
+
+    @staticmethod
+    def superseded(prod_ids: List[int], fetched_at: float) -> Set[int]:
+        """ Products whose offers were written after fetched_at by another writer, i.e. pushed during fetch. """
+        return {prod_id for prod_id, in OffersSyncJob.db.session.query(OfferSummary.prod_id)
+                .filter(OfferSummary.prod_id.in_(prod_ids), OfferSummary.last_synced > fetched_at)}
+
+    @staticmethod
+    def owns(prod_id: int) -> bool:
+        leases = OffersSyncJob.leases
+        return leases is None or prod_id % leases.buckets in leases.owned
 
-        i = 0
-        while i < len(remote_offers):
-            offer = remote_offers[i]
+    @staticmethod
+    def publish_status(now: float):
+        """ Log scheduler state and store it for GET /sync/status together with metrics for GET /metrics, sync runs
+        in another process than API. Each worker has own rows, rows of dead workers are removed. """
+        session = OffersSyncJob.db.session
+        leases = OffersSyncJob.leases
+        worker = leases.owner if leases is not None else SYNC_DEFAULT_WORKER
+        status = OffersSyncJob.scheduler.stats(now)
+        status['updated_at'] = now
+        status['worker'] = worker
+        if leases is not None:
+            status['buckets'] = sorted(leases.owned)
+        current_app.logger.info('Sync scheduler: {}'.format(status))
+
+        session.merge(Settings(name=SYNC_SCHEDULER_STATUS + worker, value=json.dumps(status)))
+        session.merge(Settings(name=METRICS_SNAPSHOT_PREFIX + 'sync:' + worker, value=REGISTRY.snapshot()))
+        if leases is not None:
+            live = {worker_id for worker_id, in session.query(SyncWorker.id)} | {worker}
+            for prefix in (SYNC_SCHEDULER_STATUS, METRICS_SNAPSHOT_PREFIX + 'sync:'):
+                for row in Settings.query.filter(Settings.name.startswith(prefix)):
+                    if row.name[len(prefix):] not in live:
+                        session.delete(row)
+        session.commit()
+
+    @staticmethod
+    def fetch_offers(prod_ids: Iterable[int],
+                     errors: Optional[Dict[int, Exception]] = None) -> Iterator[Tuple[int, Optional[List[Dict]]]]:
+        """ Yield (prod_id, offers) in order of prod_ids. At most `concurrency` requests are running and results
+        are buffered only within a small window, so memory doesn't depend on the catalogue size. Failure of product
+        doesn't stop the others, its offers are None and exception is stored to errors. Coroutines of async
+        connector run in event loop in background thread, all requests of window are in flight at once. Leases are
+        renewed on time while results are awaited or processed by caller. """
+        def result(prod_id: int, future) -> Tuple[int, Optional[List[Dict]]]:
+            while True:
+                OffersSyncJob.heartbeat(time())
+                renew_in = max(OffersSyncJob.leases_renew_at - time(), 0.) if OffersSyncJob.leases else None
+                if wait_futures((future,), timeout=renew_in).done:
+                    break
+            try:
+                return prod_id, future.result()
+            except Exception as e:
+                SYNC_ERRORS.inc(type(e).__name__)
+                if errors is not None:
+                    errors[prod_id] = e
+                return prod_id, None
 
-            # skip invalid offers
-            if not OffersSyncJob.offer_validation(offer):
-                remote_offers = np.delete(remote_offers, i)
-                continue  # Remote offers is invalid
+        product_offers = OffersSyncJob.offersMS.product_offers
+        if asyncio.iscoroutinefunction(product_offers):
+            loop = OffersSyncJob.event_loop()
+            window = OffersSyncJob.concurrency
+            executor = None
+            submit = lambda prod_id: asyncio.run_coroutine_threadsafe(product_offers(prod_id), loop)
+        else:
+            window = 2 * OffersSyncJob.concurrency
+            executor = OffersSyncJob.thread_pool()
+            submit = lambda prod_id: executor.submit(product_offers, prod_id)
 
-            # skip synchronized offers
-            j = np.searchsorted(ret, offer[ID])
-            if j >= len(ret):
-                i += 1
-                continue  # Remote offers wasn't found in DB -> add them
+        in_flight = deque()
+        try:
+            for prod_id in prod_ids:
+                in_flight.append((prod_id, submit(prod_id)))
+                if len(in_flight) >= window:
+                    yield result(*in_flight.popleft())
 
-            remote_offers = np.delete(remote_offers, i)
-            ret = np.delete(ret, j)
+            while in_flight:
+                yield result(*in_flight.popleft())
+        finally:
+            for _, future in in_flight:  # caller stopped early, pool is free for next cycle
+                future.cancel()
 
-        return remote_offers
+    @staticmethod
+    def thread_pool() -> ThreadPoolExecutor:
+        """ Threads of sync connector, started with the first use and shut down when worker stops. """
+        if OffersSyncJob.executor is None:
+            OffersSyncJob.executor = ThreadPoolExecutor(max_workers=OffersSyncJob.concurrency,
+                                                        thread_name_prefix='sync-fetch')
+        return OffersSyncJob.executor
+
+    @staticmethod
+    def event_loop() -> asyncio.AbstractEventLoop:
+        """ Event loop running in background thread, started with the first use. """
+        if OffersSyncJob.loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, name='sync-event-loop', daemon=True).start()
+            OffersSyncJob.loop = loop
+        return OffersSyncJob.loop
+
+    @staticmethod
+    def offer_validation(offer: dict):
+        return offer_validation(offer)
+
+    @staticmethod
+    def reconcile(prod_id: int, remote_offers: list) -> Reconciliation:
+        local_offers = OffersSyncJob.db.session.query(Offer.id, Offer.remote_id, Offer.price, Offer.items_in_stock) \
+            .filter_by(prod_id=prod_id)
+        return reconcile(prod_id, local_offers, remote_offers)
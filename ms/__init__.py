@@ -1,11 +1,12 @@
 import os
 
 import click
-from flask import Flask
+from flask import Flask, current_app
 from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
 from logging.config import dictConfig
 
+from ms import metrics, storage
 from ms.offersConnector import OffersConnector
 
 __version__ = (1, 0, 0, "dev")
@@ -49,42 +50,48 @@ def create_app(test_config=None):
 
     if test_config is not None:
         app.config.update(test_config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', storage.engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
 
     try:
         os.makedirs(app.instance_path, exist_ok=True)
     except OSError:
         pass
 
+    storage.configure_sqlite()
     db.init_app(app)
+    metrics.instrument_db()
     app.cli.add_command(init_all_command)
+    app.cli.add_command(sync_worker_command)
+    app.cli.add_command(outbox_worker_command)
+    app.cli.add_command(export_command)
+    app.cli.add_command(compact_command)
 
     from ms import interface
+    from ms.core import Core
 
     app.register_blueprint(interface.interface_blueprint)
+    # connector authenticates with the first call, so app starts even when offers service is unreachable
+    Core.init(db, OffersConnector(*token_store(app)))
 
     return app
 
 
-def init_all(without_job: bool = False):
+def init_all():
+    """ Create DB and search index. Sync and outbox workers are launched separately (flask sync-worker, flask
+    outbox-worker or ms-worker), so this neither blocks nor needs offers service. """
+    from ms.offersWriter import OffersWriter
+    from ms.search import ProductSearch
     if RESET:
         db.drop_all()
+        ProductSearch.drop_index(db)
         logger.info('Database reset. All data removed.')
     db.create_all()
+    deleted = OffersWriter.create_index(db)
+    if deleted:
+        logger.info('{} duplicated offers deleted.'.format(deleted))
+    ProductSearch.create_index(db)
     logger.info('Database initialized.')
 
-    global offersMS
-    offersMS = offersConnector.OffersConnector(load_token, save_token)
-    logger.info('OffersConnector initialized.')
-
-    from ms.core import Core
-    Core.init(db, offersMS)
-    logger.info('Core initialized.')
-
-    if not without_job:  # Job is not necessary during api testing.
-        from ms.OffersSyncJob import OffersSyncJob
-        OffersSyncJob.start(offersMS, db)
-        logger.info('offers ms job started.')
-
 
 @click.command('init-all')
 @with_appcontext
@@ -92,15 +99,101 @@ def init_all_command():
     init_all()
 
 
+@click.command('sync-worker')
+@click.option('--concurrency', type=int, default=None, help='concurrent requests to offers service')
+@click.option('--async', 'use_async', is_flag=True, help='non-blocking requests in event loop, needs httpx')
+@with_appcontext
+def sync_worker_command(concurrency, use_async):
+    """ Run offers sync worker in foreground. Start as many workers as needed on any hosts, products are split
+    between them. """
+    from ms.OffersSyncJob import OffersSyncJob, SYNC_CONCURRENCY, SYNC_ASYNC, SYNC_ASYNC_CONCURRENCY
+    db.create_all()
+    if use_async or SYNC_ASYNC:
+        from ms.asyncOffersConnector import AsyncOffersConnector
+        offers_ms = AsyncOffersConnector(*token_store())
+        concurrency = concurrency or SYNC_ASYNC_CONCURRENCY
+    else:
+        offers_ms = OffersConnector(*token_store())
+    logger.info('sync worker started.')
+    OffersSyncJob.run(offers_ms, db, concurrency or SYNC_CONCURRENCY)
+
+
+@click.command('outbox-worker')
+@with_appcontext
+def outbox_worker_command():
+    """ Run worker registering new products to offers service in foreground. """
+    from ms.outboxWorker import OutboxWorker
+    db.create_all()
+    offers_ms = OffersConnector(*token_store())
+    logger.info('outbox worker started.')
+    OutboxWorker.run(offers_ms, db)
+
+
+@click.command('export')
+@click.option('--output', '-o', default='-', help='output file, stdout by default')
+@click.option('--gzip', 'compress', is_flag=True, help='compress output')
+@with_appcontext
+def export_command(output, compress):
+    """ Export all products with offers as NDJSON. """
+    from ms import export
+    from ms.core import Core
+    Core.init(db, None)
+    chunks = export.ndjson(Core.export_products())
+    with click.open_file(output, 'wb') as f:
+        for chunk in export.gzip(chunks) if compress else chunks:
+            f.write(chunk)
+
+
+@click.command('compact')
+@click.option('--changes-days', type=float, default=None, help='keep offer changes of this many days, 0 = all')
+@click.option('--history-days', type=float, default=None, help='keep price history of this many days, 0 = all')
+@click.option('--batch-size', type=int, default=None, help='rows deleted in one transaction')
+@click.option('--vacuum', is_flag=True, help='return free space to file system, blocks writers meanwhile')
+@with_appcontext
+def compact_command(changes_days, history_days, batch_size, vacuum):
+    """ Delete rows of deleted products and old offer changes and price history in small batches. Safe to run
+    periodically next to API and workers. """
+    from ms.retention import Retention, RETENTION_CHANGES_DAYS, RETENTION_HISTORY_DAYS, RETENTION_BATCH_SIZE
+    report = Retention.compact(
+        db,
+        changes_days=RETENTION_CHANGES_DAYS if changes_days is None else changes_days,
+        history_days=RETENTION_HISTORY_DAYS if history_days is None else history_days,
+        batch_size=batch_size or RETENTION_BATCH_SIZE)
+    for name in ('offers', 'offer_summaries', 'price_history', 'offer_changes', 'rows', 'reclaimed_bytes'):
+        click.echo('{}: {}'.format(name, report[name]))
+    if vacuum:
+        size = Retention.database_bytes(db)
+        Retention.vacuum(db)
+        click.echo('database bytes: {} -> {}'.format(size, Retention.database_bytes(db)))
+    logger.info('Compaction deleted {} rows in {:.1f} s.'.format(report['rows'], report['seconds']))
+
+
+def token_store(app: Flask = None):
+    """ load/save token callbacks of app (current app by default) for OffersConnector. Each call runs in own app
+    context, so it works from threads of sync job and doesn't commit session of caller. """
+    if app is None:
+        app = current_app._get_current_object()
+
+    def load() -> str:
+        with app.app_context():
+            return load_token()
+
+    def save(token: str) -> None:
+        with app.app_context():
+            save_token(token)
+
+    return load, save
+
+
 # db must be initialized, so I run load/save token later
 def load_token() -> str:
     from ms.dbModels import Settings
     token = Settings.query.get('access_token')
-    return token
+    return token.value if token is not None else None
 
 
 def save_token(token: str) -> None:
     from ms.dbModels import Settings
-    db.session.add(Settings(name='access_token', value=token))
+    db.session.merge(Settings(name='access_token', value=token))
     db.session.commit()
     logger.info('New access token for offers ms was received.')
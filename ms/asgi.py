@@ -0,0 +1,83 @@
+# ASGI entry point of API. Long-polling of GET /offers/changes?wait= waits in event loop, so thousands of waiting
+# clients don't need thousands of server threads as with WSGI server. Other requests are passed to Flask app.
+#
+#   $ uvicorn --factory ms.asgi:create_asgi_app
+#
+# asgiref is optional dependency needed for requests passed to Flask app: pip install asgiref uvicorn
+import asyncio
+import json
+from flask import Flask
+from time import monotonic, perf_counter
+from typing import Callable, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from ms import create_app
+from ms.consts import HTTP_OK, HTTP_BAD_REQUEST, HTTP_INTERNAL_SERVER_ERROR, CHANGES_POLL_INTERVAL
+from ms.metrics import HTTP_REQUEST_SECONDS
+
+CHANGES_ROUTE = '/offers/changes'
+
+
+class ASGIApp:
+    """ Serves GET /offers/changes in event loop, reads of change log run in threads with app context. Other
+    requests are served by Flask app, it runs in threads of asgiref adapter. """
+
+    def __init__(self, flask_app: Flask, wsgi: Optional[Callable] = None):
+        self.flask_app = flask_app
+        self._wsgi = wsgi
+
+    @property
+    def wsgi(self) -> Callable:
+        """ Flask app as ASGI app, adapter is created with the first request passed to it. """
+        if self._wsgi is None:
+            from asgiref.wsgi import WsgiToAsgi  # optional dependency
+            self._wsgi = WsgiToAsgi(self.flask_app)
+        return self._wsgi
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == CHANGES_ROUTE:
+            start = perf_counter()
+            status, body = await self.offer_changes(scope.get('query_string', b'').decode('latin-1'))
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(b'content-type', b'application/json')] if body else []})
+            await send({'type': 'http.response.body', 'body': body})
+            HTTP_REQUEST_SECONDS.observe(perf_counter() - start, CHANGES_ROUTE, 'GET', status)
+            return
+        await self.wsgi(scope, receive, send)
+
+    async def offer_changes(self, query_string: str) -> Tuple[int, bytes]:
+        """ Status and body of GET /offers/changes, the same as the Flask view returns. """
+        # modules of app are imported after create_app() as in it, they bind its logger
+        from ms.core import Core
+        from ms.interface import parse_changes_query
+        try:
+            since, limit, wait = parse_changes_query(dict(parse_qsl(query_string)))
+            Core.check_offer_changes_query(since, limit, wait)
+        except ValueError:
+            return HTTP_BAD_REQUEST, b''
+        except Core.EExcepted as e:
+            return e.status_code, b''
+
+        loop = asyncio.get_running_loop()
+        deadline = monotonic() + wait
+        try:
+            while True:
+                changes = await loop.run_in_executor(None, self.read_offer_changes, since, limit)
+                remaining = deadline - monotonic()
+                if changes['changes'] or remaining <= 0:
+                    return HTTP_OK, json.dumps(changes).encode()
+                await asyncio.sleep(min(CHANGES_POLL_INTERVAL, remaining))
+        except Core.EExcepted as e:
+            return e.status_code, b''
+        except Core.EUnexpected as e:
+            self.flask_app.logger.error(e)
+            return HTTP_INTERNAL_SERVER_ERROR, b''
+
+    def read_offer_changes(self, since: int, limit: int) -> dict:
+        from ms.core import Core
+        with self.flask_app.app_context():
+            return Core.read_offer_changes(since, limit)
+
+
+def create_asgi_app(test_config: dict = None) -> ASGIApp:
+    return ASGIApp(create_app(test_config))
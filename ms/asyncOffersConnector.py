@@ -0,0 +1,229 @@
+# OffersConnector on non-blocking HTTP client. One thread with event loop keeps thousands of requests in flight,
+# thread per request would need thousands of threads.
+#
+# httpx is optional dependency, it is needed only when AsyncOffersConnector is used: pip install httpx
+import asyncio
+import random
+from time import monotonic, perf_counter
+from typing import Tuple, List, Dict, Callable, Optional, Awaitable, TYPE_CHECKING
+from os import getenv
+
+if TYPE_CHECKING:
+    import httpx
+
+from ms.metrics import OFFERS_MS_REQUEST_SECONDS, OFFERS_MS_ERRORS
+from ms.offersConnector import OffersConnector, CircuitBreaker, AUTH_URL, AUTH_SUB_URL, PRODUCT_REGISTER_URL, \
+    PRODUCT_REGISTER_SUB_URL, PRODUCT_OFFERS_URL, PRODUCT_OFFERS_SUB_URL, CONNECT_TIMEOUT, READ_TIMEOUT, RETRIES, \
+    BACKOFF_BASE, BACKOFF_MAX, TOKEN_TTL, RATE_LIMIT_DIR
+from ms.rateLimiter import RateLimiter
+
+# keep-alive connections, requests above it wait in event loop for free connection
+ASYNC_POOL_SIZE = int(getenv('OffersMS_AsyncPoolSize') or 256)
+
+
+class AsyncTokenManager:
+    """ TokenManager for event loop. Concurrent refreshes are coalesced by asyncio.Lock, load/save callbacks (e.g.
+    DB) block, so they run in thread. """
+
+    def __init__(self, load_token: Callable[[], str], save_token: Callable[[str], None],
+                 auth: Callable[[], Awaitable[str]], ttl: float = TOKEN_TTL):
+        self.load_token = load_token
+        self.save_token = save_token
+        self.auth = auth
+        self.ttl = ttl
+        self.token = None
+        self.expires_at = None
+        self.lock = None  # created in event loop, before Python 3.10 lock is bound to loop of its constructor
+
+    async def get(self) -> str:
+        token = self.token
+        if token is not None and (self.expires_at is None or monotonic() < self.expires_at):
+            return token
+        return await self.refresh(stale=token)
+
+    async def refresh(self, stale: str = None) -> str:
+        """ New token instead of stale one, which was rejected or expired. """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.token is not None and self.token != stale:
+                return self.token  # refreshed by another task meanwhile
+
+            loop = asyncio.get_running_loop()
+            shared = await loop.run_in_executor(None, self.load_token)
+            if shared is not None and shared != stale:
+                self.set(shared)
+                return shared
+
+            token = await self.auth()
+            await loop.run_in_executor(None, self.save_token, token)
+            self.set(token)
+            return token
+
+    def set(self, token: str) -> None:
+        self.token = token
+        self.expires_at = monotonic() + self.ttl if self.ttl > 0 else None
+
+
+class AsyncOffersConnector:
+    """ Offers connector with coroutine methods. Retries, rate limits, circuit breaker, metrics and exceptions are
+    the same as in OffersConnector, decisions are made by its helpers and only I/O is done here. All calls must be
+    awaited in one event loop, client is bound to it. """
+
+    def __init__(self, load_token: Callable[[], str], save_token: Callable[[str], None],
+                 pool_size: int = ASYNC_POOL_SIZE, timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+                 retries: int = RETRIES, rate_limits: Dict[str, float] = None,
+                 rate_limit_dir: Optional[str] = RATE_LIMIT_DIR, breaker: CircuitBreaker = None,
+                 client: 'httpx.AsyncClient' = None):
+        """ Client can be configured by caller, e.g. with custom transport, otherwise it is created with the first
+        request. """
+        if client is None:
+            import httpx  # optional dependency, missing one fails here and not with the first request
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.limiters = OffersConnector._make_limiters(rate_limits, rate_limit_dir)
+        self.pool_size = pool_size
+        self._client = client
+        # token is obtained with the first request
+        self.tokens = AsyncTokenManager(load_token, save_token, self._request_token)
+
+    @property
+    def access_token(self) -> str:
+        return self.tokens.token
+
+    @property
+    def client(self) -> 'httpx.AsyncClient':
+        """ HTTP client is created with the first request, in event loop which runs it. """
+        if self._client is None:
+            self._client = AsyncOffersConnector._make_client(self.pool_size, self.timeout)
+        return self._client
+
+    async def auth(self) -> str:
+        """ Authenticate now, token isn't shared by save_token. """
+        token = await self._request_token()
+        self.tokens.set(token)
+        return token
+
+    async def product_register(self, prod_id: int, name: str, desc: str) -> None:
+        r, json = await self._call(url=PRODUCT_REGISTER_URL, sub_url=PRODUCT_REGISTER_SUB_URL, post=True,
+                                   json={'id': prod_id, 'name': name, 'description': desc})
+        OffersConnector._register_response(r, json)
+
+    async def product_offers(self, prod_id: int) -> List[Dict]:
+        r, json = await self._call(url=PRODUCT_OFFERS_URL.format(prod_id=prod_id), sub_url=PRODUCT_OFFERS_SUB_URL)
+        return OffersConnector._offers_response(r, json)
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # PRIVATE METHODS
+
+    async def _request_token(self) -> str:
+        r, json = await self._call_with_token(url=AUTH_URL, sub_url=AUTH_SUB_URL, method='POST')
+        return OffersConnector._token_response(r, json)
+
+    async def _call(self, url: str, sub_url: str, post: bool = False,
+                    json: Dict = None) -> Tuple['httpx.Response', Dict]:
+        """ Call guarded by circuit breaker. """
+        method = 'POST' if post else 'GET'
+        OffersConnector._allow(self.breaker, sub_url, method)
+
+        failed = True
+        try:
+            r, response_json = await self._call_with_token(url, sub_url, method, json)
+            failed = OffersConnector._failed(r=r)
+            return r, response_json
+        except Exception as e:
+            failed = OffersConnector._failed(error=e)
+            raise
+        finally:
+            if failed:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+    async def _call_with_token(self, url: str, sub_url: str, method: str,
+                               json: Dict = None) -> Tuple['httpx.Response', Dict]:
+        start = perf_counter()
+        try:
+            if sub_url == AUTH_SUB_URL:
+                return await self._call_with_retries(url, sub_url, method, json, token=None)
+
+            token = await self.tokens.get()
+            r, response_json = await self._call_with_retries(url, sub_url, method, json, token)
+            if r.status_code == 401:  # token expired, refresh it once
+                r, response_json = await self._call_with_retries(url, sub_url, method, json,
+                                                                 await self.tokens.refresh(token))
+            return r, response_json
+        finally:
+            OFFERS_MS_REQUEST_SECONDS.observe(perf_counter() - start, sub_url, method)
+
+    async def _call_with_retries(self, url: str, sub_url: str, method: str, json: Dict,
+                                 token: str) -> Tuple['httpx.Response', Dict]:
+        post = method == 'POST'
+        headers = {'Bearer': token} if token is not None else {}
+        limiter = self.limiters[sub_url]
+        attempt = 0
+        while True:
+            await AsyncOffersConnector._acquire(limiter)
+            try:
+                if post:
+                    r = await self.client.post(url, headers=headers, json=json)
+                else:
+                    r = await self.client.get(url, headers=headers)
+            except Exception as e:
+                error = AsyncOffersConnector._transport_error(e)
+                OFFERS_MS_ERRORS.inc(sub_url, method, error or 'request')
+                if error is not None and OffersConnector._retry_error(
+                        post, AsyncOffersConnector._connect_error(e), attempt, self.retries):
+                    await AsyncOffersConnector._backoff(attempt)
+                    attempt += 1
+                    continue
+                raise OffersConnector.ERequestException(url=sub_url, original_exception=e)
+
+            retry_after = OffersConnector._throttle(limiter, sub_url, method, r)
+            if OffersConnector._retry_response(post, r.status_code, attempt, self.retries):
+                if retry_after is None:
+                    await AsyncOffersConnector._backoff(attempt)
+                attempt += 1
+                continue
+            return r, OffersConnector._parse_response(url, sub_url, method, r, retry_after)
+
+    @staticmethod
+    def _transport_error(e: Exception) -> Optional[str]:
+        """ 'timeout' or 'connection' if request failed in transport, None for the other errors. """
+        import httpx
+        if isinstance(e, httpx.TimeoutException):
+            return 'timeout'
+        return 'connection' if isinstance(e, httpx.TransportError) else None
+
+    @staticmethod
+    def _connect_error(e: Exception) -> bool:
+        """ Request failed while connecting, so nothing was sent. """
+        import httpx
+        return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+
+    @staticmethod
+    def _make_client(pool_size: int, timeout: Tuple[float, float]) -> 'httpx.AsyncClient':
+        import httpx
+        # waiting for free connection isn't limited, number of requests in flight is limited by caller
+        return httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0], pool=None))
+
+    @staticmethod
+    async def _acquire(limiter: RateLimiter) -> None:
+        """ RateLimiter.acquire() which waits in event loop. """
+        while True:
+            wait = limiter.reserve()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    @staticmethod
+    async def _backoff(attempt: int) -> None:
+        """ Exponential backoff with full jitter. """
+        await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
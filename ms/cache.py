@@ -0,0 +1,89 @@
+import json
+from collections import OrderedDict
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import Hashable, Optional
+
+PRODUCT_CACHE_SIZE = int(getenv('PRODUCT_CACHE_SIZE') or 10000)  # max number of cached products per process
+PRODUCT_CACHE_TTL = float(getenv('PRODUCT_CACHE_TTL') or 60.)  # seconds
+# seconds, summary of offers is written by sync worker in another process, so it isn't invalidated
+PRODUCT_SUMMARY_TTL = float(getenv('PRODUCT_SUMMARY_TTL') or 5.)
+PRODUCT_CACHE_REDIS_URL = getenv('PRODUCT_CACHE_REDIS_URL')  # shared cache of all workers, optional
+
+
+class LRUCache:
+    """ Thread safe in-process cache with bounded size, TTL and LRU eviction. Cached values must not be None. """
+
+    def __init__(self, maxsize: int = PRODUCT_CACHE_SIZE, ttl: float = PRODUCT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key: Hashable) -> Optional[object]:
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            if item[0] <= monotonic():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return item[1]
+
+    def set(self, key: Hashable, value: object) -> None:
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = (monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+
+class RedisCache:
+    """ Cache shared by all processes, so invalidation in one worker is visible to the others. Values are stored
+    as JSON. Needs redis package. """
+
+    def __init__(self, url: str = PRODUCT_CACHE_REDIS_URL, ttl: float = PRODUCT_CACHE_TTL, prefix: str = 'ms:'):
+        import redis  # optional dependency
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = max(1, int(ttl))
+        self.prefix = prefix
+
+    def get(self, key: Hashable) -> Optional[object]:
+        value = self.redis.get(self._key(key))
+        return None if value is None else json.loads(value)
+
+    def set(self, key: Hashable, value: object) -> None:
+        self.redis.setex(self._key(key), self.ttl, json.dumps(value))
+
+    def delete(self, key: Hashable) -> None:
+        self.redis.delete(self._key(key))
+
+    def clear(self) -> None:
+        keys = list(self.redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self.redis.delete(*keys)
+
+    def _key(self, key: Hashable) -> str:
+        return '{}{}'.format(self.prefix, key)
+
+
+def make_cache(prefix: str, ttl: float = PRODUCT_CACHE_TTL):
+    """ Redis cache if PRODUCT_CACHE_REDIS_URL is defined, in-process LRU cache otherwise. """
+    if PRODUCT_CACHE_REDIS_URL:
+        return RedisCache(ttl=ttl, prefix='ms:{}:'.format(prefix))
+    return LRUCache(ttl=ttl)
@@ -1,9 +1,58 @@
 HTTP_OK = 200
 HTTP_CREATED = 201
+HTTP_NOT_MODIFIED = 304
 HTTP_BAD_REQUEST = 400
+HTTP_UNAUTHORIZED = 401
 HTTP_NOT_FOUND = 404
+HTTP_CONFLICT = 409
+HTTP_GONE = 410
 HTTP_INTERNAL_SERVER_ERROR = 500
 
+BIGINT_MAX = 2 ** 63 - 1  # integer argument bound to DB query must be in 64-bit range
 
 PRODUCT_NAME = 'name'
 PRODUCT_DESCRIPTION = 'description'
+
+BATCH_MAX_SIZE = 1000  # max number of products in one batch request
+BATCH_IDS = 'ids'  # comma separated ids of products in GET /products
+
+OFFERS_SORT = 'sort'  # price or items_in_stock
+OFFERS_ORDER = 'order'  # asc or desc
+OFFERS_LIMIT = 'limit'
+OFFERS_CURSOR = 'cursor'
+OFFERS_MIN_STOCK = 'min_stock'
+OFFERS_MAX_PRICE = 'max_price'
+OFFERS_DEFAULT_LIMIT = 50
+OFFERS_MAX_LIMIT = 500
+
+SEARCH_QUERY = 'q'  # words matched as prefixes of words in name or description
+SEARCH_LIMIT = 'limit'
+SEARCH_OFFSET = 'offset'
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_MAX_OFFSET = 10000
+
+HISTORY_FROM = 'from'  # unix time, default one day before to
+HISTORY_TO = 'to'  # unix time, default now
+HISTORY_BUCKET = 'bucket'  # length of aggregation window in seconds, whole range by default
+HISTORY_PERCENTILES = 'percentiles'  # comma separated, default 50,90
+HISTORY_DEFAULT_RANGE = 24 * 3600.
+HISTORY_MAX_WINDOWS = 10000
+
+CHANGES_SINCE = 'since'  # cursor returned by previous call, 0 = from the oldest change
+CHANGES_LIMIT = 'limit'
+CHANGES_WAIT = 'wait'  # seconds to wait for the first change (long-polling), 0 = return immediately
+CHANGES_DEFAULT_LIMIT = 1000
+CHANGES_MAX_LIMIT = 10000
+CHANGES_MAX_WAIT = 30.
+CHANGES_POLL_INTERVAL = 0.2  # seconds between reads of change log during long-polling
+
+INGEST_OFFERS = 'offers'  # offers of product in POST /offers/ingest, the same fields as offers service returns
+INGEST_OBSERVED_AT = 'observed_at'  # unix time when offers were current, default time of request
+
+EXPORT_GZIP = 'gzip'  # 1 compresses GET /export
+EXPORT_PAGE_SIZE = 1000  # products read from DB at once during export
+
+SYNC_SCHEDULER_STATUS = 'sync_scheduler_status:'  # prefix of Settings rows with state of sync workers
+METRICS_SNAPSHOT_PREFIX = 'metrics:'  # Settings rows with metrics of worker processes, e.g. metrics:sync
+CHANGES_PRUNED = 'offer_changes_pruned'  # Settings row with seq of the newest offer change deleted by retention
@@ -1,14 +1,44 @@
+import base64
+import json
+import math
+from collections import defaultdict
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, bindparam, or_, select
+from time import monotonic, sleep, time
+from typing import Iterator, List, Optional, Tuple
 
-from ms.dbModels import Product
+from ms.dbModels import Product, Offer, OfferChange, OfferSummary, PriceHistoryChunk, Settings, RegistrationOutbox
 from ms.offersConnector import OffersConnector
-from ms.consts import HTTP_NOT_FOUND, HTTP_BAD_REQUEST
+from ms.cache import make_cache, PRODUCT_SUMMARY_TTL
+from ms.history import HistoryStore
+from ms.offersWriter import OffersWriter
+from ms.reconciliation import reconcile, offer_validation, ID, PRICE, ITEMS_IN_STOCK, INTEGER_MAX
+from ms.search import ProductSearch
+from ms.consts import HTTP_OK, HTTP_CREATED, HTTP_NOT_FOUND, HTTP_BAD_REQUEST, HTTP_CONFLICT, HTTP_GONE, \
+    SYNC_SCHEDULER_STATUS, OFFERS_DEFAULT_LIMIT, OFFERS_MAX_LIMIT, BATCH_MAX_SIZE, HISTORY_MAX_WINDOWS, \
+    METRICS_SNAPSHOT_PREFIX, EXPORT_PAGE_SIZE, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, SEARCH_MAX_OFFSET, \
+    CHANGES_DEFAULT_LIMIT, CHANGES_MAX_LIMIT, CHANGES_MAX_WAIT, CHANGES_POLL_INTERVAL, CHANGES_PRUNED
+from ms.metrics import REGISTRY, INGEST_PRODUCTS
 from ms import logger
 
+# statements are built once, their compiled form is cached by SQLAlchemy
+SUMMARY_QUERY = select(OfferSummary.prod_id, OfferSummary.best_price, OfferSummary.offer_count,
+                       OfferSummary.total_stock, OfferSummary.last_synced) \
+    .where(OfferSummary.prod_id.in_(bindparam('prod_ids', expanding=True)))
+PRODUCT_QUERY = select(Product.id, Product.name, Product.description, OfferSummary.prod_id, OfferSummary.best_price,
+                       OfferSummary.offer_count, OfferSummary.total_stock, OfferSummary.last_synced) \
+    .outerjoin(OfferSummary, OfferSummary.prod_id == Product.id) \
+    .where(Product.id.in_(bindparam('prod_ids', expanding=True)))
+CHANGES_QUERY = select(OfferChange.seq, OfferChange.prod_id, OfferChange.remote_id, OfferChange.change,
+                       OfferChange.price, OfferChange.items_in_stock, OfferChange.changed_at) \
+    .where(OfferChange.seq > bindparam('since')).order_by(OfferChange.seq).limit(bindparam('limit'))
+
 
 class Core:
     db = None
     offersMS = None
+    product_cache = None
+    summary_cache = None
 
     class ECore(Exception):
         """ Common Exception for Core class. """
@@ -30,16 +60,23 @@ class Core:
                 return Core.EBadRequest(HTTP_BAD_REQUEST)
             elif status_code == HTTP_NOT_FOUND:
                 return Core.ENotFound(HTTP_NOT_FOUND)
+            elif status_code == HTTP_GONE:
+                return Core.EGone(HTTP_GONE)
 
     class EBadRequest(EExcepted):
         """ Exception for Bad Request response. """
     class ENotFound(EExcepted):
         """ Exception for Not Found response. """
+    class EGone(EExcepted):
+        """ Exception for Gone response. """
 
     @staticmethod
-    def init(db: SQLAlchemy, offers_ms: OffersConnector):
+    def init(db: SQLAlchemy, offers_ms: OffersConnector, product_cache=None, summary_cache=None):
         Core.db = db
         Core.offersMS = offers_ms
+        Core.product_cache = product_cache if product_cache is not None else make_cache('product')
+        Core.summary_cache = summary_cache if summary_cache is not None \
+            else make_cache('summary', PRODUCT_SUMMARY_TTL)
 
     @staticmethod
     def create_product(name: str, description: str):
@@ -49,23 +86,27 @@ class Core:
         try:
             p = Product(name=name, description=description)
             Core.db.session.add(p)
+            Core.db.session.flush()
+            # registration to offers service is done by OutboxWorker
+            Core.db.session.add(RegistrationOutbox(prod_id=p.id))
+            ProductSearch.index(Core.db, [(p.id, name, description)])
             Core.db.session.commit()
-            Core.offersMS.product_register(p.id, p.name, p.description)
-            logger.info('New product registered in offers ms: {}'.format(p))
+            logger.info('New product created: {}'.format(p))
         except Exception as e:
+            Core.db.session.rollback()
             raise Core.EUnexpected(e)
 
     @staticmethod
     def get_product(prod_id: int):
+        """ Product with summary of its offers. """
         try:
-            p = Product.query.get(prod_id)
+            found = Core._read_products([prod_id])
         except Exception as e:
             raise Core.EUnexpected(e)
 
-        if p is None:
+        if prod_id not in found:
             raise Core.EExcepted.make_descendant(HTTP_NOT_FOUND)
-
-        return {'id': p.id, 'name': p.name, 'description': p.description}
+        return found[prod_id]
 
     @staticmethod
     def update_product(prod_id: int, name: str = None, description: str = None):
@@ -86,10 +127,13 @@ class Core:
             p.description = description
 
         try:
+            ProductSearch.index(Core.db, [(p.id, p.name, p.description)])
             Core.db.session.commit()
             # Cannot update in offers service due to missing documentation
         except Exception as e:
             raise Core.EUnexpected(e)
+        finally:
+            Core._cache_delete(prod_id)
 
     @staticmethod
     def delete_product(prod_id: int):
@@ -102,9 +146,494 @@ class Core:
             raise Core.EExcepted.make_descendant(HTTP_NOT_FOUND)
 
         try:
+            Core._delete_dependents([prod_id])
             Core.db.session.delete(p)
+            ProductSearch.remove(Core.db, [prod_id])
             Core.db.session.commit()
             # Cannot delete from offers service due to missing documentation.
             logger.info('Product was deleted: {}'.format(p))
         except Exception as e:
             raise Core.EUnexpected(e)
+        finally:
+            Core._cache_delete(prod_id)
+            Core._cache_delete(prod_id, Core.summary_cache)
+
+    # BATCH OPERATIONS
+    # Batch is processed in single transaction. Result contains status code of each item in order of request.
+
+    @staticmethod
+    def create_products(products: List[Tuple[str, str]]) -> List[dict]:
+        Core._check_batch(products)
+
+        results = [None] * len(products)
+        created = []
+        for i, (name, description) in enumerate(products):
+            if name is None or description is None:
+                results[i] = {'status': HTTP_BAD_REQUEST}
+            else:
+                created.append((i, Product(name=name, description=description)))
+
+        try:
+            Core.db.session.add_all([p for _, p in created])
+            Core.db.session.flush()
+            Core.db.session.add_all([RegistrationOutbox(prod_id=p.id) for _, p in created])
+            ProductSearch.index(Core.db, [(p.id, p.name, p.description) for _, p in created])
+            Core.db.session.commit()
+        except Exception as e:
+            Core.db.session.rollback()
+            raise Core.EUnexpected(e)
+
+        for i, p in created:
+            results[i] = {'id': p.id, 'status': HTTP_CREATED}
+        return results
+
+    @staticmethod
+    def get_products(prod_ids: List[int]) -> List[dict]:
+        Core._check_batch(prod_ids)
+
+        try:
+            found = Core._read_products(set(prod_ids))
+        except Exception as e:
+            raise Core.EUnexpected(e)
+
+        return [
+            dict(found[prod_id], status=HTTP_OK) if prod_id in found else {'id': prod_id, 'status': HTTP_NOT_FOUND}
+            for prod_id in prod_ids
+        ]
+
+    @staticmethod
+    def update_products(products: List[Tuple[int, str, str]]) -> List[dict]:
+        Core._check_batch(products)
+
+        try:
+            prod_ids = [prod_id for prod_id, _, _ in products if prod_id is not None]
+            found = {p.id: p for p in Product.query.filter(Product.id.in_(prod_ids))}
+        except Exception as e:
+            raise Core.EUnexpected(e)
+
+        results = []
+        for prod_id, name, description in products:
+            p = found.get(prod_id)
+            if prod_id is None or (name is None and description is None):
+                results.append({'id': prod_id, 'status': HTTP_BAD_REQUEST})
+                continue
+            if p is None:
+                results.append({'id': prod_id, 'status': HTTP_NOT_FOUND})
+                continue
+
+            if name is not None:
+                p.name = name
+            if description is not None:
+                p.description = description
+            results.append({'id': prod_id, 'status': HTTP_OK})
+
+        try:
+            updated = {r['id'] for r in results if r['status'] == HTTP_OK}
+            ProductSearch.index(Core.db, [(p.id, p.name, p.description) for p in found.values() if p.id in updated])
+            Core.db.session.commit()
+        except Exception as e:
+            Core.db.session.rollback()
+            raise Core.EUnexpected(e)
+        finally:
+            for prod_id in found:
+                Core._cache_delete(prod_id)
+        return results
+
+    @staticmethod
+    def delete_products(prod_ids: List[int]) -> List[dict]:
+        Core._check_batch(prod_ids)
+
+        try:
+            found = {p.id: p for p in Product.query.filter(Product.id.in_(prod_ids))}
+            Core._delete_dependents(list(found))
+            for p in found.values():
+                Core.db.session.delete(p)
+            ProductSearch.remove(Core.db, found)
+            Core.db.session.commit()
+            logger.info('Products were deleted: {}'.format(sorted(found)))
+        except Exception as e:
+            Core.db.session.rollback()
+            raise Core.EUnexpected(e)
+        finally:
+            for prod_id in prod_ids:
+                Core._cache_delete(prod_id)
+                Core._cache_delete(prod_id, Core.summary_cache)
+
+        return [{'id': prod_id, 'status': HTTP_OK if prod_id in found else HTTP_NOT_FOUND} for prod_id in prod_ids]
+
+    @staticmethod
+    def search_products(query: str, limit: int = SEARCH_DEFAULT_LIMIT, offset: int = 0) -> dict:
+        """ Page of products matching all words of query, ordered by relevance. """
+        if not query or not query.strip() or not 0 < limit <= SEARCH_MAX_LIMIT or not 0 <= offset <= SEARCH_MAX_OFFSET:
+            raise Core.EExcepted.make_descendant(HTTP_BAD_REQUEST)
+
+        try:
+            products = ProductSearch.search(Core.db, query, limit + 1, offset)  # one more tells whether next exists
+            summaries = Core._get_summaries([p['id'] for p in products[:limit]])
+        except Exception as e:
+            raise Core.EUnexpected(e)
+
+        next_offset = offset + limit if len(products) > limit else None
+        return {'products': [dict(p, summary=summaries.get(p['id'])) for p in products[:limit]],
+                'next_offset': next_offset}
+
+    @staticmethod
+    def ingest_offers(items: List[Tuple[Optional[int], Optional[list], Optional[float]]]) -> List[dict]:
+        """ Apply pushed offers of products, items are (prod_id, offers, observed_at). Offers of item replace
+        current offers of product the same way as sync does, so the same item applied again changes nothing. Item
+        observed before the last sync or push of product is stale and skipped (409). The whole batch is written by
+        OffersWriter together with summaries, change log and price history. """
+        Core._check_batch(items)
+
+        now = time()
+        pushed = {}  # prod_id -> (index of item, offers, observed_at)
+        for i, (prod_id, offers, observed_at) in enumerate(items):
+            if prod_id is not None and 0 < prod_id <= INTEGER_MAX and prod_id not in pushed \
+                    and Core._valid_offers(offers) and (observed_at is None or Core._valid_time(observed_at)):
+                pushed[prod_id] = (i, offers, min(now, observed_at) if observed_at is not None else now)
+
+        try:
+            found = {prod_id for prod_id, in Core.db.session.query(Product.id).filter(Product.id.in_(pushed))}
+            last_synced = dict(Core.db.session.query(OfferSummary.prod_id, OfferSummary.last_synced)
+                               .filter(OfferSummary.prod_id.in_(found)))
+        except Exception as e:
+            raise Core.EUnexpected(e)
+        fresh = {prod_id for prod_id in found if pushed[prod_id][2] >= (last_synced.get(prod_id) or 0.)}
+
+        try:
+            local = defaultdict(list)
+            for offer_id, prod_id, remote_id, price, items_in_stock in Core.db.session.query(
+                    Offer.id, Offer.prod_id, Offer.remote_id, Offer.price, Offer.items_in_stock) \
+                    .filter(Offer.prod_id.in_(fresh)):
+                local[prod_id].append((offer_id, remote_id, price, items_in_stock))
+
+            batch = []
+            samples = {}
+            changed = {}
+            for prod_id in sorted(fresh):
+                _, offers, observed_at = pushed[prod_id]
+                changes = reconcile(prod_id, local[prod_id], offers)
+                changes.summary['last_synced'] = observed_at
+                batch.append(changes)
+                changed[prod_id] = len(changes.inserts) + len(changes.updates) + len(changes.deletes)
+                if observed_at > (last_synced.get(prod_id) or 0.):  # replayed item doesn't duplicate history
+                    samples[prod_id] = [(observed_at, offer[ID], offer[PRICE], offer[ITEMS_IN_STOCK])
+                                        for offer in offers]
+            OffersWriter.write(Core.db, batch, samples=samples)
+        except Exception as e:
+            Core.db.session.rollback()
+            raise Core.EUnexpected(e)
+        finally:
+            for prod_id in fresh:
+                Core._cache_delete(prod_id, Core.summary_cache)
+
+        results = []
+        for i, (prod_id, _, _) in enumerate(items):
+            if prod_id not in pushed or pushed[prod_id][0] != i:  # invalid or duplicated item
+                result = {'id': prod_id, 'status': HTTP_BAD_REQUEST}
+            elif prod_id in fresh:
+                result = {'id': prod_id, 'status': HTTP_OK, 'changes': changed[prod_id]}
+            elif prod_id in found:
+                result = {'id': prod_id, 'status': HTTP_CONFLICT}
+            else:
+                result = {'id': prod_id, 'status': HTTP_NOT_FOUND}
+            INGEST_PRODUCTS.inc(str(result['status']))
+            results.append(result)
+        return results
+
+    @staticmethod
+    def get_offer_changes(since: int = 0, limit: int = CHANGES_DEFAULT_LIMIT, wait: float = 0.) -> dict:
+        """ Offer changes after cursor since in order of seq. If there is none, wait for them up to wait seconds
+        (long-polling). Waiting request holds its thread, ASGI entry point (ms.asgi) waits in event loop instead. """
+        Core.check_offer_changes_query(since, limit, wait)
+        deadline = monotonic() + wait
+        while True:
+            changes = Core.read_offer_changes(since, limit)
+            remaining = deadline - monotonic()
+            if changes['changes'] or remaining <= 0:
+                return changes
+            sleep(min(CHANGES_POLL_INTERVAL, remaining))
+
+    @staticmethod
+    def check_offer_changes_query(since: int, limit: int, wait: float) -> None:
+        if since is None or since < 0 or not 0 < limit <= CHANGES_MAX_LIMIT or not 0 <= wait <= CHANGES_MAX_WAIT:
+            raise Core.EExcepted.make_descendant(HTTP_BAD_REQUEST)
+
+    @staticmethod
+    def read_offer_changes(since: int, limit: int) -> dict:
+        """ Offer changes after cursor since without waiting. Each read is range scan of primary key, so cost depends
+        on number of changes only. Transaction is ended, so it isn't held (with snapshot of SQLite WAL) between
+        reads of long-polling. Cursor older than changes deleted by retention raises EGone, client missed them and
+        must reload offers and start again from 0 (the oldest kept change). """
+        try:
+            rows = Core.db.session.execute(CHANGES_QUERY, {'since': since, 'limit': limit + 1}).all()
+            # read after changes, retention moves it before it deletes them
+            pruned = Core.db.session.query(Settings.value).filter(Settings.name == CHANGES_PRUNED).scalar() \
+                if since > 0 else None
+            Core.db.session.rollback()
+        except Exception as e:
+            raise Core.EUnexpected(e)
+        if pruned is not None and since < int(pruned):
+            raise Core.EExcepted.make_descendant(HTTP_GONE)
+
+        changes = [
+            {'seq': seq, 'prod_id': prod_id, 'remote_id': remote_id, 'change': change, 'price': price,
+             'items_in_stock': items_in_stock, 'changed_at': changed_at}
+            for seq, prod_id, remote_id, change, price, items_in_stock, changed_at in rows[:limit]
+        ]
+        cursor = changes[-1]['seq'] if changes else since
+        return {'changes': changes, 'cursor': cursor, 'has_more': len(rows) > limit}
+
+    @staticmethod
+    def get_offers(prod_id: int, sort: str = 'price', order: str = 'asc', limit: int = OFFERS_DEFAULT_LIMIT,
+                   cursor: str = None, min_stock: int = None, max_price: int = None):
+        """ Page of offers of product ordered by sort column and id. Page continues after cursor returned with
+        previous page (keyset pagination), so page is read by range scan of covering index however deep it is.
+        Offers are from the last successful sync, its time is returned as last_synced (None before the first one). """
+        columns = {'price': Offer.price, 'items_in_stock': Offer.items_in_stock}
+        if sort not in columns or order not in ('asc', 'desc') or limit is None or not 0 < limit <= OFFERS_MAX_LIMIT:
+            raise Core.EExcepted.make_descendant(HTTP_BAD_REQUEST)
+        column = columns[sort]
+        desc = order == 'desc'
+
+        after = None
+        if cursor is not None:
+            after = Core._decode_cursor(cursor)
+            if after is None:
+                raise Core.EExcepted.make_descendant(HTTP_BAD_REQUEST)
+
+        try:
+            product = Core.db.session.query(Product.id, OfferSummary.last_synced) \
+                .outerjoin(OfferSummary, OfferSummary.prod_id == Product.id).filter(Product.id == prod_id).first()
+            if product is None:
+                raise Core.EExcepted.make_descendant(HTTP_NOT_FOUND)
+
+            q = Core.db.session.query(Offer.id, Offer.remote_id, Offer.price, Offer.items_in_stock) \
+                .filter(Offer.prod_id == prod_id)
+            if min_stock is not None:
+                q = q.filter(Offer.items_in_stock >= min_stock)
+            if max_price is not None:
+                q = q.filter(Offer.price <= max_price)
+            if after is not None:
+                value, offer_id = after
+                if desc:
+                    q = q.filter(or_(column < value, and_(column == value, Offer.id < offer_id)))
+                else:
+                    q = q.filter(or_(column > value, and_(column == value, Offer.id > offer_id)))
+            q = q.order_by(column.desc(), Offer.id.desc()) if desc else q.order_by(column, Offer.id)
+
+            rows = q.limit(limit + 1).all()  # one more row tells whether next page exists
+        except Core.ECore:
+            raise
+        except Exception as e:
+            raise Core.EUnexpected(e)
+
+        offers = [
+            {'id': offer_id, 'remote_id': remote_id, 'price': price, 'items_in_stock': items_in_stock}
+            for offer_id, remote_id, price, items_in_stock in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = offers[-1]
+            next_cursor = Core._encode_cursor(last[sort], last['id'])
+
+        return {'offers': offers, 'next_cursor': next_cursor, 'last_synced': product.last_synced}
+
+    @staticmethod
+    def export_products(page_size: int = EXPORT_PAGE_SIZE) -> Iterator[List[dict]]:
+        """ Pages of products with their offers ordered by id. Products are read by keyset pages and offers of page
+        by one range query, so memory doesn't depend on catalogue size and no transaction is open between pages. """
+        session = Core.db.session
+        last_id = 0
+        while True:
+            try:
+                products = session.query(Product.id, Product.name, Product.description) \
+                    .filter(Product.id > last_id).order_by(Product.id).limit(page_size).all()
+                if not products:
+                    session.commit()
+                    return
+
+                last_id = products[-1][0]
+                offers = {prod_id: [] for prod_id, _, _ in products}
+                rows = session.query(Offer.prod_id, Offer.id, Offer.remote_id, Offer.price, Offer.items_in_stock) \
+                    .filter(Offer.prod_id >= products[0][0], Offer.prod_id <= last_id) \
+                    .order_by(Offer.prod_id, Offer.id)
+                for prod_id, offer_id, remote_id, price, items_in_stock in rows:
+                    offers[prod_id].append(
+                        {'id': offer_id, 'remote_id': remote_id, 'price': price, 'items_in_stock': items_in_stock})
+                session.commit()
+            except Exception as e:
+                raise Core.EUnexpected(e)
+
+            yield [{'id': prod_id, 'name': name, 'description': description, 'offers': offers[prod_id]}
+                   for prod_id, name, description in products]
+
+    @staticmethod
+    def get_history(prod_id: int, start: float, end: float, bucket: float = None, percentiles: List[float] = None):
+        """ Statistics of price and stock of product offers observed by sync job between start and end. """
+        if not math.isfinite(start) or not math.isfinite(end) or end <= start \
+                or (bucket is not None and (not math.isfinite(bucket) or bucket <= 0
+                                            or (end - start) / bucket > HISTORY_MAX_WINDOWS)) \
+                or any(not 0. <= p <= 100. for p in percentiles or ()):
+            raise Core.EExcepted.make_descendant(HTTP_BAD_REQUEST)
+
+        try:
+            if Core.db.session.query(Product.id).filter_by(id=prod_id).scalar() is None:
+                raise Core.EExcepted.make_descendant(HTTP_NOT_FOUND)
+            if percentiles is None:
+                return HistoryStore.aggregate(prod_id, start, end, bucket)
+            return HistoryStore.aggregate(prod_id, start, end, bucket, percentiles)
+        except Core.ECore:
+            raise
+        except Exception as e:
+            raise Core.EUnexpected(e)
+
+    @staticmethod
+    def get_sync_status():
+        """ Totals over all sync workers and state of each worker. """
+        try:
+            rows = Settings.query.filter(Settings.name.startswith(SYNC_SCHEDULER_STATUS))
+            workers = [json.loads(row.value) for row in rows]
+        except Exception as e:
+            raise Core.EUnexpected(e)
+
+        if not workers:  # sync job didn't publish its state yet
+            raise Core.EExcepted.make_descendant(HTTP_NOT_FOUND)
+
+        status = {key: sum(w[key] for w in workers) for key in ('products', 'queue_depth', 'in_progress', 'due')}
+        for key, aggregate in (('next_due_in', min), ('min_interval', min), ('max_interval', max)):
+            values = [w[key] for w in workers if w[key] is not None]
+            status[key] = aggregate(values) if values else None
+        status['workers'] = sorted(workers, key=lambda w: w['worker'])
+        return status
+
+    @staticmethod
+    def get_metrics() -> str:
+        """ Metrics of this process in Prometheus text format, summed with the last snapshots published by workers. """
+        try:
+            snapshots = [s.value for s in Settings.query.filter(Settings.name.startswith(METRICS_SNAPSHOT_PREFIX))]
+        except Exception as e:
+            raise Core.EUnexpected(e)
+
+        return REGISTRY.render(snapshots)
+
+    # PRIVATE METHODS
+
+    @staticmethod
+    def _read_products(prod_ids) -> dict:
+        """ prod_id -> product with summary of its offers, for products which exist. Product missing in cache is
+        read together with its summary by one query. """
+        found = {}
+        missing = []
+        for prod_id in prod_ids:
+            cached = Core._cache_get(prod_id)
+            if cached is not None:
+                found[prod_id] = cached
+            else:
+                missing.append(prod_id)
+
+        summaries = {}
+        if missing:
+            for prod_id, name, description, *summary in Core.db.session.execute(PRODUCT_QUERY,
+                                                                                {'prod_ids': missing}):
+                found[prod_id] = {'id': prod_id, 'name': name, 'description': description}
+                Core._cache_set(prod_id, found[prod_id])
+                summaries[prod_id] = Core._summary(*summary)
+                Core._cache_set(prod_id, {'summary': summaries[prod_id]}, Core.summary_cache)
+
+        summaries.update(Core._get_summaries([prod_id for prod_id in found if prod_id not in summaries]))
+        return {prod_id: dict(product, summary=summaries.get(prod_id)) for prod_id, product in found.items()}
+
+    @staticmethod
+    def _get_summaries(prod_ids) -> dict:
+        """ prod_id -> summary of offers (None before the first sync), by primary key lookups. Summaries are cached
+        for PRODUCT_SUMMARY_TTL only, sync writes them in another process. """
+        summaries = {}
+        missing = []
+        for prod_id in prod_ids:
+            cached = Core._cache_get(prod_id, Core.summary_cache)
+            if cached is not None:
+                summaries[prod_id] = cached['summary']
+            else:
+                missing.append(prod_id)
+        if not missing:
+            return summaries
+
+        read = {prod_id: Core._summary(prod_id, *summary)
+                for prod_id, *summary in Core.db.session.execute(SUMMARY_QUERY, {'prod_ids': missing})}
+        for prod_id in missing:
+            summaries[prod_id] = read.get(prod_id)
+            Core._cache_set(prod_id, {'summary': summaries[prod_id]}, Core.summary_cache)
+        return summaries
+
+    @staticmethod
+    def _summary(prod_id: Optional[int], best_price: int, offer_count: int, total_stock: int,
+                 last_synced: float) -> Optional[dict]:
+        """ Summary of OfferSummary columns, None if product has no summary row. """
+        if prod_id is None:
+            return None
+        return {'best_price': best_price, 'offer_count': offer_count, 'total_stock': total_stock,
+                'last_synced': last_synced}
+
+    @staticmethod
+    def _delete_dependents(prod_ids: List[int]) -> None:
+        """ Delete offers, summaries and price history of products in current transaction. Offers are logged as
+        deleted, so readers of change feed drop them too. """
+        if not prod_ids:
+            return
+        OffersWriter.delete_products(Core.db, prod_ids)
+        OfferSummary.query.filter(OfferSummary.prod_id.in_(prod_ids)).delete(synchronize_session=False)
+        PriceHistoryChunk.query.filter(PriceHistoryChunk.prod_id.in_(prod_ids)).delete(synchronize_session=False)
+
+    @staticmethod
+    def _valid_offers(offers: list) -> bool:
+        """ Offers pass the same validation as offers fetched by sync, so their values fit DB columns. """
+        return isinstance(offers, list) and all(offer_validation(offer) for offer in offers)
+
+    @staticmethod
+    def _valid_time(value) -> bool:
+        """ Finite non-negative number of seconds, bool isn't number here. """
+        return (type(value) is int or type(value) is float and math.isfinite(value)) and value >= 0
+
+    @staticmethod
+    def _check_batch(items: list) -> None:
+        if not isinstance(items, list) or not 0 < len(items) <= BATCH_MAX_SIZE:
+            raise Core.EExcepted.make_descendant(HTTP_BAD_REQUEST)
+
+    @staticmethod
+    def _encode_cursor(value: int, offer_id: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps([value, offer_id]).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str):
+        try:
+            value, offer_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            return None
+        if not isinstance(value, int) or not isinstance(offer_id, int):
+            return None
+        return value, offer_id
+
+    # Cache is only optimization, so its errors are logged and request is served from DB.
+
+    @staticmethod
+    def _cache_get(prod_id: int, cache=None) -> Optional[dict]:
+        try:
+            return (Core.product_cache if cache is None else cache).get(prod_id)
+        except Exception as e:
+            logger.error('Product cache get failed: {}'.format(e))
+            return None
+
+    @staticmethod
+    def _cache_set(prod_id: int, product: dict, cache=None) -> None:
+        try:
+            (Core.product_cache if cache is None else cache).set(prod_id, product)
+        except Exception as e:
+            logger.error('Product cache set failed: {}'.format(e))
+
+    @staticmethod
+    def _cache_delete(prod_id: int, cache=None) -> None:
+        try:
+            (Core.product_cache if cache is None else cache).delete(prod_id)
+        except Exception as e:
+            logger.error('Product cache invalidation failed: {}'.format(e))
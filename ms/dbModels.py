@@ -11,8 +11,15 @@ class Product(db.Model):
 
 
 class Offer(db.Model):
+    __table_args__ = (
+        db.Index('ix_offer_prod_id_remote_id', 'prod_id', 'remote_id', unique=True),
+        # covering indexes of paginated offers read API (GET /product/<id>/offers)
+        db.Index('ix_offer_prod_id_price', 'prod_id', 'price', 'id', 'items_in_stock', 'remote_id'),
+        db.Index('ix_offer_prod_id_items_in_stock', 'prod_id', 'items_in_stock', 'id', 'price', 'remote_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    prod_id = db.Column(db.Integer, db.ForeignKey('product.id'))
+    prod_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'))
     remote_id = db.Column(db.Integer)  # for keeping offers dedudiplicated
     price = db.Column(db.Integer)
     items_in_stock = db.Column(db.Integer)
@@ -22,6 +29,89 @@ class Offer(db.Model):
             self.id, self.prod_id, self.remote_id, self.price, self.items_in_stock)
 
 
+class OfferSummary(db.Model):
+    """ Aggregates of current offers of product, written by sync job together with offers. """
+    prod_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), primary_key=True,
+                        autoincrement=False)
+    best_price = db.Column(db.Integer)  # None if product has no offers
+    offer_count = db.Column(db.Integer, nullable=False, default=0)
+    total_stock = db.Column(db.BigInteger, nullable=False, default=0)  # sum of all offers exceeds 32 bits
+    last_synced = db.Column(db.Float)  # unix time
+
+    def __repr__(self):
+        return '<OfferSummary prod_id: {}, best_price: {}, offer_count: {}, total_stock: {}, last_synced: {}>'.format(
+            self.prod_id, self.best_price, self.offer_count, self.total_stock, self.last_synced)
+
+
+class OfferChange(db.Model):
+    """ Log of inserted, updated and deleted offers written with the offers in the same transaction. seq grows with
+    every change and is never reused, clients read changes after the last seq they have seen. """
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = db.Column(db.Integer, primary_key=True)
+    prod_id = db.Column(db.Integer, nullable=False)  # not a foreign key, deletes outlive the product
+    remote_id = db.Column(db.Integer, nullable=False)
+    change = db.Column(db.String(6), nullable=False)  # insert, update or delete
+    price = db.Column(db.Integer)  # None for delete
+    items_in_stock = db.Column(db.Integer)  # None for delete
+    changed_at = db.Column(db.Float, nullable=False)  # unix time
+
+    def __repr__(self):
+        return '<OfferChange seq: {}, prod_id: {}, remote_id: {}, change: {}, price: {}, items_in_stock: {}>'.format(
+            self.seq, self.prod_id, self.remote_id, self.change, self.price, self.items_in_stock)
+
+
+class PriceHistoryChunk(db.Model):
+    """ Compressed columns of price and stock observations of product, see HistoryStore. """
+    __table_args__ = (
+        db.Index('ix_price_history_chunk_prod_id_end_ts', 'prod_id', 'end_ts'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    prod_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
+    start_ts = db.Column(db.Float, nullable=False)  # unix time of the first sample
+    end_ts = db.Column(db.Float, nullable=False)  # unix time of the last sample
+    samples = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return '<PriceHistoryChunk id: {}, prod_id: {}, start_ts: {}, end_ts: {}, samples: {}>'.format(
+            self.id, self.prod_id, self.start_ts, self.end_ts, self.samples)
+
+
+class RegistrationOutbox(db.Model):
+    """ Products waiting for registration to offers service. Row is written in the same transaction as product and
+    removed by OutboxWorker after successful registration. """
+    id = db.Column(db.Integer, primary_key=True)
+    prod_id = db.Column(db.Integer, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.Float, nullable=False, default=0., index=True)  # unix time
+    last_error = db.Column(db.String)
+
+    def __repr__(self):
+        return '<RegistrationOutbox id: {}, prod_id: {}, attempts: {}, next_attempt_at: {}>'.format(
+            self.id, self.prod_id, self.attempts, self.next_attempt_at)
+
+
+class SyncLease(db.Model):
+    """ Lease of bucket of products (Product.id % number of buckets) held by one sync worker, see SyncLeases. """
+    bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    owner = db.Column(db.String)  # id of SyncWorker, None if bucket is free
+    expires_at = db.Column(db.Float, nullable=False, default=0.)  # unix time
+
+    def __repr__(self):
+        return '<SyncLease bucket: {}, owner: {}, expires_at: {}>'.format(self.bucket, self.owner, self.expires_at)
+
+
+class SyncWorker(db.Model):
+    """ Live sync workers, used to compute fair share of buckets. """
+    id = db.Column(db.String, primary_key=True)
+    heartbeat = db.Column(db.Float, nullable=False)  # unix time
+
+    def __repr__(self):
+        return '<SyncWorker id: {}, heartbeat: {}>'.format(self.id, self.heartbeat)
+
+
 class Settings(db.Model):
     name = db.Column(db.String, primary_key=True)
     value = db.Column(db.String)
@@ -0,0 +1,22 @@
+import json
+import zlib
+from typing import Iterable, Iterator, List
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+GZIP_LEVEL = 6
+
+
+def ndjson(pages: Iterable[List[dict]]) -> Iterator[bytes]:
+    """ One JSON document per line, one chunk per page, so records aren't written to socket one by one. """
+    for page in pages:
+        yield ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in page).encode()
+
+
+def gzip(chunks: Iterable[bytes], level: int = GZIP_LEVEL) -> Iterator[bytes]:
+    """ Gzip stream. Each chunk is flushed, so client can decompress data as soon as it is received. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,183 @@
+# Local stand-in of offers service for tests and benchmarks. Use it by OffersMS_BaseUrl env variable:
+#
+#   $ python -m ms.fakeOffersService --port 8765 --latency 0.05 --error-rate 0.01 --offers 20
+#   $ export OffersMS_BaseUrl=http://127.0.0.1:8765/api/v1
+import argparse
+import json
+import random
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep
+from typing import List, Dict
+
+API_PREFIX = '/api/v1'
+ACCESS_TOKEN = 'fake-access-token'
+OFFERS_URL_RE = re.compile(r'^/products/(\d+)/offers$')
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # many clients connect at once
+
+
+class FakeOffersService:
+    """ HTTP server with the same API as offers service. Latency, error rate (503 responses), number of offers of
+    product and rate of price changes between two reads of offers are configurable. """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0., error_rate: float = 0.,
+                 offers: int = 10, change_rate: float = 0.1, auto_register: bool = False):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.offers = offers
+        self.change_rate = change_rate
+        self.auto_register = auto_register  # offers of not registered products are returned too
+        self.registered = set()
+        self.requests = 0
+        self.auths = 0
+        self.access_token = ACCESS_TOKEN
+        self.throttled = 0  # number of next requests refused with 429
+        self.retry_after = 1
+        self.lock = Lock()
+        self.server = Server((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    @property
+    def base_url(self) -> str:
+        return 'http://{}:{}{}'.format(self.server.server_address[0], self.port, API_PREFIX)
+
+    def start(self) -> 'FakeOffersService':
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire_tokens(self) -> None:
+        """ Tokens issued so far are rejected with 401. """
+        with self.lock:
+            self.access_token = '{}-{}'.format(ACCESS_TOKEN, self.auths)
+
+    def throttle(self, requests: int, retry_after: int = 1) -> None:
+        """ Next requests are refused with 429 and Retry-After header. """
+        with self.lock:
+            self.throttled = requests
+            self.retry_after = retry_after
+
+    def product_offers(self, prod_id: int) -> List[Dict]:
+        """ Offers are deterministic per product, `change_rate` of them has different price on each read. """
+        rnd = random.Random(prod_id)
+        offers = [{'id': prod_id * 1000 + i, 'price': rnd.randint(100, 10000), 'items_in_stock': rnd.randint(0, 100)}
+                  for i in range(self.offers)]
+        for offer in offers:
+            if random.random() < self.change_rate:
+                offer['price'] += random.randint(1, 100)
+        return offers
+
+    # PRIVATE METHODS
+
+    def _handle(self, method: str, path: str, body: Dict):
+        with self.lock:
+            self.requests += 1
+            if self.throttled:
+                self.throttled -= 1
+                return 429, {'code': 429, 'msg': 'Too many requests.'}
+        if self.latency:
+            sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {'code': 503, 'msg': 'Service unavailable.'}
+
+        if not path.startswith(API_PREFIX):
+            return 404, {'code': 404, 'msg': 'Not found.'}
+        path = path[len(API_PREFIX):]
+
+        if method == 'POST' and path == '/auth':
+            with self.lock:
+                self.auths += 1
+                return 201, {'access_token': self.access_token}
+
+        if method == 'POST' and path == '/products/register':
+            if not isinstance(body, dict) or 'id' not in body:
+                return 400, {'code': 400, 'msg': 'Bad request.'}
+            with self.lock:
+                if body['id'] in self.registered:
+                    return 400, {'code': 400, 'msg': 'Product already registered.'}
+                self.registered.add(body['id'])
+            return 201, {'id': body['id']}
+
+        match = OFFERS_URL_RE.match(path)
+        if method == 'GET' and match:
+            prod_id = int(match.group(1))
+            if not self.auto_register and prod_id not in self.registered:
+                return 404, {'code': 404, 'msg': 'Product not registered.'}
+            return 200, self.product_offers(prod_id)
+
+        return 404, {'code': 404, 'msg': 'Not found.'}
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            disable_nagle_algorithm = True  # headers and body are sent separately
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, method: str):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = None
+                if length:
+                    try:
+                        body = json.loads(self.rfile.read(length))
+                    except ValueError:
+                        pass
+
+                if self.headers.get('Bearer') != service.access_token and not self.path.endswith('/auth'):
+                    code, json_response = 401, {'code': 401, 'msg': 'Access token is missing or invalid.'}
+                else:
+                    code, json_response = service._handle(method, self.path, body)
+
+                data = json.dumps(json_response).encode()
+                self.send_response(code)
+                if code == 429:
+                    self.send_header('Retry-After', str(service.retry_after))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of offers service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0., help='seconds added to each response')
+    parser.add_argument('--error-rate', type=float, default=0., help='fraction of 503 responses')
+    parser.add_argument('--offers', type=int, default=10, help='offers per product')
+    parser.add_argument('--change-rate', type=float, default=0.1, help='fraction of offers changed on each read')
+    parser.add_argument('--auto-register', action='store_true', help='return offers of not registered products')
+    args = parser.parse_args()
+
+    service = FakeOffersService(args.host, args.port, args.latency, args.error_rate, args.offers, args.change_rate,
+                                args.auto_register)
+    print('Fake offers service running on {}'.format(service.base_url))
+    service.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import struct
+import zlib
+from flask_sqlalchemy import SQLAlchemy
+from os import getenv
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    import numpy as np  # imported on first use, it is slow to import and API process needs it rarely
+
+from ms.dbModels import PriceHistoryChunk
+
+# max number of samples in one chunk
+HISTORY_CHUNK_SIZE = int(getenv('HISTORY_CHUNK_SIZE') or 4096)
+COMPRESSION_LEVEL = 1
+
+# Columns of chunk, each compressed separately so only needed columns are decompressed. Time is stored run length
+# encoded, all offers of product observed during one sync have the same time.
+BLOCKS = (('ts_values', '<f8'), ('ts_runs', '<i4'), ('remote_id', '<i8'), ('price', '<i8'), ('items_in_stock', '<i8'))
+HEADER = struct.Struct('<' + 'I' * len(BLOCKS))  # compressed length of each block
+COLUMNS = ('ts', 'remote_id', 'price', 'items_in_stock')
+COLUMN_TYPES = {'ts': '<f8', 'remote_id': '<i8', 'price': '<i8', 'items_in_stock': '<i8'}
+
+# (unix time, remote_id, price, items_in_stock) observed by sync job
+Sample = Tuple[float, int, int, int]
+
+
+class HistoryStore:
+    """ Append only store of price and stock observations. Samples of product are kept in columnar, zlib compressed
+    chunks, the last chunk of product is open for appends until it has HISTORY_CHUNK_SIZE samples. """
+
+    @staticmethod
+    def append(db: SQLAlchemy, samples: Dict[int, List[Sample]], chunk_size: int = HISTORY_CHUNK_SIZE) -> None:
+        """ Append samples of several products, caller commits. Samples of product must be ordered by time. """
+        import numpy as np
+        samples = {prod_id: s for prod_id, s in samples.items() if s}
+        if not samples:
+            return
+
+        open_chunks = {
+            chunk.prod_id: chunk for chunk in db.session.query(PriceHistoryChunk)
+            .filter(PriceHistoryChunk.prod_id.in_(samples), PriceHistoryChunk.samples < chunk_size)
+        }
+
+        for prod_id, product_samples in samples.items():
+            columns = HistoryStore._to_columns(product_samples)
+            chunk = open_chunks.get(prod_id)
+            if chunk is not None:
+                free = chunk_size - chunk.samples
+                old = HistoryStore.decode(chunk)
+                HistoryStore._encode(chunk, [np.concatenate((o, c[:free])) for o, c in zip(old, columns)])
+                columns = [c[free:] for c in columns]
+
+            for i in range(0, len(columns[0]), chunk_size):
+                chunk = PriceHistoryChunk(prod_id=prod_id)
+                HistoryStore._encode(chunk, [c[i:i + chunk_size] for c in columns])
+                db.session.add(chunk)
+
+    @staticmethod
+    def load(prod_id: int, start: float, end: float, columns: Sequence[str] = COLUMNS) -> List[np.ndarray]:
+        """ Columns of samples of product with start <= ts < end, ordered by time. """
+        import numpy as np
+        chunks = PriceHistoryChunk.query \
+            .filter(PriceHistoryChunk.prod_id == prod_id, PriceHistoryChunk.end_ts >= start,
+                    PriceHistoryChunk.start_ts < end) \
+            .order_by(PriceHistoryChunk.start_ts)
+
+        columns = ['ts'] + [c for c in columns if c != 'ts']
+        decoded = [HistoryStore.decode(chunk, columns) for chunk in chunks]
+        if not decoded:
+            return [np.empty(0, dtype=COLUMN_TYPES[c]) for c in columns]
+
+        data = [np.concatenate(column) for column in zip(*decoded)]
+        mask = (data[0] >= start) & (data[0] < end)
+        return [column[mask] for column in data]
+
+    @staticmethod
+    def aggregate(prod_id: int, start: float, end: float, bucket: Optional[float] = None,
+                  percentiles: Sequence[float] = (50., 90.)) -> Dict:
+        """ count, min, max, mean and percentiles of price and stock in window or in windows of bucket seconds. """
+        import numpy as np
+        ts, price, stock = HistoryStore.load(prod_id, start, end, ('ts', 'price', 'items_in_stock'))
+        percentiles = np.asarray(percentiles, dtype=np.float64)
+
+        if bucket is None:
+            groups = np.zeros(len(ts), dtype=np.int64)
+        else:
+            groups = ((ts - start) // bucket).astype(np.int64)
+            if len(groups) > 1 and np.any(groups[1:] < groups[:-1]):
+                order = np.argsort(groups, kind='stable')
+                groups, price, stock = groups[order], price[order], stock[order]
+
+        # groups are sorted, so each group is consecutive slice
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else np.empty(0, np.int64)
+        counts = np.diff(np.r_[starts, len(groups)])
+        group_ids = groups[starts]
+
+        stats = {name: HistoryStore._group_stats(values, groups, starts, counts, percentiles)
+                 for name, values in (('price', price), ('items_in_stock', stock))}
+
+        windows = []
+        for i, group_id in enumerate(group_ids):
+            window = {
+                'from': start + group_id * bucket if bucket is not None else start,
+                'to': min(end, start + (group_id + 1) * bucket) if bucket is not None else end,
+                'count': int(counts[i])
+            }
+            for name, s in stats.items():
+                window[name] = {key: float(value[i]) for key, value in s.items()}
+            windows.append(window)
+
+        if bucket is None:
+            return windows[0] if windows else {'from': start, 'to': end, 'count': 0}
+        return {'from': start, 'to': end, 'bucket': bucket, 'windows': windows}
+
+    @staticmethod
+    def decode(chunk: PriceHistoryChunk, columns: Sequence[str] = COLUMNS) -> List[np.ndarray]:
+        import numpy as np
+        lengths = HEADER.unpack_from(chunk.data)
+        blocks = {}
+        offset = HEADER.size
+        for (name, dtype), length in zip(BLOCKS, lengths):
+            if name in columns or (name.startswith('ts_') and 'ts' in columns):
+                raw = zlib.decompress(chunk.data[offset:offset + length])
+                if dtype == '<i8' and len(raw) == 4 * chunk.samples:
+                    dtype = '<i4'  # chunk written before price and stock were stored as 64 bit
+                blocks[name] = np.frombuffer(raw, dtype=dtype)
+            offset += length
+
+        ret = []
+        for column in columns:
+            if column == 'ts':
+                ret.append(np.repeat(blocks['ts_values'], blocks['ts_runs']))
+            else:
+                ret.append(blocks[column])
+        return ret
+
+    # PRIVATE METHODS
+
+    @staticmethod
+    def _encode(chunk: PriceHistoryChunk, columns: List[np.ndarray]) -> None:
+        import numpy as np
+        ts, remote_id, price, stock = columns
+        run_starts = np.flatnonzero(np.r_[True, ts[1:] != ts[:-1]])
+        ts_runs = np.diff(np.r_[run_starts, len(ts)])
+
+        blocks = [zlib.compress(np.ascontiguousarray(block, dtype=dtype).tobytes(), COMPRESSION_LEVEL)
+                  for block, (_, dtype) in zip((ts[run_starts], ts_runs, remote_id, price, stock), BLOCKS)]
+        chunk.samples = len(ts)
+        chunk.start_ts = float(ts[0])
+        chunk.end_ts = float(ts[-1])
+        chunk.data = HEADER.pack(*(len(block) for block in blocks)) + b''.join(blocks)
+
+    @staticmethod
+    def _to_columns(samples: Iterable[Sample]) -> List[np.ndarray]:
+        import numpy as np
+        return [np.asarray(column, dtype=COLUMN_TYPES[name]) for column, name in zip(zip(*samples), COLUMNS)]
+
+    @staticmethod
+    def _group_stats(values: np.ndarray, groups: np.ndarray, starts: np.ndarray, counts: np.ndarray,
+                     percentiles: np.ndarray) -> Dict[str, np.ndarray]:
+        """ Vectorized statistics of values split to groups of consecutive items, groups are sorted. """
+        import numpy as np
+        if len(values) == 0:
+            return {}
+
+        ret = {
+            'min': np.minimum.reduceat(values, starts),
+            'max': np.maximum.reduceat(values, starts),
+            'mean': np.add.reduceat(values.astype(np.float64), starts) / counts
+        }
+
+        # Sort values inside groups. Single sort of (group, value) packed to int64 is much faster than lexsort.
+        low = int(values.min())
+        if len(starts) == 1:
+            ordered = np.sort(values).astype(np.float64)
+        elif int(values.max()) - low < 2 ** 31 and int(groups[-1]) < 2 ** 31:
+            ordered = (np.sort((groups << 32) | (values.astype(np.int64) - low)) & 0xffffffff) + low
+            ordered = ordered.astype(np.float64)
+        else:
+            ordered = values[np.lexsort((values, groups))].astype(np.float64)
+
+        # percentiles with linear interpolation as np.percentile, all groups at once
+        for p in percentiles:
+            position = starts + (counts - 1) * p / 100.
+            lower = np.floor(position).astype(np.int64)
+            upper = np.minimum(lower + 1, starts + counts - 1)
+            fraction = position - lower
+            ret['p{:g}'.format(p)] = ordered[lower] * (1. - fraction) + ordered[upper] * fraction
+        return ret
@@ -1,10 +1,35 @@
-from flask import request, jsonify, Blueprint, current_app
+import hmac
+from flask import request, jsonify, Blueprint, current_app, g, Response, stream_with_context
+from os import getenv
+from time import perf_counter, time
 from ms.core import Core
-from ms.consts import HTTP_INTERNAL_SERVER_ERROR, HTTP_CREATED, HTTP_OK, PRODUCT_NAME, PRODUCT_DESCRIPTION
+from ms.consts import HTTP_INTERNAL_SERVER_ERROR, HTTP_CREATED, HTTP_OK, HTTP_BAD_REQUEST, HTTP_UNAUTHORIZED, \
+    PRODUCT_NAME, PRODUCT_DESCRIPTION, OFFERS_SORT, OFFERS_ORDER, OFFERS_LIMIT, OFFERS_CURSOR, OFFERS_MIN_STOCK, \
+    OFFERS_MAX_PRICE, OFFERS_DEFAULT_LIMIT, BATCH_IDS, HISTORY_FROM, HISTORY_TO, HISTORY_BUCKET, HISTORY_PERCENTILES, \
+    HISTORY_DEFAULT_RANGE, EXPORT_GZIP, SEARCH_QUERY, SEARCH_LIMIT, SEARCH_OFFSET, SEARCH_DEFAULT_LIMIT, \
+    CHANGES_SINCE, CHANGES_LIMIT, CHANGES_WAIT, CHANGES_DEFAULT_LIMIT, INGEST_OFFERS, INGEST_OBSERVED_AT, BIGINT_MAX
+from ms import export
+from ms.metrics import HTTP_REQUEST_SECONDS, CONTENT_TYPE
+
+# POST /offers/ingest requires header Authorization: Bearer <INGEST_TOKEN> if it is set
+INGEST_TOKEN = getenv('INGEST_TOKEN')
 
 interface_blueprint = Blueprint('interface_blueprint', __name__)
 
 
+@interface_blueprint.before_request
+def start_timer():
+    g.request_start = perf_counter()
+
+
+@interface_blueprint.after_request
+def observe_latency(response):
+    # route template instead of path, so number of label values is bounded
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HTTP_REQUEST_SECONDS.observe(perf_counter() - g.request_start, route, request.method, response.status_code)
+    return response
+
+
 @interface_blueprint.route('/product', methods=['POST'])
 def product_register():
     name, description = parse_product()
@@ -30,7 +55,10 @@ def product_read(prod_id):
         current_app.logger.error(e)
         return "", HTTP_INTERNAL_SERVER_ERROR
 
-    return jsonify(p), HTTP_OK
+    # ETag of product, client with the same version gets Not Modified without body
+    response = jsonify(p)
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @interface_blueprint.route('/product/<int:prod_id>', methods=['POST'])
@@ -61,6 +89,184 @@ def product_delete(prod_id):
     return "", HTTP_OK
 
 
+@interface_blueprint.route('/products', methods=['POST'])
+def products_register():
+    items = parse_batch()
+    if items is None:
+        return "", HTTP_BAD_REQUEST
+    return batch_response(Core.create_products, [parse_product_item(item) for item in items])
+
+
+@interface_blueprint.route('/products', methods=['GET'])
+def products_read():
+    try:
+        prod_ids = [int(prod_id) for prod_id in request.args.get(BATCH_IDS, '').split(',')]
+    except ValueError:
+        return "", HTTP_BAD_REQUEST
+    return batch_response(Core.get_products, prod_ids)
+
+
+@interface_blueprint.route('/products', methods=['PUT'])
+def products_update():
+    items = parse_batch()
+    if items is None:
+        return "", HTTP_BAD_REQUEST
+    products = []
+    for item in items:
+        prod_id = item.get('id') if isinstance(item, dict) else None
+        products.append((prod_id if type(prod_id) is int else None, *parse_product_item(item)))
+    return batch_response(Core.update_products, products)
+
+
+@interface_blueprint.route('/products', methods=['DELETE'])
+def products_delete():
+    items = parse_batch()
+    if items is None or not all(type(prod_id) is int for prod_id in items):  # bool is int too
+        return "", HTTP_BAD_REQUEST
+    return batch_response(Core.delete_products, items)
+
+
+@interface_blueprint.route('/products/search', methods=['GET'])
+def products_search():
+    try:
+        limit = int(request.args.get(SEARCH_LIMIT, SEARCH_DEFAULT_LIMIT))
+        offset = int(request.args.get(SEARCH_OFFSET, 0))
+    except ValueError:
+        return "", HTTP_BAD_REQUEST
+
+    try:
+        products = Core.search_products(request.args.get(SEARCH_QUERY), limit, offset)
+    except Core.EExcepted as e:
+        return "", e.status_code
+    except Core.EUnexpected as e:
+        current_app.logger.error(e)
+        return "", HTTP_INTERNAL_SERVER_ERROR
+
+    return jsonify(products), HTTP_OK
+
+
+@interface_blueprint.route('/product/<int:prod_id>/offers', methods=['GET'])
+def product_offers(prod_id):
+    try:
+        query = parse_offers_query()
+    except ValueError:
+        return "", HTTP_BAD_REQUEST
+
+    try:
+        offers = Core.get_offers(prod_id, **query)
+    except Core.EExcepted as e:
+        return "", e.status_code
+    except Core.EUnexpected as e:
+        current_app.logger.error(e)
+        return "", HTTP_INTERNAL_SERVER_ERROR
+
+    return jsonify(offers), HTTP_OK
+
+
+@interface_blueprint.route('/offers/changes', methods=['GET'])
+def offer_changes():
+    try:
+        since, limit, wait = parse_changes_query(request.args)
+    except ValueError:
+        return "", HTTP_BAD_REQUEST
+
+    try:
+        changes = Core.get_offer_changes(since, limit, wait)
+    except Core.EExcepted as e:
+        return "", e.status_code
+    except Core.EUnexpected as e:
+        current_app.logger.error(e)
+        return "", HTTP_INTERNAL_SERVER_ERROR
+
+    return jsonify(changes), HTTP_OK
+
+
+@interface_blueprint.route('/offers/ingest', methods=['POST'])
+def offers_ingest():
+    if INGEST_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                'Bearer {}'.format(INGEST_TOKEN)):
+        return "", HTTP_UNAUTHORIZED
+
+    items = parse_batch()
+    if items is None:
+        return "", HTTP_BAD_REQUEST
+    return batch_response(Core.ingest_offers, [parse_ingest_item(item) for item in items])
+
+
+@interface_blueprint.route('/product/<int:prod_id>/history', methods=['GET'])
+def product_history(prod_id):
+    try:
+        query = parse_history_query()
+    except ValueError:
+        return "", HTTP_BAD_REQUEST
+
+    try:
+        history = Core.get_history(prod_id, **query)
+    except Core.EExcepted as e:
+        return "", e.status_code
+    except Core.EUnexpected as e:
+        current_app.logger.error(e)
+        return "", HTTP_INTERNAL_SERVER_ERROR
+
+    return jsonify(history), HTTP_OK
+
+
+@interface_blueprint.route('/sync/status', methods=['GET'])
+def sync_status():
+    try:
+        status = Core.get_sync_status()
+    except Core.EExcepted as e:
+        return "", e.status_code
+    except Core.EUnexpected as e:
+        current_app.logger.error(e)
+        return "", HTTP_INTERNAL_SERVER_ERROR
+
+    return jsonify(status), HTTP_OK
+
+
+@interface_blueprint.route('/export', methods=['GET'])
+def export_catalogue():
+    """ All products with offers as NDJSON, streamed as they are read from DB. """
+    compress = request.args.get(EXPORT_GZIP) == '1'
+
+    def generate():
+        try:
+            chunks = export.ndjson(Core.export_products())
+            yield from export.gzip(chunks) if compress else chunks
+        except Core.EUnexpected as e:
+            # status is already sent, broken stream tells client that export is incomplete
+            current_app.logger.error(e)
+            raise
+
+    response = Response(stream_with_context(generate()), HTTP_OK, mimetype=export.NDJSON_MIMETYPE)
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@interface_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    try:
+        text = Core.get_metrics()
+    except Core.EUnexpected as e:
+        current_app.logger.error(e)
+        return "", HTTP_INTERNAL_SERVER_ERROR
+
+    return text, HTTP_OK, {'Content-Type': CONTENT_TYPE}
+
+
+def batch_response(operation, items: list):
+    try:
+        results = operation(items)
+    except Core.EExcepted as e:
+        return "", e.status_code
+    except Core.EUnexpected as e:
+        current_app.logger.error(e)
+        return "", HTTP_INTERNAL_SERVER_ERROR
+
+    return jsonify(results), HTTP_OK
+
+
 def parse_product():
     json = request.get_json(force=True, silent=True, cache=False)
     if json is None:
@@ -69,3 +275,71 @@ def parse_product():
     name = json[PRODUCT_NAME] if PRODUCT_NAME in json else None
     description = json[PRODUCT_DESCRIPTION] if PRODUCT_DESCRIPTION in json else None
     return name, description
+
+
+def parse_product_item(item):
+    """ name and description of batch item, both None (bad request) if item or its given field isn't valid. """
+    if not isinstance(item, dict):
+        return None, None
+    name, description = item.get(PRODUCT_NAME), item.get(PRODUCT_DESCRIPTION)
+    if not all(value is None or isinstance(value, str) for value in (name, description)):
+        return None, None
+    return name, description
+
+
+def parse_ingest_item(item):
+    if not isinstance(item, dict):
+        return None, None, None
+    prod_id = item.get('id')
+    return prod_id if type(prod_id) is int else None, item.get(INGEST_OFFERS), item.get(INGEST_OBSERVED_AT)
+
+
+def parse_batch() -> list:
+    """ JSON array of request or None if body isn't array. """
+    json = request.get_json(force=True, silent=True, cache=False)
+    return json if isinstance(json, list) else None
+
+
+def parse_changes_query(args) -> tuple:
+    """ since, limit and wait of GET /offers/changes from mapping of query arguments, shared by ASGI entry point.
+    Raise ValueError if argument is invalid. """
+    return parse_bigint(args.get(CHANGES_SINCE, 0)), int(args.get(CHANGES_LIMIT, CHANGES_DEFAULT_LIMIT)), \
+        float(args.get(CHANGES_WAIT, 0.))
+
+
+def parse_offers_query():
+    """ Raise ValueError if numeric argument is invalid. """
+    args = request.args
+    min_stock = args.get(OFFERS_MIN_STOCK)
+    max_price = args.get(OFFERS_MAX_PRICE)
+    return {
+        'sort': args.get(OFFERS_SORT, 'price'),
+        'order': args.get(OFFERS_ORDER, 'asc'),
+        'limit': int(args.get(OFFERS_LIMIT, OFFERS_DEFAULT_LIMIT)),
+        'cursor': args.get(OFFERS_CURSOR),
+        'min_stock': parse_bigint(min_stock) if min_stock is not None else None,
+        'max_price': parse_bigint(max_price) if max_price is not None else None
+    }
+
+
+def parse_bigint(value: str) -> int:
+    """ Integer in 64-bit range, larger one would overflow DB parameter. Raise ValueError if value is invalid. """
+    number = int(value)
+    if not -BIGINT_MAX - 1 <= number <= BIGINT_MAX:
+        raise ValueError('Integer out of range: {}'.format(value))
+    return number
+
+
+def parse_history_query():
+    """ Raise ValueError if numeric argument is invalid. """
+    args = request.args
+    end = float(args.get(HISTORY_TO, time()))
+    start = float(args.get(HISTORY_FROM, end - HISTORY_DEFAULT_RANGE))
+    bucket = args.get(HISTORY_BUCKET)
+    percentiles = args.get(HISTORY_PERCENTILES)
+    return {
+        'start': start,
+        'end': end,
+        'bucket': float(bucket) if bucket is not None else None,
+        'percentiles': [float(p) for p in percentiles.split(',')] if percentiles is not None else None
+    }
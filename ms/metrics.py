@@ -0,0 +1,212 @@
+import json
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+CYCLE_BUCKETS = (0.1, 0.5, 1., 5., 10., 30., 60., 120., 300., 600., 1800.)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """ Family of samples with the same name, one sample per combination of label values. Updates take one lock and
+    a few list operations, so instrumentation can stay on in production. """
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}  # label values -> sample
+        self.lock = Lock()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.values.clear()
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            values = [[list(key), list(value)] for key, value in self.values.items()]
+        return {'type': self.type, 'help': self.documentation, 'labels': list(self.labels), 'values': values}
+
+    def render(self, values: Dict[Tuple, List[float]]) -> Iterable[str]:
+        raise NotImplementedError
+
+    def _label_pairs(self, key: Sequence, extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *label_values, amount: float = 1.) -> None:
+        with self.lock:
+            value = self.values.get(label_values)
+            if value is None:
+                self.values[label_values] = [amount]
+            else:
+                value[0] += amount
+
+    def render(self, values: Dict[Tuple, List[float]]) -> Iterable[str]:
+        for key, (value,) in sorted(values.items()):
+            yield '{}{} {}'.format(self.name, self._label_pairs(key), _number(value))
+
+
+class Histogram(Metric):
+    """ Sample is [count of bucket 1, ..., count of bucket n, count of +Inf bucket, sum]. Counts of buckets are not
+    cumulative, they are summed up during rendering. """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values) -> None:
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            sample = self.values.get(label_values)
+            if sample is None:
+                sample = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.]
+            sample[i] += 1
+            sample[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *label_values)
+
+    def snapshot(self) -> Dict:
+        ret = super().snapshot()
+        ret['buckets'] = list(self.buckets)
+        return ret
+
+    def render(self, values: Dict[Tuple, List[float]]) -> Iterable[str]:
+        bounds = [_number(bound) for bound in self.buckets] + ['+Inf']
+        for key, sample in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, sample[:-1]):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, self._label_pairs(key, (('le', bound),)), cumulative)
+            yield '{}_sum{} {}'.format(self.name, self._label_pairs(key), _number(sample[-1]))
+            yield '{}_count{} {}'.format(self.name, self._label_pairs(key), cumulative)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def reset(self) -> None:
+        """ Forked worker process starts from zero, values of parent are reported by parent. """
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self) -> str:
+        """ JSON with values of all metrics, workers store it to DB, so API process can report them. """
+        return json.dumps({name: metric.snapshot() for name, metric in self.metrics.items()})
+
+    def render(self, snapshots: Iterable[str] = ()) -> str:
+        """ Prometheus text format of own metrics summed with metrics from snapshots of other processes. """
+        merged = {}
+        for name, metric in self.metrics.items():
+            merged[name] = {tuple(key): value for key, value in metric.snapshot()['values']}
+
+        for snapshot in snapshots:
+            for name, data in json.loads(snapshot).items():
+                if name not in merged:  # metric of other version
+                    continue
+                values = merged[name]
+                for key, value in data['values']:
+                    key = tuple(key)
+                    if key in values and len(values[key]) == len(value):
+                        values[key] = [a + b for a, b in zip(values[key], value)]
+                    elif key not in values:
+                        values[key] = value
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.type))
+            lines.extend(metric.render(merged[name]))
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError('Metric {} is already registered.'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'ms_http_request_duration_seconds', 'Latency of API requests.', ('route', 'method', 'status'))
+OFFERS_MS_REQUEST_SECONDS = REGISTRY.histogram(
+    'ms_offers_ms_request_duration_seconds', 'Latency of calls to offers service including retries.',
+    ('endpoint', 'method'))
+OFFERS_MS_ERRORS = REGISTRY.counter(
+    'ms_offers_ms_errors_total', 'Failed attempts of calls to offers service by class of error.',
+    ('endpoint', 'method', 'error'))
+SYNC_CYCLE_SECONDS = REGISTRY.histogram(
+    'ms_sync_cycle_duration_seconds', 'Duration of sync cycles.', buckets=CYCLE_BUCKETS)
+SYNC_PRODUCTS = REGISTRY.counter('ms_sync_products_total', 'Products synced with offers service.')
+SYNC_OFFERS = REGISTRY.counter('ms_sync_offers_total', 'Offers changed by sync job.', ('change',))
+SYNC_ERRORS = REGISTRY.counter(
+    'ms_sync_errors_total', 'Products whose sync failed and was postponed, by class of error.', ('error',))
+INGEST_PRODUCTS = REGISTRY.counter(
+    'ms_ingest_products_total', 'Products in POST /offers/ingest by status of item.', ('status',))
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'ms_db_query_duration_seconds', 'Latency of DB statements by kind of statement.', ('statement',))
+
+
+def instrument_db() -> None:
+    """ Time all statements of all engines. Safe to call repeatedly. """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+# PRIVATE METHODS
+
+# start is kept by execution context of statement, failed statement doesn't leave it on pooled connection
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.ms_query_start = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'ms_query_start', None)
+    if start is not None:
+        DB_QUERY_SECONDS.observe(perf_counter() - start, statement.lstrip()[:16].split(None, 1)[0].upper())
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
@@ -4,10 +4,18 @@
 # * Version of connector can be tagged in repository and older version can be used if older version of
 #   offers service deployed somewhere.
 # * This code can be simply reused in another project.
-import requests
-from typing import Tuple, List, Dict, Callable
+import random
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+from typing import Tuple, List, Dict, Callable, Optional, TYPE_CHECKING
 from os import getenv
 
+if TYPE_CHECKING:  # requests is imported with the first call, it takes a large part of startup of API process
+    import requests
+
+from ms.metrics import OFFERS_MS_REQUEST_SECONDS, OFFERS_MS_ERRORS
+from ms.rateLimiter import RateLimiter, parse_retry_after
+
 # URL
 BASE_URL = getenv('OffersMS_BaseUrl')
 BASE_URL = 'https://applifting-python-excercise-ms.herokuapp.com/api/v1' if BASE_URL is None else BASE_URL
@@ -18,12 +26,128 @@ PRODUCT_REGISTER_URL = BASE_URL + PRODUCT_REGISTER_SUB_URL
 PRODUCT_OFFERS_SUB_URL = '/products/{prod_id}/offers'
 PRODUCT_OFFERS_URL = BASE_URL + PRODUCT_OFFERS_SUB_URL
 
+# HTTP session
+POOL_SIZE = int(getenv('OffersMS_PoolSize') or 32)  # keep-alive connections kept in pool
+CONNECT_TIMEOUT = float(getenv('OffersMS_ConnectTimeout') or 3.05)
+READ_TIMEOUT = float(getenv('OffersMS_ReadTimeout') or 10.)
+RETRIES = int(getenv('OffersMS_Retries') or 3)  # retries after first attempt
+BACKOFF_BASE = float(getenv('OffersMS_BackoffBase') or 0.1)  # seconds
+BACKOFF_MAX = float(getenv('OffersMS_BackoffMax') or 5.)  # seconds
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+THROTTLE_STATUS_CODES = (429, 503)  # service is overloaded, rate of requests is decreased
+TOKEN_TTL = float(getenv('OffersMS_TokenTTL') or 0.)  # token is refreshed after this time in seconds, 0 = on 401 only
+
+# max requests per second of each endpoint, 0 = unlimited
+RATE_LIMITS = {
+    AUTH_SUB_URL: float(getenv('OffersMS_RateAuth') or 10.),
+    PRODUCT_REGISTER_SUB_URL: float(getenv('OffersMS_RateRegister') or 100.),
+    PRODUCT_OFFERS_SUB_URL: float(getenv('OffersMS_RateOffers') or 1000.),
+}
+# state of rate limiters is shared by all processes using the same directory, None keeps it in process
+RATE_LIMIT_DIR = getenv('OffersMS_RateLimitDir') or None
+# circuit opens after this number of consecutive failed calls, 0 = never
+BREAKER_THRESHOLD = int(getenv('OffersMS_BreakerThreshold') or 5)
+BREAKER_COOLDOWN = float(getenv('OffersMS_BreakerCooldown') or 30.)  # seconds before trial call
+
 # offers API Values
 ACCESS_TOKEN = 'access_token'
 ERROR_CODE = 'code'
 ERROR_MESSAGE = 'msq'
 
 
+class TokenManager:
+    """ Access token cached in memory and shared with other processes by load/save callbacks (e.g. DB). Token is
+    refreshed lazily when it expires or service rejects it. Concurrent refreshes are coalesced: the first thread
+    refreshes, the others wait and use its token. Before authentication token is reloaded, so process doesn't
+    authenticate again when another process already did. """
+
+    def __init__(self, load_token: Callable[[], str], save_token: Callable[[str], None], auth: Callable[[], str],
+                 ttl: float = TOKEN_TTL):
+        self.load_token = load_token
+        self.save_token = save_token
+        self.auth = auth
+        self.ttl = ttl
+        self.token = None
+        self.expires_at = None
+        self.lock = Lock()
+
+    def get(self) -> str:
+        token = self.token
+        if token is not None and (self.expires_at is None or monotonic() < self.expires_at):
+            return token
+        return self.refresh(stale=token)
+
+    def refresh(self, stale: str = None) -> str:
+        """ New token instead of stale one, which was rejected or expired. """
+        with self.lock:
+            if self.token is not None and self.token != stale:
+                return self.token  # refreshed by another thread meanwhile
+
+            shared = self.load_token()
+            if shared is not None and shared != stale:
+                self._set(shared)
+                return shared
+
+            token = self.auth()
+            self.save_token(token)
+            self._set(token)
+            return token
+
+    def set(self, token: str) -> None:
+        with self.lock:
+            self._set(token)
+
+    def _set(self, token: str) -> None:
+        self.token = token
+        self.expires_at = monotonic() + self.ttl if self.ttl > 0 else None
+
+
+class CircuitBreaker:
+    """ Fails calls fast while offers service is down. Circuit opens after `threshold` consecutive failed calls,
+    after `cooldown` seconds one trial call is let through (half-open) and circuit closes when it succeeds. """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False  # trial call is running
+        self.lock = Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CircuitBreaker.CLOSED
+        return CircuitBreaker.HALF_OPEN if self.trial else CircuitBreaker.OPEN
+
+    def allow(self) -> bool:
+        """ True if call can be made. Caller must report its result by success() or failure(). """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and monotonic() - self.opened_at >= self.cooldown:
+                self.trial = True
+                return True
+            return False
+
+    def success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and 0 < self.threshold <= self.failures):
+                self.opened_at = monotonic()
+            self.trial = False
+
+
 class OffersConnector:
 
     # EXCEPTIONS
@@ -33,10 +157,17 @@ class OffersConnector:
     class EConnection(EOffersConnector):
         """ Exceptions corresponding with connection to service. """
 
-    class ENoAuth(EConnection):
-        """ Offers service need simple authentication. Call OffersConnector.auth() before any action. """
+    class ECircuitOpen(EConnection):
+        """ Offers service failed repeatedly, calls fail fast until trial call succeeds. """
         def __init__(self, url: str):
-            self.msg = '{url} - no authentication.'.format(url=url)
+            self.msg = '{url} - Circuit is open, offers service is failing.'.format(url=url)
+
+    class ETooManyRequests(EConnection):
+        """ Offers service kept refusing requests for rate limit (429) after all retries. """
+        def __init__(self, url: str, retry_after: float = None):
+            self.msg = '{url} - Too many requests, retry after: {retry_after}.'.format(url=url,
+                                                                                      retry_after=retry_after)
+            self.retry_after = retry_after
 
     class ERequestException(EConnection):
         """ Exception during connection to Offers service """
@@ -94,58 +225,179 @@ class OffersConnector:
 
     # CLASS METHODS
 
-    def __init__(self, load_token: Callable[[], str], save_token: Callable[[str], None]):
-        self.access_token = load_token()
-        if self.access_token is None:
-            save_token(self.auth())
+    def __init__(self, load_token: Callable[[], str], save_token: Callable[[str], None], pool_size: int = POOL_SIZE,
+                 timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT), retries: int = RETRIES,
+                 rate_limits: Dict[str, float] = None, rate_limit_dir: Optional[str] = RATE_LIMIT_DIR,
+                 breaker: CircuitBreaker = None):
+        """ Rate limiters are shared with other processes by files in rate_limit_dir, None keeps them in
+        process. """
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.limiters = OffersConnector._make_limiters(rate_limits, rate_limit_dir)
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = Lock()
+        # token is obtained with the first request
+        self.tokens = TokenManager(load_token, save_token, self._request_token)
+
+    @property
+    def access_token(self) -> str:
+        return self.tokens.token
+
+    @property
+    def session(self) -> 'requests.Session':
+        """ HTTP session is created with the first request, so the connector costs nothing until it is used. """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = OffersConnector._make_session(self.pool_size)
+        return self._session
 
     def auth(self) -> str:
-        r, json = self._call(url=AUTH_URL, sub_url=AUTH_SUB_URL, post=True)
-
-        if r.status_code != 201:
-            raise OffersConnector.EUnexpectedResponse(AUTH_URL, r.status_code, json)
-
-        if ACCESS_TOKEN not in json:
-            raise OffersConnector.ECannotParseToken(url=AUTH_URL, json=json)
-
-        self.access_token = json[ACCESS_TOKEN]
-        return self.access_token
+        """ Authenticate now, token isn't shared by save_token. """
+        token = self._request_token()
+        self.tokens.set(token)
+        return token
 
     def product_register(self, prod_id: int, name: str, desc: str) -> None:
         r, json = self._call(url=PRODUCT_REGISTER_URL, sub_url=PRODUCT_REGISTER_SUB_URL, post=True,
                              json={'id': prod_id, 'name': name, 'description': desc})
-
-        if r.status_code == 201:
-            return
-
-        self._invalid_response(sub_url=PRODUCT_OFFERS_SUB_URL, expected_codes=(400, 401), r=r, json=json)
+        OffersConnector._register_response(r, json)
 
     def product_offers(self, prod_id: int) -> List[Dict]:
         r, json = self._call(url=PRODUCT_OFFERS_URL.format(prod_id=prod_id), sub_url=PRODUCT_OFFERS_SUB_URL)
+        return OffersConnector._offers_response(r, json)
 
-        if r.status_code == 200:
-            return list(json)
-
-        self._invalid_response(sub_url=PRODUCT_OFFERS_SUB_URL, expected_codes=(400, 401, 404), r=r, json=json)
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
 
     # PRIVATE METHODS
 
-    def _call(self, url: str, sub_url: str, post: bool = False, json: Dict = None) -> Tuple[requests.Response, Dict]:
-        if self.access_token is None and sub_url != AUTH_SUB_URL:
-            raise OffersConnector.ENoAuth(url=sub_url)
+    def _request_token(self) -> str:
+        # auth is part of call which is already guarded by circuit breaker or it is called explicitly
+        r, json = self._call_with_token(url=AUTH_URL, sub_url=AUTH_SUB_URL, method='POST')
+        return OffersConnector._token_response(r, json)
 
+    def _call(self, url: str, sub_url: str, post: bool = False,
+              json: Dict = None) -> Tuple['requests.Response', Dict]:
+        """ Call guarded by circuit breaker. """
+        method = 'POST' if post else 'GET'
+        OffersConnector._allow(self.breaker, sub_url, method)
+
+        failed = True
         try:
-            headers = {'Bearer': self.access_token}
-            if post:
-                r = requests.post(url, headers=headers, json=json)
-            else:
-                r = requests.get(url, headers=headers)
+            r, response_json = self._call_with_token(url, sub_url, method, json)
+            failed = OffersConnector._failed(r=r)
+            return r, response_json
         except Exception as e:
-            raise OffersConnector.ERequestException(url=sub_url, original_exception=e)
+            failed = OffersConnector._failed(error=e)
+            raise
+        finally:
+            if failed:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+    def _call_with_token(self, url: str, sub_url: str, method: str,
+                         json: Dict = None) -> Tuple['requests.Response', Dict]:
+        start = perf_counter()
+        try:
+            if sub_url == AUTH_SUB_URL:
+                return self._call_with_retries(url, sub_url, method, json, token=None)
+
+            token = self.tokens.get()
+            r, response_json = self._call_with_retries(url, sub_url, method, json, token)
+            if r.status_code == 401:  # token expired, refresh it once
+                r, response_json = self._call_with_retries(url, sub_url, method, json, self.tokens.refresh(token))
+            return r, response_json
+        finally:
+            OFFERS_MS_REQUEST_SECONDS.observe(perf_counter() - start, sub_url, method)
+
+    def _call_with_retries(self, url: str, sub_url: str, method: str, json: Dict,
+                           token: str) -> Tuple['requests.Response', Dict]:
+        import requests
+        post = method == 'POST'
+        headers = {'Bearer': token}
+        limiter = self.limiters[sub_url]
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                if post:
+                    r = self.session.post(url, headers=headers, json=json, timeout=self.timeout)
+                else:
+                    r = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                OFFERS_MS_ERRORS.inc(sub_url, method, 'timeout' if isinstance(e, requests.Timeout) else 'connection')
+                if OffersConnector._retry_error(post, OffersConnector._connect_error(e), attempt, self.retries):
+                    OffersConnector._backoff(attempt)
+                    attempt += 1
+                    continue
+                raise OffersConnector.ERequestException(url=sub_url, original_exception=e)
+            except Exception as e:
+                OFFERS_MS_ERRORS.inc(sub_url, method, 'request')
+                raise OffersConnector.ERequestException(url=sub_url, original_exception=e)
+
+            retry_after = OffersConnector._throttle(limiter, sub_url, method, r)
+            if OffersConnector._retry_response(post, r.status_code, attempt, self.retries):
+                if retry_after is None:
+                    OffersConnector._backoff(attempt)
+                attempt += 1
+                continue
+            return r, OffersConnector._parse_response(url, sub_url, method, r, retry_after)
+
+    # Helpers shared with AsyncOffersConnector, they decide everything but I/O.
+
+    @staticmethod
+    def _allow(breaker: CircuitBreaker, sub_url: str, method: str) -> None:
+        """ Raise ECircuitOpen if circuit breaker doesn't let the call through. """
+        if not breaker.allow():
+            OFFERS_MS_ERRORS.inc(sub_url, method, 'circuit_open')
+            raise OffersConnector.ECircuitOpen(url=sub_url)
+
+    @staticmethod
+    def _failed(r=None, error: Exception = None) -> bool:
+        """ Call failed for circuit breaker: it raised connection error or invalid JSON, or service returned 5xx
+        after retries. Other exceptions mean that service responded, e.g. 429 or unexpected auth response. """
+        if error is not None:
+            return isinstance(error, (OffersConnector.ERequestException, OffersConnector.EInvalidJSONResponse))
+        return r.status_code >= 500
+
+    @staticmethod
+    def _retry_error(post: bool, connect: bool, attempt: int, retries: int) -> bool:
+        """ Retry request which failed by connection error or timeout. POST is retried only if connection wasn't
+        established, otherwise request could be already sent and processed by service. """
+        return (not post or connect) and attempt < retries
+
+    @staticmethod
+    def _retry_response(post: bool, status_code: int, attempt: int, retries: int) -> bool:
+        """ Retry request answered by error status. POST is not retried on error response, because request could
+        be already processed by service. 429 means that request was refused without processing. """
+        return (not post or status_code == 429) and status_code in RETRY_STATUS_CODES and attempt < retries
+
+    @staticmethod
+    def _throttle(limiter: RateLimiter, sub_url: str, method: str, r) -> Optional[float]:
+        """ Count error response and slow down when service is overloaded, return its Retry-After. """
+        if r.status_code >= 400:
+            OFFERS_MS_ERRORS.inc(sub_url, method, 'http_{}'.format(r.status_code))
+        if r.status_code not in THROTTLE_STATUS_CODES:
+            return None
+        retry_after = parse_retry_after(r.headers.get('Retry-After'))
+        limiter.throttle(retry_after)  # the next acquire waits for Retry-After
+        return retry_after
+
+    @staticmethod
+    def _parse_response(url: str, sub_url: str, method: str, r, retry_after: Optional[float]) -> Dict:
+        """ JSON of final response, raise ETooManyRequests if service kept refusing request. """
+        if r.status_code == 429:
+            raise OffersConnector.ETooManyRequests(url=sub_url, retry_after=retry_after)
 
         try:
-            json = r.json()
+            return r.json()
         except Exception as e:
+            OFFERS_MS_ERRORS.inc(sub_url, method, 'invalid_json')
             raise OffersConnector.EInvalidJSONResponse(
                 url=url,
                 code=r.status_code,
@@ -153,10 +405,74 @@ class OffersConnector:
                 original_exception=e
             )
 
-        return r, json
+    @staticmethod
+    def _token_response(r, json: Dict) -> str:
+        if r.status_code != 201:
+            raise OffersConnector.EUnexpectedResponse(AUTH_URL, r.status_code, json)
+
+        if ACCESS_TOKEN not in json:
+            raise OffersConnector.ECannotParseToken(url=AUTH_URL, json=json)
+
+        return json[ACCESS_TOKEN]
+
+    @staticmethod
+    def _register_response(r, json: Dict) -> None:
+        if r.status_code == 201:
+            return
+
+        OffersConnector._invalid_response(sub_url=PRODUCT_REGISTER_SUB_URL, expected_codes=(400, 401), r=r,
+                                          json=json)
+
+    @staticmethod
+    def _offers_response(r, json: Dict) -> List[Dict]:
+        if r.status_code == 200:
+            return list(json)
+
+        OffersConnector._invalid_response(sub_url=PRODUCT_OFFERS_SUB_URL, expected_codes=(400, 401, 404), r=r,
+                                          json=json)
+
+    @staticmethod
+    def _make_limiters(rate_limits: Optional[Dict[str, float]],
+                       rate_limit_dir: Optional[str]) -> Dict[str, RateLimiter]:
+        return {
+            sub_url: RateLimiter(rate, path=RateLimiter.shared_path(rate_limit_dir, BASE_URL + sub_url)
+                                 if rate_limit_dir is not None else None)
+            for sub_url, rate in dict(RATE_LIMITS, **(rate_limits or {})).items()
+        }
+
+    @staticmethod
+    def _make_session(pool_size: int) -> 'requests.Session':
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        # Proxies and CA bundle are read from environment once here. Otherwise requests scans whole environment
+        # on each request, which costs more than the request itself on local network.
+        session.proxies = requests.utils.get_environ_proxies(BASE_URL)
+        session.verify = getenv('REQUESTS_CA_BUNDLE') or getenv('CURL_CA_BUNDLE') or True
+        session.trust_env = False
+        # retries are handled in _call, adapter only keeps pool of keep-alive connections
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def _connect_error(e: Exception) -> bool:
+        """ Request failed while connecting (timeout, refused, name resolution), so nothing was sent. """
+        import requests
+        from urllib3.exceptions import ConnectTimeoutError  # NewConnectionError is its descendant
+        if isinstance(e, requests.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], 'reason', None) if e.args else None  # adapter wraps urllib3 MaxRetryError
+        return isinstance(reason, ConnectTimeoutError)
+
+    @staticmethod
+    def _backoff(attempt: int) -> None:
+        """ Exponential backoff with full jitter. """
+        sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
 
     @staticmethod
-    def _invalid_response(sub_url: str, expected_codes: Tuple[int, ...], r: requests.Response, json: dict) -> None:
+    def _invalid_response(sub_url: str, expected_codes: Tuple[int, ...], r: 'requests.Response', json: dict) -> None:
         response_valid = (ERROR_MESSAGE in json) and (ERROR_CODE in json)
         if (r.status_code in expected_codes) and response_valid:
             raise OffersConnector.EExpectedErrorResponse.make_descendant(
@@ -0,0 +1,192 @@
+from flask_sqlalchemy import SQLAlchemy
+from os import getenv
+from sqlalchemy import insert, text
+from time import time
+from typing import Dict, Iterable, List, Optional
+
+from ms.dbModels import Offer, OfferChange, OfferSummary
+from ms.history import HistoryStore
+from ms.reconciliation import Reconciliation
+
+# number of rows written in one transaction
+WRITE_CHUNK_SIZE = int(getenv('WRITE_CHUNK_SIZE') or 1000)
+
+UPSERT_COLUMNS = ('prod_id', 'remote_id', 'price', 'items_in_stock')
+UPSERT_KEY = ('prod_id', 'remote_id')
+SUMMARY_COLUMNS = ('prod_id', 'best_price', 'offer_count', 'total_stock', 'last_synced')
+SUMMARY_KEY = ('prod_id',)
+CHANGE_INSERT = 'insert'
+CHANGE_UPDATE = 'update'
+CHANGE_DELETE = 'delete'
+CHANGE_LOG_LOCK = 0x6f666672  # PostgreSQL advisory lock serializing writers of change log
+UPSERT_INDEX = 'ix_offer_prod_id_remote_id'  # unique index which is conflict target of upsert
+
+
+class OffersWriter:
+    """ Bulk writer of Offer and OfferSummary rows. Rows are written by executemany and committed in chunks, each
+    chunk together with its OfferChange rows. """
+
+    @staticmethod
+    def write(db: SQLAlchemy, changes: Iterable[Reconciliation], chunk_size: int = WRITE_CHUNK_SIZE,
+              samples: Optional[Dict] = None) -> int:
+        """ Write reconciliations of several products, return number of written offer rows. Price history samples of
+        products are appended in transaction of their summaries, write which failed before leaves neither of them, so
+        repeated write doesn't duplicate history. """
+        upserts = []
+        deletes = []
+        summaries = []
+        for c in changes:
+            upserts.extend(c.inserts)
+            upserts.extend(c.updates)
+            deletes.extend(c.deletes)
+            if c.summary is not None:
+                summaries.append(c.summary)
+
+        # deletes first, duplicates of (prod_id, remote_id) must be removed before upsert
+        written = OffersWriter.delete(db, deletes, chunk_size) + OffersWriter.upsert(db, upserts, chunk_size)
+        OffersWriter.upsert_summaries(db, summaries, chunk_size, samples)
+        return written
+
+    @staticmethod
+    def create_index(db: SQLAlchemy) -> int:
+        """ Create unique index of upsert key if it doesn't exist, db.create_all() creates it with new table only.
+        Duplicated offers left by older versions are deleted first, the newest one of each key is kept. Return
+        number of deleted offers. """
+        deleted = db.session.execute(text(
+            'DELETE FROM offer WHERE id NOT IN (SELECT MAX(id) FROM offer GROUP BY prod_id, remote_id)')).rowcount
+        db.session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS {} ON offer (prod_id, remote_id)'.format(
+            UPSERT_INDEX)))
+        db.session.commit()
+        return deleted
+
+    @staticmethod
+    def upsert(db: SQLAlchemy, rows: List[Dict], chunk_size: int = WRITE_CHUNK_SIZE) -> int:
+        """ Insert or update offers keyed by (prod_id, remote_id). Rows with local id are logged as updates. """
+        if not rows:
+            return 0
+
+        stmt = OffersWriter._upsert_statement(db, Offer, UPSERT_KEY, ('price', 'items_in_stock'))
+        for chunk in OffersWriter._chunks(rows, chunk_size):
+            changed_at = time()
+            changes = [{'prod_id': row['prod_id'], 'remote_id': row['remote_id'],
+                        'change': CHANGE_UPDATE if 'id' in row else CHANGE_INSERT, 'price': row['price'],
+                        'items_in_stock': row['items_in_stock'], 'changed_at': changed_at} for row in chunk]
+            chunk = [{column: row[column] for column in UPSERT_COLUMNS} for row in chunk]
+            if stmt is not None:
+                db.session.execute(stmt, chunk)
+            else:
+                OffersWriter._upsert_fallback(db, chunk)
+            OffersWriter._log_changes(db, changes)
+            db.session.commit()
+        return len(rows)
+
+    @staticmethod
+    def upsert_summaries(db: SQLAlchemy, rows: List[Dict], chunk_size: int = WRITE_CHUNK_SIZE,
+                         samples: Optional[Dict] = None) -> int:
+        """ Replace summaries of products, rows are keyed by prod_id. Price history samples of products are
+        appended in the same transaction as their summaries. """
+        samples = dict(samples or {})
+        if not rows:
+            if samples:
+                HistoryStore.append(db, samples)
+                db.session.commit()
+            return 0
+
+        stmt = OffersWriter._upsert_statement(db, OfferSummary, SUMMARY_KEY, SUMMARY_COLUMNS[1:])
+        chunks = list(OffersWriter._chunks(rows, chunk_size))
+        for i, chunk in enumerate(chunks):
+            chunk = [{column: row.get(column) for column in SUMMARY_COLUMNS} for row in chunk]
+            chunk_samples = {row['prod_id']: samples.pop(row['prod_id']) for row in chunk if row['prod_id'] in samples}
+            if i == len(chunks) - 1:
+                chunk_samples.update(samples)  # products without summary
+            HistoryStore.append(db, chunk_samples)
+            if stmt is not None:
+                db.session.execute(stmt, chunk)
+            else:
+                for row in chunk:
+                    db.session.merge(OfferSummary(**row))
+            db.session.commit()
+        return len(rows)
+
+    @staticmethod
+    def delete(db: SQLAlchemy, ids: List[int], chunk_size: int = WRITE_CHUNK_SIZE) -> int:
+        for chunk in OffersWriter._chunks(ids, chunk_size):
+            changed_at = time()
+            changes = [{'prod_id': prod_id, 'remote_id': remote_id, 'change': CHANGE_DELETE, 'price': None,
+                        'items_in_stock': None, 'changed_at': changed_at}
+                       for prod_id, remote_id in db.session.query(Offer.prod_id, Offer.remote_id)
+                                                           .filter(Offer.id.in_(chunk))]
+            db.session.query(Offer).filter(Offer.id.in_(chunk)).delete(synchronize_session=False)
+            OffersWriter._log_changes(db, changes)
+            db.session.commit()
+        return len(ids)
+
+    @staticmethod
+    def delete_products(db: SQLAlchemy, prod_ids: Iterable[int]) -> int:
+        """ Delete all offers of products in current transaction, caller commits. Return number of deleted offers. """
+        prod_ids = list(prod_ids)
+        changed_at = time()
+        changes = [{'prod_id': prod_id, 'remote_id': remote_id, 'change': CHANGE_DELETE, 'price': None,
+                    'items_in_stock': None, 'changed_at': changed_at}
+                   for prod_id, remote_id in db.session.query(Offer.prod_id, Offer.remote_id)
+                                                       .filter(Offer.prod_id.in_(prod_ids))]
+        db.session.query(Offer).filter(Offer.prod_id.in_(prod_ids)).delete(synchronize_session=False)
+        OffersWriter._log_changes(db, changes)
+        return len(changes)
+
+    # PRIVATE METHODS
+
+    @staticmethod
+    def _log_changes(db: SQLAlchemy, changes: List[Dict]) -> None:
+        """ Append changes in current transaction. Sequence numbers must become visible in their order, otherwise
+        reader could move its cursor over a number of transaction not committed yet. SQLite serializes writers itself,
+        PostgreSQL writers of several sync workers are serialized by advisory lock held until commit. """
+        if not changes:
+            return
+        if db.session.get_bind().dialect.name == 'postgresql':
+            db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOG_LOCK})
+        db.session.execute(insert(OfferChange.__table__), changes)
+
+    @staticmethod
+    def _upsert_statement(db: SQLAlchemy, model, key: Iterable[str], update_columns: Iterable[str]):
+        """ INSERT ... ON CONFLICT DO UPDATE for dialects which support it, otherwise None. """
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            return None
+
+        stmt = insert(model.__table__)
+        return stmt.on_conflict_do_update(
+            index_elements=list(key),
+            set_={column: stmt.excluded[column] for column in update_columns}
+        )
+
+    @staticmethod
+    def _upsert_fallback(db: SQLAlchemy, rows: List[Dict]) -> None:
+        prod_ids = {row['prod_id'] for row in rows}
+        existing = {
+            (prod_id, remote_id): offer_id
+            for offer_id, prod_id, remote_id in db.session.query(Offer.id, Offer.prod_id, Offer.remote_id)
+                                                           .filter(Offer.prod_id.in_(prod_ids))
+        }
+
+        inserts = []
+        updates = []
+        for row in rows:
+            offer_id = existing.get((row['prod_id'], row['remote_id']))
+            if offer_id is None:
+                inserts.append(row)
+            else:
+                updates.append(dict(row, id=offer_id))
+
+        db.session.bulk_insert_mappings(Offer, inserts)
+        db.session.bulk_update_mappings(Offer, updates)
+
+    @staticmethod
+    def _chunks(items: list, size: int):
+        size = max(1, size)
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
@@ -0,0 +1,141 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from flask_sqlalchemy import SQLAlchemy
+from multiprocessing import Process
+from os import getenv
+from time import sleep, time
+from typing import List, Optional, Tuple
+
+from ms.consts import METRICS_SNAPSHOT_PREFIX
+from ms.dbModels import Product, RegistrationOutbox, Settings
+from ms.metrics import REGISTRY
+from ms.offersConnector import OffersConnector
+
+OUTBOX_BATCH_SIZE = int(getenv('OUTBOX_BATCH_SIZE') or 100)  # outbox rows processed in one transaction
+OUTBOX_CONCURRENCY = int(getenv('OUTBOX_CONCURRENCY') or 16)  # concurrent registrations to offers service
+OUTBOX_POLL_INTERVAL = float(getenv('OUTBOX_POLL_INTERVAL') or 1.)  # seconds
+OUTBOX_BACKOFF_BASE = 1.  # seconds
+OUTBOX_BACKOFF_MAX = 600.  # seconds
+OUTBOX_METRICS_INTERVAL = 30.  # how often are metrics of worker published for GET /metrics, seconds
+OUTBOX_ERROR_SLEEP = 5.  # seconds after failed batch, e.g. DB is unavailable
+# claimed rows aren't due for other workers meanwhile, rows of crashed worker are retried after it
+OUTBOX_CLAIM_TIMEOUT = float(getenv('OUTBOX_CLAIM_TIMEOUT') or 300.)
+
+
+class OutboxWorker:
+    """ Registers products from RegistrationOutbox to offers service. Registrations of the same product are
+    deduplicated, failed ones are retried with exponential backoff and refused ones (400) are dropped. Any number of
+    workers can run on one or more hosts, each claims due rows before it registers them. """
+
+    offersMS = None
+    db = None
+    process = None
+    batch_size = OUTBOX_BATCH_SIZE
+    concurrency = OUTBOX_CONCURRENCY
+
+    @staticmethod
+    def start(offers_ms: OffersConnector, db: SQLAlchemy):
+        """ Run outbox worker in child process. """
+        OutboxWorker.process = Process(target=OutboxWorker.run, args=(offers_ms, db))
+        OutboxWorker.process.start()
+
+    @staticmethod
+    def run(offers_ms: OffersConnector, db: SQLAlchemy):
+        """ Run outbox worker in this process. """
+        OutboxWorker.offersMS = offers_ms
+        OutboxWorker.db = db
+        REGISTRY.reset()
+        next_publish = 0.
+        with ThreadPoolExecutor(max_workers=OutboxWorker.concurrency) as executor:
+            while True:
+                try:
+                    if time() >= next_publish:
+                        OutboxWorker.publish_metrics()
+                        next_publish = time() + OUTBOX_METRICS_INTERVAL
+                    processed = OutboxWorker.drain(executor)
+                except Exception as e:
+                    # e.g. DB is unavailable, worker keeps running and claimed rows are retried after claim timeout
+                    current_app.logger.exception('Outbox batch failed: {}'.format(e))
+                    OutboxWorker.db.session.rollback()
+                    sleep(OUTBOX_ERROR_SLEEP)
+                    continue
+                if processed < OutboxWorker.batch_size:
+                    sleep(OUTBOX_POLL_INTERVAL)
+
+    @staticmethod
+    def publish_metrics():
+        OutboxWorker.db.session.merge(Settings(name=METRICS_SNAPSHOT_PREFIX + 'outbox', value=REGISTRY.snapshot()))
+        OutboxWorker.db.session.commit()
+
+    @staticmethod
+    def drain(executor: ThreadPoolExecutor) -> int:
+        """ Process one batch of due outbox rows, return number of processed rows. """
+        session = OutboxWorker.db.session
+        now = time()
+        entries = OutboxWorker.claim(now)
+        if not entries:
+            return 0
+
+        prod_ids = {entry.prod_id for entry in entries}
+        products = [(p.id, p.name, p.description) for p in Product.query.filter(Product.id.in_(prod_ids))]
+        errors = dict(zip([p[0] for p in products], executor.map(OutboxWorker.register, products)))
+
+        for entry in entries:
+            if entry.prod_id not in errors:  # product was deleted before registration
+                session.delete(entry)
+                continue
+
+            error = errors[entry.prod_id]
+            if error is None:
+                session.delete(entry)
+            elif isinstance(error, OffersConnector.EBadRequest):
+                current_app.logger.error('Registration of product {} refused: {}'.format(entry.prod_id, error.msg))
+                session.delete(entry)
+            else:
+                entry.attempts += 1
+                entry.next_attempt_at = now + OutboxWorker.backoff(entry.attempts)
+                entry.last_error = str(getattr(error, 'msg', error))
+        session.commit()
+
+        registered = sum(1 for error in errors.values() if error is None)
+        if registered:
+            current_app.logger.info('{} products registered in offers ms.'.format(registered))
+        return len(entries)
+
+    @staticmethod
+    def claim(now: float) -> List[RegistrationOutbox]:
+        """ Claim due rows of one batch of products and commit, so no other worker registers the same products
+        meanwhile. Rows are claimed by conditional update, row already claimed by another worker isn't due anymore
+        and stays with it. Claimed rows are marked by unique next attempt time. """
+        session = OutboxWorker.db.session
+        prod_ids = [prod_id for prod_id, in session.query(RegistrationOutbox.prod_id)
+                    .filter(RegistrationOutbox.next_attempt_at <= now)
+                    .order_by(RegistrationOutbox.id)
+                    .limit(OutboxWorker.batch_size)]
+        if not prod_ids:
+            session.commit()
+            return []
+
+        claimed_until = now + OUTBOX_CLAIM_TIMEOUT + random.random()
+        session.query(RegistrationOutbox) \
+            .filter(RegistrationOutbox.prod_id.in_(set(prod_ids)), RegistrationOutbox.next_attempt_at <= now) \
+            .update({RegistrationOutbox.next_attempt_at: claimed_until}, synchronize_session=False)
+        session.commit()
+        return session.query(RegistrationOutbox) \
+            .filter(RegistrationOutbox.prod_id.in_(set(prod_ids)),
+                    RegistrationOutbox.next_attempt_at == claimed_until) \
+            .order_by(RegistrationOutbox.id) \
+            .all()
+
+    @staticmethod
+    def register(product: Tuple[int, str, str]) -> Optional[Exception]:
+        try:
+            OutboxWorker.offersMS.product_register(*product)
+        except Exception as e:
+            return e
+        return None
+
+    @staticmethod
+    def backoff(attempts: int) -> float:
+        return random.uniform(0.5, 1.) * min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** attempts)
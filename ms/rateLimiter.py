@@ -0,0 +1,156 @@
+import hashlib
+import os
+import struct
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from time import sleep, time
+from typing import List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows, state is kept in process
+    fcntl = None
+
+RATE_DECREASE = 0.5  # rate is multiplied by it when service refuses requests for load
+RATE_RECOVERY = 0.02  # rate grows by this fraction of max rate per second until it reaches max rate again
+RATE_MIN = 0.01  # fraction of max rate, rate never decreases below it
+RATE_BURST = 1.  # seconds of requests at max rate which can be sent at once
+DECREASE_INTERVAL = 1.  # refusals of requests sent concurrently decrease rate only once per this time, seconds
+RETRY_AFTER_MAX = 300.  # seconds, longer Retry-After is capped
+
+# tokens, updated_at, rate, blocked_until, decreased_at
+STATE = struct.Struct('<5d')
+
+
+class RateLimiter:
+    """ Token bucket with adaptive rate. Rate starts at max rate, is halved when service refuses requests for load
+    (429, 503) and grows linearly back (AIMD), so it settles near the highest rate service sustains. Retry-After
+    blocks all requests until it passes. State is kept in file locked by flock, so it is shared by all processes
+    using the same path, or in memory if path is None or the file can't be opened and locked. """
+
+    def __init__(self, rate: float, burst: float = None, path: Optional[str] = None):
+        self.max_rate = rate
+        self.burst = burst if burst is not None else max(1., rate * RATE_BURST)
+        self.min_rate = rate * RATE_MIN
+        self.increase = rate * RATE_RECOVERY
+        self.path = path if fcntl is not None else None
+        self.state = None  # state in memory if path is None
+        self.lock = Lock()
+
+    @staticmethod
+    def shared_path(directory: str, name: str) -> str:
+        """ Path of state file shared by limiters of the same name in all processes. """
+        return os.path.join(directory, 'ms-rate-{}'.format(hashlib.sha1(name.encode()).hexdigest()[:16]))
+
+    def acquire(self) -> float:
+        """ Block until request can be sent, return waited seconds. Max rate 0 means no limit, only Retry-After
+        is respected. """
+        waited = 0.
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return waited
+            sleep(wait)
+            waited += wait
+
+    def reserve(self) -> float:
+        """ Take token and return 0 if request can be sent now, otherwise return seconds to wait before next try.
+        Non-blocking variant of acquire() for event loops. """
+        with self._locked() as state:
+            now = time()
+            self._refill(state, now)
+            tokens, _, rate, blocked_until, _ = state
+            if now < blocked_until:
+                return blocked_until - now
+            if self.max_rate <= 0:
+                return 0.
+            if tokens >= 1.:
+                state[0] -= 1.
+                return 0.
+            return (1. - tokens) / rate
+
+    def throttle(self, retry_after: Optional[float] = None) -> None:
+        """ Service refused request for load. Decrease rate and block requests for retry_after seconds. """
+        with self._locked() as state:
+            now = time()
+            self._refill(state, now)
+            if now - state[4] >= DECREASE_INTERVAL:
+                state[2] = max(self.min_rate, state[2] * RATE_DECREASE)
+                state[4] = now
+            state[0] = min(state[0], 0.)
+            if retry_after:
+                state[3] = max(state[3], now + min(retry_after, RETRY_AFTER_MAX))
+
+    def rate(self) -> float:
+        """ Current allowed rate in requests per second. """
+        with self._locked() as state:
+            self._refill(state, time())
+            return state[2]
+
+    # PRIVATE METHODS
+
+    def _initial_state(self) -> List[float]:
+        return [self.burst, time(), self.max_rate, 0., 0.]
+
+    def _refill(self, state: List[float], now: float) -> None:
+        tokens, updated_at, rate, blocked_until, decreased_at = state
+        elapsed = max(0., now - updated_at)
+        if now >= blocked_until:
+            rate = min(self.max_rate, rate + self.increase * elapsed)
+            tokens = min(self.burst, tokens + rate * elapsed)
+        state[:] = tokens, now, rate, blocked_until, decreased_at
+
+    @contextmanager
+    def _locked(self):
+        with self.lock:
+            if self.path is None:
+                if self.state is None:
+                    self.state = self._initial_state()
+                yield self.state
+                return
+
+            fd = self._open()
+            if fd is None:  # request isn't failed by broken shared state, limits are kept in process instead
+                if self.state is None:
+                    self.state = self._initial_state()
+                yield self.state
+                return
+
+            try:
+                data = os.pread(fd, STATE.size, 0)
+                state = list(STATE.unpack(data)) if len(data) == STATE.size else self._initial_state()
+                state[2] = min(state[2], self.max_rate)  # max rate could be lowered since state was stored
+                yield state
+                os.pwrite(fd, STATE.pack(*state), 0)
+            finally:
+                os.close(fd)
+
+    def _open(self) -> Optional[int]:
+        """ Descriptor of locked state file, None if it can't be opened or locked. File is opened on each use, lock
+        of descriptor inherited by fork wouldn't exclude parent and child. """
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Seconds from Retry-After header, which is either number of seconds or HTTP date. None if missing or
+    invalid. """
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
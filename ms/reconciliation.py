@@ -0,0 +1,73 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+PRICE = 'price'
+ITEMS_IN_STOCK = 'items_in_stock'
+ID = 'id'
+INTEGER_MAX = 2 ** 31 - 1  # Integer column of PostgreSQL is 32 bit
+
+# (id, remote_id, price, items_in_stock) of offer stored in local DB
+LocalOffer = Tuple[int, int, int, int]
+
+
+class Reconciliation(NamedTuple):
+    """ Changes needed to get local offers of product in sync with remote offers. """
+    inserts: List[Dict]  # mappings of new Offer rows
+    updates: List[Dict]  # mappings of changed Offer rows, including local id
+    deletes: List[int]  # local ids of offers which aren't offered anymore
+    summary: Optional[Dict] = None  # mapping of OfferSummary row of product after the changes
+
+    def __bool__(self):
+        """ True if offers changed. """
+        return bool(self.inserts or self.updates or self.deletes)
+
+
+def offer_validation(offer: dict) -> bool:
+    """ Offer has id, price and stock which are integers storable in DB Integer column, price and stock aren't
+    negative. """
+    if not isinstance(offer, dict) or PRICE not in offer or ITEMS_IN_STOCK not in offer or ID not in offer:
+        return False
+    return all(type(offer[key]) is int and 0 <= offer[key] <= INTEGER_MAX for key in (ID, PRICE, ITEMS_IN_STOCK))
+
+
+def reconcile(prod_id: int, local_offers: Iterable[LocalOffer], remote_offers: Iterable[Dict]) -> Reconciliation:
+    """ Compare local and remote offers of one product in single O(n+m) pass. Offers are keyed by
+    (prod_id, remote_id); invalid and duplicated remote offers are skipped, duplicated local offers are deleted. """
+    inserts = []
+    updates = []
+    deletes = []
+
+    local = {}
+    for local_offer in local_offers:
+        remote_id = local_offer[1]
+        if remote_id in local:
+            deletes.append(local_offer[0])  # duplicate stored before offers had unique key
+        else:
+            local[remote_id] = local_offer
+
+    seen = set()
+    best_price = None
+    total_stock = 0
+    for offer in remote_offers:
+        if not offer_validation(offer):
+            continue
+        remote_id = offer[ID]
+        if remote_id in seen:
+            continue
+        seen.add(remote_id)
+
+        price = offer[PRICE]
+        items_in_stock = offer[ITEMS_IN_STOCK]
+        best_price = price if best_price is None or price < best_price else best_price
+        total_stock += items_in_stock
+        local_offer = local.pop(remote_id, None)
+        if local_offer is None:
+            inserts.append({'prod_id': prod_id, 'remote_id': remote_id, PRICE: price, ITEMS_IN_STOCK: items_in_stock})
+        elif local_offer[2] != price or local_offer[3] != items_in_stock:
+            updates.append({'id': local_offer[0], 'prod_id': prod_id, 'remote_id': remote_id, PRICE: price,
+                            ITEMS_IN_STOCK: items_in_stock})
+
+    # offers which were not returned by offers service anymore
+    deletes.extend(local_offer[0] for local_offer in local.values())
+
+    summary = {'prod_id': prod_id, 'best_price': best_price, 'offer_count': len(seen), 'total_stock': total_stock}
+    return Reconciliation(inserts, updates, deletes, summary)
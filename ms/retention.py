@@ -0,0 +1,129 @@
+from flask_sqlalchemy import SQLAlchemy
+from os import getenv
+from sqlalchemy import func, or_, select, text
+from time import perf_counter, sleep, time
+from typing import Callable, List, Optional
+
+from ms.consts import CHANGES_PRUNED
+from ms.dbModels import Product, Offer, OfferChange, OfferSummary, PriceHistoryChunk, Settings
+from ms.offersWriter import OffersWriter
+
+# policies, 0 = keep forever
+RETENTION_CHANGES_DAYS = float(getenv('RETENTION_CHANGES_DAYS') or 7.)  # age of offer changes in change feed
+RETENTION_HISTORY_DAYS = float(getenv('RETENTION_HISTORY_DAYS') or 0.)  # age of price history chunks
+# primary key range deleted in one short transaction, API and sync writers get the lock between batches
+RETENTION_BATCH_SIZE = int(getenv('RETENTION_BATCH_SIZE') or 1000)
+RETENTION_PAUSE = float(getenv('RETENTION_PAUSE') or 0.01)  # seconds after each batch which deleted rows
+DAY = 24 * 3600.
+
+
+class Retention:
+    """ Removes rows which are no longer needed: offers, summaries and price history of deleted products (left by
+    sync which wrote them after product was deleted, or by older versions without cascade), price history and offer
+    changes older than policy. Offers table itself keeps current offers only, sync deletes offers which vanished
+    remotely. Rows are deleted by ranges of primary key, each range in own transaction, so table is never locked
+    for long and compaction can run next to API and sync workers. """
+
+    @staticmethod
+    def compact(db: SQLAlchemy, changes_days: float = RETENTION_CHANGES_DAYS,
+                history_days: float = RETENTION_HISTORY_DAYS, batch_size: int = RETENTION_BATCH_SIZE,
+                pause: float = RETENTION_PAUSE, now: float = None) -> dict:
+        """ Apply all policies, return deleted rows of each table and reclaimed bytes (None if database size is
+        unknown). Free space is reused by database, file shrinks only after vacuum(). """
+        start = perf_counter()
+        now = time() if now is None else now
+        used_before = Retention.used_bytes(db)
+        orphan_history = ~PriceHistoryChunk.prod_id.in_(select(Product.id))
+        report = {
+            'offers': Retention._sweep(
+                db, Offer.id, ~Offer.prod_id.in_(select(Product.id)), batch_size, pause,
+                delete=lambda ids: OffersWriter.delete(db, ids)),  # logged, so readers of change feed drop them
+            'offer_summaries': Retention._sweep(
+                db, OfferSummary.prod_id, ~OfferSummary.prod_id.in_(select(Product.id)), batch_size, pause),
+            'price_history': Retention._sweep(
+                db, PriceHistoryChunk.id,
+                or_(orphan_history, PriceHistoryChunk.end_ts < now - history_days * DAY) if history_days > 0
+                else orphan_history,
+                batch_size, pause),
+            'offer_changes': Retention.prune_changes(db, now - changes_days * DAY, batch_size, pause)
+            if changes_days > 0 else 0,
+        }
+        used_after = Retention.used_bytes(db)
+        report['rows'] = sum(report.values())
+        report['reclaimed_bytes'] = used_before - used_after if used_before is not None else None
+        report['seconds'] = perf_counter() - start
+        return report
+
+    @staticmethod
+    def prune_changes(db: SQLAlchemy, before: float, batch_size: int = RETENTION_BATCH_SIZE,
+                      pause: float = RETENTION_PAUSE) -> int:
+        """ Delete the oldest offer changes up to the first change made at or after `before`, log stays contiguous.
+        Seq of the newest deleted change is stored before deletion, readers whose cursor is older get 410 Gone. """
+        first_kept = db.session.query(OfferChange.seq).filter(OfferChange.changed_at >= before) \
+            .order_by(OfferChange.seq).limit(1).scalar()  # scan stops at the first recent change
+        pruned = first_kept - 1 if first_kept is not None else db.session.query(func.max(OfferChange.seq)).scalar()
+        watermark = db.session.get(Settings, CHANGES_PRUNED)
+        if pruned is not None and (watermark is None or int(watermark.value) < pruned):
+            db.session.merge(Settings(name=CHANGES_PRUNED, value=str(pruned)))
+        db.session.commit()
+        if pruned is None:
+            return 0
+
+        # changes written after the watermark was stored are above it, so they are kept
+        return Retention._sweep(db, OfferChange.seq, OfferChange.seq <= pruned, batch_size, pause)
+
+    @staticmethod
+    def used_bytes(db: SQLAlchemy) -> Optional[int]:
+        """ Bytes used by data of database, free pages of SQLite are not counted. """
+        if db.session.get_bind().dialect.name == 'sqlite':
+            free = db.session.execute(text('PRAGMA freelist_count')).scalar()
+            return Retention.database_bytes(db) - free * db.session.execute(text('PRAGMA page_size')).scalar()
+        return Retention.database_bytes(db)
+
+    @staticmethod
+    def database_bytes(db: SQLAlchemy) -> Optional[int]:
+        """ Size of database on disk, None if it is unknown for the dialect. """
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            pages = db.session.execute(text('PRAGMA page_count')).scalar()
+            return pages * db.session.execute(text('PRAGMA page_size')).scalar()
+        if dialect == 'postgresql':
+            return db.session.execute(text('SELECT pg_database_size(current_database())')).scalar()
+        return None
+
+    @staticmethod
+    def vacuum(db: SQLAlchemy) -> None:
+        """ Return free space to file system (SQLite) or make dead rows reusable (PostgreSQL). SQLite VACUUM
+        rewrites whole file and blocks writers meanwhile, run it in maintenance window. """
+        db.session.commit()
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql('VACUUM')
+
+    # PRIVATE METHODS
+
+    @staticmethod
+    def _sweep(db: SQLAlchemy, pk, condition, batch_size: int, pause: float,
+               delete: Callable[[List[int]], None] = None) -> int:
+        """ Delete rows matching condition range by range of integer primary key, return number of deleted rows. """
+        model = pk.class_
+        low, high = db.session.query(func.min(pk), func.max(pk)).one()
+        db.session.commit()
+        if low is None:
+            return 0
+
+        deleted = 0
+        batch_size = max(1, batch_size)
+        for start in range(low, high + 1, batch_size):
+            ids = [row_id for row_id, in db.session.query(pk).filter(pk >= start, pk < start + batch_size, condition)]
+            if not ids:
+                db.session.commit()  # ends read transaction
+                continue
+            if delete is not None:
+                delete(ids)
+            else:
+                db.session.query(model).filter(pk.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(ids)
+            if pause > 0:
+                sleep(pause)
+        return deleted
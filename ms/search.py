@@ -0,0 +1,100 @@
+import re
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import or_, text
+from typing import Iterable, List, Tuple
+
+from ms.dbModels import Product
+
+FTS_TABLE = 'product_fts'
+PG_INDEX = 'ix_product_fts'
+PG_DOCUMENT = "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(description, ''))"
+NAME_WEIGHT = 4.  # match in name ranks higher than match in description
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class ProductSearch:
+    """ Full-text index of product name and description. SQLite uses FTS5 table maintained by Core on each change of
+    product, PostgreSQL uses GIN index of tsvector maintained by DB itself. Other databases fall back to LIKE scan.
+    Every word of query is matched as prefix, results are ranked by relevance. """
+
+    @staticmethod
+    def create_index(db: SQLAlchemy) -> None:
+        """ Create index if it doesn't exist and add products which are not indexed yet. """
+        dialect = ProductSearch._dialect(db)
+        if dialect == 'sqlite':
+            db.session.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(name, description, "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3')".format(FTS_TABLE)))
+            db.session.execute(text(
+                'INSERT INTO {0} (rowid, name, description) SELECT id, name, description FROM product '
+                'WHERE id NOT IN (SELECT rowid FROM {0})'.format(FTS_TABLE)))
+        elif dialect == 'postgresql':
+            db.session.execute(text('CREATE INDEX IF NOT EXISTS {} ON product USING GIN (({}))'.format(
+                PG_INDEX, PG_DOCUMENT)))
+        db.session.commit()
+
+    @staticmethod
+    def drop_index(db: SQLAlchemy) -> None:
+        """ FTS5 table isn't part of models, so it isn't dropped by db.drop_all(). """
+        if ProductSearch._dialect(db) == 'sqlite':
+            db.session.execute(text('DROP TABLE IF EXISTS {}'.format(FTS_TABLE)))
+            db.session.commit()
+
+    @staticmethod
+    def index(db: SQLAlchemy, products: Iterable[Tuple[int, str, str]]) -> None:
+        """ Index new or changed products in current transaction, caller commits. """
+        products = list(products)
+        if not products or ProductSearch._dialect(db) != 'sqlite':
+            return
+        ProductSearch.remove(db, [prod_id for prod_id, _, _ in products])
+        db.session.execute(
+            text('INSERT INTO {} (rowid, name, description) VALUES (:id, :name, :description)'.format(FTS_TABLE)),
+            [{'id': prod_id, 'name': name, 'description': description} for prod_id, name, description in products])
+
+    @staticmethod
+    def remove(db: SQLAlchemy, prod_ids: Iterable[int]) -> None:
+        """ Remove products from index in current transaction, caller commits. """
+        prod_ids = list(prod_ids)
+        if not prod_ids or ProductSearch._dialect(db) != 'sqlite':
+            return
+        db.session.execute(text('DELETE FROM {} WHERE rowid = :id'.format(FTS_TABLE)),
+                           [{'id': prod_id} for prod_id in prod_ids])
+
+    @staticmethod
+    def search(db: SQLAlchemy, query: str, limit: int, offset: int = 0) -> List[dict]:
+        """ Products matching all words of query as prefixes, the most relevant first. """
+        tokens = [token.lower() for token in TOKEN_RE.findall(query)]
+        if not tokens:
+            return []
+
+        dialect = ProductSearch._dialect(db)
+        if dialect == 'sqlite':
+            # bm25 is lower for better match
+            rows = db.session.execute(text(
+                'SELECT p.id, p.name, p.description, bm25({0}, :name_weight, 1.0) AS score '
+                'FROM {0} JOIN product p ON p.id = {0}.rowid WHERE {0} MATCH :match '
+                'ORDER BY score, p.id LIMIT :limit OFFSET :offset'.format(FTS_TABLE)),
+                {'match': ' '.join('"{}"*'.format(token) for token in tokens), 'name_weight': NAME_WEIGHT,
+                 'limit': limit, 'offset': offset})
+            return [{'id': i, 'name': n, 'description': d, 'rank': -r} for i, n, d, r in rows]
+
+        if dialect == 'postgresql':
+            rows = db.session.execute(text(
+                "SELECT id, name, description, ts_rank({0}, to_tsquery('simple', :match)) AS score FROM product "
+                "WHERE {0} @@ to_tsquery('simple', :match) ORDER BY score DESC, id "
+                "LIMIT :limit OFFSET :offset".format(PG_DOCUMENT)),
+                {'match': ' & '.join('{}:*'.format(token) for token in tokens), 'limit': limit, 'offset': offset})
+            return [{'id': i, 'name': n, 'description': d, 'rank': r} for i, n, d, r in rows]
+
+        q = db.session.query(Product.id, Product.name, Product.description)
+        for token in tokens:
+            pattern = '%{}%'.format(token.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+            q = q.filter(or_(Product.name.ilike(pattern, escape='\\'), Product.description.ilike(pattern, escape='\\')))
+        rows = q.order_by(Product.id).limit(limit).offset(offset)
+        return [{'id': i, 'name': n, 'description': d, 'rank': 0.} for i, n, d in rows]
+
+    # PRIVATE METHODS
+
+    @staticmethod
+    def _dialect(db: SQLAlchemy) -> str:
+        return db.session.get_bind().dialect.name
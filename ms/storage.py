@@ -0,0 +1,47 @@
+from os import getenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# SQLite
+SQLITE_JOURNAL_MODE = getenv('SQLITE_JOURNAL_MODE') or 'WAL'  # readers don't block writer and vice versa
+SQLITE_SYNCHRONOUS = getenv('SQLITE_SYNCHRONOUS') or 'NORMAL'  # in WAL mode commit survives crash of process
+SQLITE_BUSY_TIMEOUT = float(getenv('SQLITE_BUSY_TIMEOUT') or 30.)  # seconds writer waits for lock of other writer
+
+# PostgreSQL and other databases with connection pool
+DB_POOL_SIZE = int(getenv('DB_POOL_SIZE') or 10)
+DB_MAX_OVERFLOW = int(getenv('DB_MAX_OVERFLOW') or 20)
+DB_POOL_TIMEOUT = float(getenv('DB_POOL_TIMEOUT') or 10.)  # seconds to wait for free connection
+DB_POOL_RECYCLE = int(getenv('DB_POOL_RECYCLE') or 1800)  # seconds, older connections are reopened
+
+
+def engine_options(uri: str) -> dict:
+    """ SQLALCHEMY_ENGINE_OPTIONS for database URI. """
+    if uri.startswith('sqlite'):
+        return {'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT}}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': True  # connection closed by server or proxy is replaced instead of failing request
+    }
+
+
+def configure_sqlite() -> None:
+    """ Set pragmas of each new SQLite connection of all engines. Safe to call repeatedly. """
+    if not event.contains(Engine, 'connect', _set_sqlite_pragmas):
+        event.listen(Engine, 'connect', _set_sqlite_pragmas)
+
+
+# PRIVATE METHODS
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if type(dbapi_connection).__module__ != 'sqlite3':
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode={}'.format(SQLITE_JOURNAL_MODE))
+        cursor.execute('PRAGMA synchronous={}'.format(SQLITE_SYNCHRONOUS))
+        cursor.execute('PRAGMA busy_timeout={}'.format(int(SQLITE_BUSY_TIMEOUT * 1000)))
+    finally:
+        cursor.close()
@@ -0,0 +1,107 @@
+import math
+import os
+import socket
+import uuid
+from flask_sqlalchemy import SQLAlchemy
+from os import getenv
+from sqlalchemy import or_
+from typing import Optional, Set
+
+from ms.dbModels import SyncLease, SyncWorker
+
+# products are split to buckets by Product.id % SYNC_BUCKETS, more buckets than workers allow even split
+SYNC_BUCKETS = int(getenv('SYNC_BUCKETS') or 64)
+# lease of dead worker is taken over after this time, seconds
+SYNC_LEASE_TTL = float(getenv('SYNC_LEASE_TTL') or 30.)
+
+
+class SyncLeases:
+    """ Splits products between sync workers running on one or more hosts. Each worker holds leases of its fair share
+    (ceil(buckets / live workers)) of buckets and renews them by heartbeat. Buckets are claimed by conditional update,
+    so two workers never own the same bucket, and buckets of worker which stopped heartbeating are taken over when
+    its leases expire. """
+
+    def __init__(self, db: SQLAlchemy, buckets: int = SYNC_BUCKETS, ttl: float = SYNC_LEASE_TTL,
+                 owner: Optional[str] = None):
+        self.db = db
+        self.buckets = max(1, buckets)
+        self.ttl = ttl
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.owned = set()
+
+    def rebalance(self, now: float) -> Set[int]:
+        """ Heartbeat, renew own leases, release buckets over fair share and claim free or expired ones. Return owned
+        buckets. """
+        session = self.db.session
+        self._ensure_buckets()
+
+        session.merge(SyncWorker(id=self.owner, heartbeat=now))
+        session.query(SyncWorker).filter(SyncWorker.heartbeat < now - self.ttl).delete(synchronize_session=False)
+        live = session.query(SyncWorker).count()
+        fair_share = math.ceil(self.buckets / max(1, live))
+
+        self._renew(now)
+        owned = sorted(self._owned_buckets(now))
+        if len(owned) > fair_share:
+            extra = owned[fair_share:]
+            session.query(SyncLease) \
+                .filter(SyncLease.bucket.in_(extra), SyncLease.owner == self.owner) \
+                .update({SyncLease.owner: None, SyncLease.expires_at: 0.}, synchronize_session=False)
+            owned = owned[:fair_share]
+        elif len(owned) < fair_share:
+            free = [bucket for bucket, in session.query(SyncLease.bucket)
+                    .filter(or_(SyncLease.owner.is_(None), SyncLease.expires_at < now), SyncLease.bucket < self.buckets)
+                    .order_by(SyncLease.bucket)]
+            for bucket in free:
+                if len(owned) >= fair_share:
+                    break
+                # another worker may claim the same bucket concurrently, only one update matches
+                claimed = session.query(SyncLease) \
+                    .filter(SyncLease.bucket == bucket, or_(SyncLease.owner.is_(None), SyncLease.expires_at < now)) \
+                    .update({SyncLease.owner: self.owner, SyncLease.expires_at: now + self.ttl},
+                            synchronize_session=False)
+                if claimed:
+                    owned.append(bucket)
+        session.commit()
+
+        self.owned = set(owned)
+        return self.owned
+
+    def renew(self, now: float) -> Set[int]:
+        """ Extend own leases without rebalancing, called during long sync cycles. """
+        self.db.session.merge(SyncWorker(id=self.owner, heartbeat=now))
+        self._renew(now)
+        self.owned = self._owned_buckets(now)
+        self.db.session.commit()
+        return self.owned
+
+    def release(self) -> None:
+        """ Give up all leases, so other workers take them over without waiting for expiration. """
+        session = self.db.session
+        session.query(SyncLease).filter(SyncLease.owner == self.owner) \
+            .update({SyncLease.owner: None, SyncLease.expires_at: 0.}, synchronize_session=False)
+        session.query(SyncWorker).filter(SyncWorker.id == self.owner).delete(synchronize_session=False)
+        session.commit()
+        self.owned = set()
+
+    # PRIVATE METHODS
+
+    def _ensure_buckets(self) -> None:
+        existing = {bucket for bucket, in self.db.session.query(SyncLease.bucket)}
+        missing = [SyncLease(bucket=bucket, owner=None, expires_at=0.) for bucket in range(self.buckets)
+                   if bucket not in existing]
+        if missing:
+            self.db.session.add_all(missing)
+            try:
+                self.db.session.commit()
+            except Exception:  # created concurrently by another worker
+                self.db.session.rollback()
+
+    def _renew(self, now: float) -> None:
+        self.db.session.query(SyncLease) \
+            .filter(SyncLease.owner == self.owner, SyncLease.expires_at >= now) \
+            .update({SyncLease.expires_at: now + self.ttl}, synchronize_session=False)
+
+    def _owned_buckets(self, now: float) -> Set[int]:
+        return {bucket for bucket, in self.db.session.query(SyncLease.bucket)
+                .filter(SyncLease.owner == self.owner, SyncLease.expires_at >= now, SyncLease.bucket < self.buckets)}
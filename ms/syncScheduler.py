@@ -0,0 +1,111 @@
+import heapq
+import random
+from os import getenv
+from typing import Dict, Iterable, List, Optional
+
+# polling interval of product adapts between min and max interval
+SYNC_MIN_INTERVAL = float(getenv('SYNC_MIN_INTERVAL') or 60.)
+SYNC_MAX_INTERVAL = float(getenv('SYNC_MAX_INTERVAL') or 3600.)
+SYNC_BACKOFF = float(getenv('SYNC_BACKOFF') or 2.)
+# first retry of product whose sync failed, doubled with each next failure up to max interval
+SYNC_RETRY_INTERVAL = float(getenv('SYNC_RETRY_INTERVAL') or 10.)
+JITTER = 0.1  # spreads products with the same interval in time
+
+
+class SyncScheduler:
+    """ Priority queue of products ordered by time of next sync. Interval of product is divided by backoff when
+    its offers changed and multiplied by backoff when they didn't. Failed product is retried with exponential
+    backoff without changing its interval. """
+
+    def __init__(self, min_interval: float = SYNC_MIN_INTERVAL, max_interval: float = SYNC_MAX_INTERVAL,
+                 backoff: float = SYNC_BACKOFF, retry_interval: float = SYNC_RETRY_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = max(1., backoff)
+        self.retry_interval = retry_interval
+        self.queue = []  # heap of (due, prod_id), entries not matching self.due are stale
+        self.due = {}  # prod_id -> due time, None while product is being synced
+        self.intervals = {}  # prod_id -> current interval
+        self.failures = {}  # prod_id -> number of consecutive failed syncs
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, prod_id: int, now: float) -> None:
+        """ New products are due immediately. """
+        if prod_id in self.intervals:
+            return
+        self.intervals[prod_id] = self.min_interval
+        self._push(prod_id, now)
+
+    def remove(self, prod_id: int) -> None:
+        self.intervals.pop(prod_id, None)
+        self.due.pop(prod_id, None)
+        self.failures.pop(prod_id, None)
+
+    def set_products(self, prod_ids: Iterable[int], now: float) -> None:
+        """ Add new products and remove products which don't exist anymore. """
+        prod_ids = set(prod_ids)
+        for prod_id in [prod_id for prod_id in self.intervals if prod_id not in prod_ids]:
+            self.remove(prod_id)
+        for prod_id in prod_ids:
+            self.add(prod_id, now)
+
+    def pop_due(self, now: float, limit: Optional[int] = None) -> List[int]:
+        """ Return products which are due, in order of due time. They are rescheduled by reschedule(). """
+        ret = []
+        while self.queue and self.queue[0][0] <= now and (limit is None or len(ret) < limit):
+            due, prod_id = heapq.heappop(self.queue)
+            if self.due.get(prod_id) != due:
+                continue  # stale entry of removed or rescheduled product
+            self.due[prod_id] = None
+            ret.append(prod_id)
+        return ret
+
+    def reschedule(self, prod_id: int, changed: bool, now: float) -> None:
+        interval = self.intervals.get(prod_id)
+        if interval is None:
+            return  # product was removed during sync
+
+        if changed:
+            interval = max(self.min_interval, interval / self.backoff)
+        else:
+            interval = min(self.max_interval, interval * self.backoff)
+        self.intervals[prod_id] = interval
+        self.failures.pop(prod_id, None)
+        self._push(prod_id, now + interval * random.uniform(1. - JITTER, 1. + JITTER))
+
+    def fail(self, prod_id: int, now: float) -> None:
+        """ Sync of product failed, retry it later. """
+        if prod_id not in self.intervals:
+            return  # product was removed during sync
+
+        failures = self.failures[prod_id] = self.failures.get(prod_id, 0) + 1
+        delay = min(self.max_interval, self.retry_interval * 2 ** min(failures - 1, 32))
+        self._push(prod_id, now + delay * random.uniform(1. - JITTER, 1. + JITTER))
+
+    def next_due(self) -> Optional[float]:
+        while self.queue and self.due.get(self.queue[0][1]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+        return self.queue[0][0] if self.queue else None
+
+    def stats(self, now: float) -> Dict:
+        intervals = list(self.intervals.values())
+        queued = [due for due in self.due.values() if due is not None]
+        return {
+            'products': len(intervals),
+            'queue_depth': len(queued),
+            'in_progress': len(intervals) - len(queued),
+            'due': sum(1 for due in queued if due <= now),
+            'failing': len(self.failures),
+            'next_due_in': max(0., min(queued) - now) if queued else None,
+            'min_interval': min(intervals) if intervals else None,
+            'mean_interval': sum(intervals) / len(intervals) if intervals else None,
+            'max_interval': max(intervals) if intervals else None
+        }
+
+    # PRIVATE METHODS
+
+    def _push(self, prod_id: int, due: float) -> None:
+        self.due[prod_id] = due
+        heapq.heappush(self.queue, (due, prod_id))
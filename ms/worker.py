@@ -0,0 +1,44 @@
+# Entry point of ms-worker script, runs sync and outbox workers of app configured by env variables:
+#
+#   $ ms-worker
+import signal
+import sys
+
+from ms import create_app, db, token_store
+from ms.offersConnector import OffersConnector
+
+
+def main():
+    """ Start sync worker and outbox worker in child processes and wait for them. """
+    from ms.OffersSyncJob import OffersSyncJob, SYNC_ASYNC, SYNC_ASYNC_CONCURRENCY
+    from ms.outboxWorker import OutboxWorker
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        # children must not share connections of parent, each opens own ones
+        db.session.remove()
+        db.engine.dispose()
+        # HTTP session is created lazily in each child, so connector can be shared by fork
+        offers_ms = OffersConnector(*token_store(app))
+        if SYNC_ASYNC:
+            from ms.asyncOffersConnector import AsyncOffersConnector
+            OffersSyncJob.start(AsyncOffersConnector(*token_store(app)), db, SYNC_ASYNC_CONCURRENCY)
+        else:
+            OffersSyncJob.start(offers_ms, db)
+        OutboxWorker.start(offers_ms, db)
+        app.logger.info('sync and outbox workers started.')
+
+    processes = (OffersSyncJob.process, OutboxWorker.process)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()  # sync worker releases its leases on SIGTERM
+
+
+if __name__ == '__main__':
+    main()
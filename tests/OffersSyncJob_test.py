@@ -0,0 +1,263 @@
+# tests of OffersSyncJob.py
+import asyncio
+import threading
+import time
+
+import pytest
+
+from ms import db
+from ms.dbModels import Product, Offer, OfferSummary, PriceHistoryChunk
+from ms.OffersSyncJob import OffersSyncJob
+
+
+class FakeOffersConnector:
+    """ Returns one offer per product and records the highest number of concurrent calls. """
+
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def product_offers(self, prod_id: int):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return [{'id': prod_id * 10, 'price': prod_id, 'items_in_stock': 1}]
+
+
+class FakeAsyncOffersConnector(FakeOffersConnector):
+    """ Coroutine variant, all calls run in one event loop. """
+
+    async def product_offers(self, prod_id: int):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        if prod_id == 13:
+            raise ValueError('failed')
+        return [{'id': prod_id * 10, 'price': prod_id, 'items_in_stock': 1}]
+
+
+def setup_job(monkeypatch, concurrency: int, batch_size: int = 100,
+              connector: FakeOffersConnector = None) -> FakeOffersConnector:
+    """ Configure job, monkeypatch restores it after test. """
+    connector = connector or FakeOffersConnector()
+    monkeypatch.setattr(OffersSyncJob, 'offersMS', connector)
+    monkeypatch.setattr(OffersSyncJob, 'db', db)
+    monkeypatch.setattr(OffersSyncJob, 'concurrency', concurrency)
+    monkeypatch.setattr(OffersSyncJob, 'batch_size', batch_size)
+    monkeypatch.setattr(OffersSyncJob, 'executor', None)  # pool of concurrency
+    return connector
+
+
+def test_fetch_offers_keeps_order(app, monkeypatch):
+    connector = setup_job(monkeypatch, concurrency=4)
+    prod_ids = list(range(1, 50))
+
+    fetched = [prod_id for prod_id, _ in OffersSyncJob.fetch_offers(prod_ids)]
+
+    assert fetched == prod_ids
+    assert 1 < connector.max_running <= 4
+
+
+def test_fetch_offers_reuses_threads(app, monkeypatch):
+    setup_job(monkeypatch, concurrency=2)
+
+    assert len(list(OffersSyncJob.fetch_offers([1, 2, 3]))) == 3
+    executor = OffersSyncJob.executor
+    assert len(list(OffersSyncJob.fetch_offers([4, 5]))) == 2
+    assert OffersSyncJob.executor is executor
+
+
+def test_fetch_offers_async(app, monkeypatch):
+    connector = setup_job(monkeypatch, concurrency=100, connector=FakeAsyncOffersConnector())
+    prod_ids = list(range(1, 300))
+    errors = {}
+
+    fetched = list(OffersSyncJob.fetch_offers(prod_ids, errors))
+
+    assert [prod_id for prod_id, _ in fetched] == prod_ids
+    assert fetched[0][1] == [{'id': 10, 'price': 1, 'items_in_stock': 1}]
+    assert dict(fetched)[13] is None and isinstance(errors[13], ValueError)
+    assert connector.max_running == 100  # whole window is in flight in one thread
+
+
+def test_sync_cycle_stores_offers(app, monkeypatch):
+    setup_job(monkeypatch, concurrency=8, batch_size=1)
+    with app.app_context():
+        db.session.add_all([Product(name='p{}'.format(i), description='d') for i in range(10)])
+        db.session.commit()
+
+        OffersSyncJob.sync_cycle()
+        OffersSyncJob.sync_cycle()  # second cycle must not duplicate offers
+
+        assert Offer.query.count() == Product.query.count()
+        summaries = OfferSummary.query.all()
+        assert len(summaries) == Product.query.count()
+        assert all(s.offer_count == 1 and s.best_price == s.prod_id and s.last_synced for s in summaries)
+
+
+def test_sync_cycle_skips_failing_product(app, monkeypatch):
+    from ms.offersConnector import OffersConnector
+    from ms.syncScheduler import SyncScheduler
+
+    monkeypatch.setattr(OffersSyncJob, 'scheduler', SyncScheduler())
+    connector = setup_job(monkeypatch, concurrency=4)
+    product_offers = connector.product_offers
+
+    def failing(prod_id):
+        if prod_id == failed:
+            raise OffersConnector.ERequestException('/products/{prod_id}/offers', ConnectionError('reset'))
+        return product_offers(prod_id)
+    connector.product_offers = failing
+
+    with app.app_context():
+        db.session.add_all([Product(name='p{}'.format(i), description='d') for i in range(5)])
+        db.session.commit()
+        prod_ids = [p.id for p in Product.query.order_by(Product.id)]
+        failed = prod_ids[2]
+        OffersSyncJob.scheduler.set_products(prod_ids, time.time())
+        OffersSyncJob.scheduler.pop_due(time.time())
+
+        OffersSyncJob.sync_cycle(prod_ids)
+
+        assert sorted(prod_id for prod_id, in db.session.query(Offer.prod_id)) == \
+            [prod_id for prod_id in prod_ids if prod_id != failed]
+        assert OffersSyncJob.scheduler.failures == {failed: 1}
+
+
+def test_sync_cycle_reports_completed_products(app, monkeypatch):
+    setup_job(monkeypatch, concurrency=4, batch_size=2)
+    write = OffersSyncJob.write
+    written = []
+
+    def failing_write(batch, samples, fetched_at=None):
+        if written:
+            raise RuntimeError('DB is unavailable')
+        written.append(sorted(samples))
+        write(batch, samples, fetched_at)
+    monkeypatch.setattr(OffersSyncJob, 'write', staticmethod(failing_write))
+
+    with app.app_context():
+        db.session.add_all([Product(name='p{}'.format(i), description='d') for i in range(5)])
+        db.session.commit()
+        prod_ids = [p.id for p in Product.query.order_by(Product.id)]
+        done = set()
+
+        with pytest.raises(RuntimeError):
+            OffersSyncJob.sync_cycle(prod_ids, done)
+        assert done == set(prod_ids[:2])  # only products of the written batch aren't failed by worker
+
+
+def test_sync_cycle_skips_malformed_product(app, monkeypatch):
+    from ms.syncScheduler import SyncScheduler
+
+    monkeypatch.setattr(OffersSyncJob, 'scheduler', SyncScheduler())
+    connector = setup_job(monkeypatch, concurrency=4)
+    product_offers = connector.product_offers
+    connector.product_offers = lambda prod_id: 42 if prod_id == malformed else product_offers(prod_id)
+
+    with app.app_context():
+        prod_ids = [p.id for p in Product.query.order_by(Product.id)]
+        malformed = prod_ids[0]
+        OffersSyncJob.scheduler.set_products(prod_ids, time.time())
+        OffersSyncJob.scheduler.pop_due(time.time())
+
+        OffersSyncJob.sync_cycle(prod_ids)
+
+        assert sorted(prod_id for prod_id, in db.session.query(Offer.prod_id)) == prod_ids[1:]
+        assert OffersSyncJob.scheduler.failures == {malformed: 1}
+
+
+def test_sync_cycle_drops_invalid_offers(app, monkeypatch):
+    connector = setup_job(monkeypatch, concurrency=4)
+    product_offers = connector.product_offers
+
+    def with_invalid(prod_id):
+        return product_offers(prod_id) + [{'id': 1, 'price': None, 'items_in_stock': 1},
+                                          {'id': 2, 'price': 2 ** 40, 'items_in_stock': 1}]
+    connector.product_offers = with_invalid
+
+    with app.app_context():
+        db.session.add_all([Product(name='p{}'.format(i), description='d') for i in range(3)])
+        db.session.commit()
+
+        OffersSyncJob.sync_cycle()
+
+        assert Offer.query.count() == Product.query.count()
+        assert OfferSummary.query.count() == Product.query.count()
+        assert PriceHistoryChunk.query.count() == Product.query.count()
+
+
+def test_sync_cycle_skips_pushed_product(app, monkeypatch):
+    from ms.core import Core
+    from ms.syncScheduler import SyncScheduler
+
+    monkeypatch.setattr(OffersSyncJob, 'scheduler', SyncScheduler(min_interval=60., max_interval=3600.))
+    monkeypatch.setattr(OffersSyncJob, 'started_at', time.time())
+    monkeypatch.setattr(OffersSyncJob, 'synced_at', {})
+    setup_job(monkeypatch, concurrency=4)
+    with app.app_context():
+        prod_ids = [p.id for p in Product.query.order_by(Product.id)]
+        OffersSyncJob.scheduler.set_products(prod_ids, time.time())
+        OffersSyncJob.sync_cycle(OffersSyncJob.scheduler.pop_due(time.time()))
+        Core.ingest_offers([(prod_ids[0], [{'id': 1, 'price': 5, 'items_in_stock': 3}], None)])
+
+        OffersSyncJob.sync_cycle(prod_ids)
+
+        pushed = Offer.query.filter_by(prod_id=prod_ids[0]).one()
+        assert (pushed.remote_id, pushed.price) == (1, 5)  # not overwritten by poll
+        assert OffersSyncJob.scheduler.intervals[prod_ids[0]] == 120.  # polling backs off
+
+
+def test_sync_cycle_keeps_offers_pushed_during_fetch(app, monkeypatch):
+    from ms.core import Core
+
+    monkeypatch.setattr(OffersSyncJob, 'started_at', time.time())
+    monkeypatch.setattr(OffersSyncJob, 'synced_at', {})
+    setup_job(monkeypatch, concurrency=4)
+    fetch_offers = OffersSyncJob.fetch_offers
+
+    def push_during_fetch(prod_ids, errors=None):
+        for prod_id, offers in fetch_offers(prod_ids, errors):
+            if prod_id == prod_ids[0]:
+                Core.ingest_offers([(prod_id, [{'id': 1, 'price': 5, 'items_in_stock': 3}], None)])
+            yield prod_id, offers
+
+    monkeypatch.setattr(OffersSyncJob, 'fetch_offers', staticmethod(push_during_fetch))
+    with app.app_context():
+        prod_ids = [p.id for p in Product.query.order_by(Product.id)]
+
+        OffersSyncJob.sync_cycle(prod_ids)
+
+        pushed = Offer.query.filter_by(prod_id=prod_ids[0]).one()
+        assert (pushed.remote_id, pushed.price) == (1, 5)
+        assert prod_ids[0] not in OffersSyncJob.synced_at
+        assert Offer.query.filter_by(prod_id=prod_ids[1]).count() > 0
+
+
+def test_fetch_offers_renews_leases_while_waiting(app, monkeypatch):
+    class FakeLeases:
+        ttl = 0.06
+        buckets = 1
+        owned = {0}
+        owner = 'worker'
+
+        def __init__(self):
+            self.renewed = []
+
+        def renew(self, now: float):
+            self.renewed.append(now)
+
+    leases = FakeLeases()
+    monkeypatch.setattr(OffersSyncJob, 'leases', leases)
+    monkeypatch.setattr(OffersSyncJob, 'leases_renew_at', 0.)
+    setup_job(monkeypatch, concurrency=1, connector=FakeOffersConnector(delay=0.2))
+
+    with app.app_context():
+        assert len(list(OffersSyncJob.fetch_offers([1]))) == 1
+    assert len(leases.renewed) >= 3  # every third of TTL during one slow request
@@ -0,0 +1,85 @@
+# tests of asgi.py
+import asyncio
+import json
+from time import monotonic
+
+import pytest
+
+from ms import db
+from ms.asgi import ASGIApp, create_asgi_app
+from ms.dbModels import Product
+from ms.offersWriter import OffersWriter
+
+
+@pytest.fixture
+def asgi_app(tmp_path):
+    # reads run in threads, in-memory DB would be separate in each of them
+    asgi_app = create_asgi_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'db')})
+    with asgi_app.flask_app.app_context():
+        db.create_all()
+        db.session.add(Product(name='changed', description='description'))
+        db.session.commit()
+    return asgi_app
+
+
+def request(app: ASGIApp, path: str, query_string: bytes = b'', method: str = 'GET'):
+    """ Run request, return status and body. """
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string}
+    return app(scope, receive, send), sent
+
+
+def response(sent: list):
+    return sent[0]['status'], sent[1]['body']
+
+
+def test_offer_changes(asgi_app):
+    with asgi_app.flask_app.app_context():
+        prod_id = Product.query.one().id
+        OffersWriter.upsert(db, [{'prod_id': prod_id, 'remote_id': 1, 'price': 1, 'items_in_stock': 1}])
+
+    call, sent = request(asgi_app, '/offers/changes', b'since=0&wait=1')
+    asyncio.run(call)
+    status, body = response(sent)
+    assert status == 200
+    assert [change['remote_id'] for change in json.loads(body)['changes']] == [1]
+
+
+def test_offer_changes_bad_request(asgi_app):
+    for query_string in (b'since=x', b'since=-1', b'since=1180591620717411303424', b'wait=nan', b'limit=0'):
+        call, sent = request(asgi_app, '/offers/changes', query_string)
+        asyncio.run(call)
+        assert response(sent) == (400, b'')
+
+
+def test_offer_changes_wait_in_event_loop(asgi_app):
+    async def scenario():
+        calls = [request(asgi_app, '/offers/changes', b'since=1000&wait=0.3') for _ in range(20)]
+        await asyncio.gather(*(call for call, _ in calls))
+        return [response(sent) for _, sent in calls]
+
+    start = monotonic()
+    responses = asyncio.run(scenario())
+    assert monotonic() - start < 2.  # waited concurrently, not one after another
+    assert {status for status, _ in responses} == {200}
+    assert json.loads(responses[0][1]) == {'changes': [], 'cursor': 1000, 'has_more': False}
+
+
+def test_other_requests_passed_to_flask_app(asgi_app):
+    passed = []
+
+    async def wsgi(scope, receive, send):
+        passed.append(scope['path'])
+
+    app = ASGIApp(asgi_app.flask_app, wsgi=wsgi)
+    for path, method in (('/products', 'GET'), ('/offers/changes', 'POST')):
+        call, _ = request(app, path, method=method)
+        asyncio.run(call)
+    assert passed == ['/products', '/offers/changes']
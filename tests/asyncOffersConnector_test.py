@@ -0,0 +1,187 @@
+# tests of asyncOffersConnector.py, tests against offers service need optional httpx
+import asyncio
+import importlib.util
+
+import pytest
+
+from ms import asyncOffersConnector
+from ms.asyncOffersConnector import AsyncOffersConnector, AsyncTokenManager
+from ms.offersConnector import OffersConnector, CircuitBreaker
+
+needs_httpx = pytest.mark.skipif(importlib.util.find_spec('httpx') is None, reason='needs optional httpx')
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, json, headers: dict = None):
+        self.status_code = status_code
+        self._json = json
+        self.text = str(json)
+        self.headers = headers or {}
+
+    def json(self):
+        if isinstance(self._json, Exception):
+            raise self._json
+        return self._json
+
+
+class FakeClient:
+    """ Answers requests by given responses (or raises given exceptions) in order and records them. """
+
+    def __init__(self, responses: list):
+        self.responses = iter(responses)
+        self.requests = []
+
+    async def get(self, url, headers=None):
+        self.requests.append(('GET', url, headers))
+        return self.respond()
+
+    async def post(self, url, headers=None, json=None):
+        self.requests.append(('POST', url, headers))
+        return self.respond()
+
+    def respond(self) -> FakeResponse:
+        r = next(self.responses)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    async def aclose(self):
+        pass
+
+
+def make_connector(store: dict, **kwargs) -> AsyncOffersConnector:
+    return AsyncOffersConnector(lambda: store.get('token'), lambda token: store.update(token=token),
+                                rate_limit_dir=None, **kwargs)
+
+
+def run_fake(monkeypatch, responses: list, scenario, store: dict = None, breaker: CircuitBreaker = None):
+    monkeypatch.setattr(asyncOffersConnector, 'BACKOFF_BASE', 0.)
+    client = FakeClient(responses)
+    offers = make_connector({'token': 'token'} if store is None else store, retries=2, client=client)
+    if breaker is not None:
+        offers.breaker = breaker
+    asyncio.run(scenario(offers))
+    return client
+
+
+def test_product_offers_retry(monkeypatch):
+    offer = {'id': 1, 'price': 1, 'items_in_stock': 1}
+
+    async def scenario(offers):
+        assert await offers.product_offers(1) == [offer]
+
+    client = run_fake(monkeypatch, [FakeResponse(503, {}), FakeResponse(429, {}, {'Retry-After': '0'}),
+                                    FakeResponse(200, [offer])], scenario)
+    assert len(client.requests) == 3
+
+
+def test_register_not_retried(monkeypatch):
+    async def scenario(offers):
+        with pytest.raises(OffersConnector.EUnexpectedResponse):
+            await offers.product_register(1, 'test', 'test description')
+        with pytest.raises(OffersConnector.EBadRequest):
+            await offers.product_register(1, 'test', 'test description')
+
+    client = run_fake(monkeypatch, [FakeResponse(503, {}), FakeResponse(400, {'code': 400, 'msq': 'registered'})],
+                      scenario)
+    assert len(client.requests) == 2
+
+
+@needs_httpx
+def test_register_retried_only_when_not_connected(monkeypatch):
+    import httpx
+
+    async def scenario(offers):
+        await offers.product_register(1, 'test', 'test description')
+        with pytest.raises(OffersConnector.ERequestException):
+            await offers.product_register(1, 'test', 'test description')  # request could be processed by service
+
+    client = run_fake(monkeypatch, [httpx.ConnectError('refused'), httpx.ConnectTimeout('timeout'),
+                                    FakeResponse(201, {}), httpx.ReadTimeout('timeout'), FakeResponse(201, {})],
+                      scenario)
+    assert len(client.requests) == 4
+
+
+def test_token_refresh_on_unauthorized(monkeypatch):
+    store = {'token': 'old'}
+
+    async def scenario(offers):
+        await offers.product_offers(1)
+
+    client = run_fake(monkeypatch, [FakeResponse(401, {}), FakeResponse(201, {'access_token': 'new'}),
+                                    FakeResponse(200, [])], scenario, store)
+    assert store['token'] == 'new'
+    assert client.requests[-1][2] == {'Bearer': 'new'}
+
+
+def test_invalid_json_and_circuit_breaker(monkeypatch):
+    async def scenario(offers):
+        with pytest.raises(OffersConnector.EInvalidJSONResponse):
+            await offers.product_offers(1)
+        assert offers.breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(OffersConnector.ECircuitOpen):
+            await offers.product_offers(1)
+
+    client = run_fake(monkeypatch, [FakeResponse(200, ValueError('not JSON'))], scenario,
+                      breaker=CircuitBreaker(threshold=1, cooldown=60.))
+    assert len(client.requests) == 1
+
+
+def test_token_manager_coalesces_refresh():
+    auths = []
+
+    async def auth():
+        auths.append(1)
+        await asyncio.sleep(0.01)
+        return 'token{}'.format(len(auths))
+
+    async def scenario():
+        manager = AsyncTokenManager(lambda: None, lambda token: None, auth)
+        assert set(await asyncio.gather(*(manager.get() for _ in range(16)))) == {'token1'}
+        assert await manager.refresh(stale='token1') == 'token2'
+
+    asyncio.run(scenario())
+    assert len(auths) == 2
+
+
+def test_token_manager_created_outside_event_loop():
+    async def auth():
+        return 'token'
+
+    manager = AsyncTokenManager(lambda: None, lambda token: None, auth)  # e.g. at import of module
+    assert asyncio.run(manager.get()) == 'token'
+
+
+@needs_httpx
+def test_register_and_offers(offers_service):
+    async def scenario():
+        offers = make_connector({})
+        try:
+            await offers.product_register(1005, 'test', 'test description')
+            assert isinstance(await offers.product_offers(1005), list)
+            with pytest.raises(OffersConnector.EBadRequest):
+                await offers.product_register(1005, 'test', 'test description')  # already registered
+        finally:
+            await offers.aclose()
+
+    asyncio.run(scenario())
+
+
+@needs_httpx
+def test_token_refresh_is_coalesced(offers_service):
+    async def scenario():
+        store = {}
+        offers = make_connector(store)
+        try:
+            await offers.product_register(1006, 'test', 'test description')
+            old_token = store['token']
+            offers_service.expire_tokens()
+            auths = offers_service.auths
+
+            await asyncio.gather(*(offers.product_offers(1006) for _ in range(16)))
+            assert offers_service.auths == auths + 1
+            assert store['token'] != old_token
+        finally:
+            await offers.aclose()
+
+    asyncio.run(scenario())
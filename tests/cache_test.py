@@ -0,0 +1,28 @@
+# tests of cache.py
+from ms import cache
+from ms.cache import LRUCache
+
+
+def test_lru_eviction():
+    c = LRUCache(maxsize=2, ttl=60.)
+    c.set(1, 'a')
+    c.set(2, 'b')
+    c.get(1)  # 2 is least recently used now
+    c.set(3, 'c')
+
+    assert c.get(1) == 'a'
+    assert c.get(2) is None
+    assert c.get(3) == 'c'
+
+
+def test_ttl(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(cache, 'monotonic', lambda: now[0])
+    c = LRUCache(maxsize=10, ttl=5.)
+    c.set(1, 'a')
+
+    now[0] = 104.
+    assert c.get(1) == 'a'
+    now[0] = 105.
+    assert c.get(1) is None
+    assert len(c) == 0
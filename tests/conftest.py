@@ -1,9 +1,33 @@
+import os
+import socket
+
+# Tests run against local fake offers service unless OffersMS_BaseUrl is defined. URL must be known before ms is
+# imported.
+FAKE_OFFERS_PORT = None
+if os.getenv('OffersMS_BaseUrl') is None:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        FAKE_OFFERS_PORT = s.getsockname()[1]
+    os.environ['OffersMS_BaseUrl'] = 'http://127.0.0.1:{}/api/v1'.format(FAKE_OFFERS_PORT)
+
 import pytest
 
 from ms import create_app
 from ms import init_all
 from ms import db
 from ms.dbModels import Product
+from ms.fakeOffersService import FakeOffersService
+
+
+@pytest.fixture(scope='session', autouse=True)
+def offers_service():
+    if FAKE_OFFERS_PORT is None:
+        yield None
+        return
+
+    service = FakeOffersService(port=FAKE_OFFERS_PORT).start()
+    yield service
+    service.stop()
 
 
 @pytest.fixture
@@ -17,7 +41,7 @@ def app():
                 Product(name='to_delete', description='product to delete.')
             )
         )
-        init_all(without_job=True)
+        init_all()
         db.session.commit()
 
     yield app
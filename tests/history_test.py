@@ -0,0 +1,74 @@
+# tests of history.py
+import numpy as np
+import pytest
+
+from ms import db
+from ms.dbModels import PriceHistoryChunk
+from ms.history import HistoryStore
+
+
+@pytest.fixture
+def samples(app, fixed_product_id):
+    rng = np.random.default_rng(0)
+    ts = np.arange(100, dtype=np.float64)
+    price = rng.integers(1, 1000, len(ts))
+    stock = rng.integers(0, 50, len(ts))
+    with app.app_context():
+        # several appends crossing chunk boundaries
+        for i in range(0, len(ts), 30):
+            HistoryStore.append(db, {fixed_product_id: [
+                (ts[j], j, price[j], stock[j]) for j in range(i, min(i + 30, len(ts)))
+            ]}, chunk_size=16)
+            db.session.commit()
+    return ts, price, stock
+
+
+def test_large_values_and_old_chunks(app, fixed_product_id):
+    import zlib
+    from ms.history import HEADER
+
+    with app.app_context():
+        HistoryStore.append(db, {fixed_product_id: [(1., 1, 2 ** 40, 1)]})
+        # chunk encoded before price and stock were 64 bit
+        blocks = [zlib.compress(np.asarray(values, dtype=dtype).tobytes()) for values, dtype in (
+            ([2.], '<f8'), ([1], '<i4'), ([1], '<i8'), ([7], '<i4'), ([3], '<i4'))]
+        db.session.add(PriceHistoryChunk(prod_id=fixed_product_id + 1, start_ts=2., end_ts=2., samples=1,
+                                         data=HEADER.pack(*map(len, blocks)) + b''.join(blocks)))
+        db.session.commit()
+
+        chunks = PriceHistoryChunk.query.order_by(PriceHistoryChunk.id).all()
+        assert [int(c[0]) for c in HistoryStore.decode(chunks[0], ('price', 'items_in_stock'))] == [2 ** 40, 1]
+        assert [int(c[0]) for c in HistoryStore.decode(chunks[1], ('price', 'items_in_stock'))] == [7, 3]
+
+
+def test_append(app, fixed_product_id, samples):
+    with app.app_context():
+        chunks = PriceHistoryChunk.query.filter_by(prod_id=fixed_product_id).all()
+        assert all(chunk.samples <= 16 for chunk in chunks)
+        assert sum(chunk.samples for chunk in chunks) == 100
+
+        ts, _, price, _ = HistoryStore.load(fixed_product_id, 10., 20.)
+        assert list(ts) == list(range(10, 20))
+        assert list(price) == list(samples[1][10:20])
+
+
+def test_aggregate(app, fixed_product_id, samples):
+    _, price, stock = samples
+    with app.app_context():
+        ret = HistoryStore.aggregate(fixed_product_id, 0., 100., percentiles=(50., 99.))
+
+    assert ret['count'] == 100
+    assert ret['price']['min'] == price.min()
+    assert ret['price']['mean'] == pytest.approx(price.mean())
+    assert ret['items_in_stock']['p99'] == pytest.approx(np.percentile(stock, 99))
+
+
+def test_aggregate_buckets(app, fixed_product_id, samples):
+    _, price, _ = samples
+    with app.app_context():
+        ret = HistoryStore.aggregate(fixed_product_id, 0., 100., bucket=25., percentiles=(50.,))
+
+    assert [w['count'] for w in ret['windows']] == [25] * 4
+    for i, window in enumerate(ret['windows']):
+        assert window['price']['max'] == price[i * 25:(i + 1) * 25].max()
+        assert window['price']['p50'] == pytest.approx(np.percentile(price[i * 25:(i + 1) * 25], 50))
@@ -4,7 +4,8 @@ from flask import g, session
 
 from ms.dbModels import Product
 
-from ms.consts import PRODUCT_NAME, PRODUCT_DESCRIPTION, HTTP_OK, HTTP_CREATED, HTTP_BAD_REQUEST, HTTP_NOT_FOUND
+from ms.consts import PRODUCT_NAME, PRODUCT_DESCRIPTION, HTTP_OK, HTTP_CREATED, HTTP_BAD_REQUEST, HTTP_NOT_FOUND, \
+    HTTP_NOT_MODIFIED
 
 
 def test_product_register_ok(client, app):
@@ -25,6 +26,57 @@ def test_product_read_ok(client, fixed_product_id):
     assert response.status_code == HTTP_OK
 
 
+def test_product_read_summary(client, app, fixed_product_id, to_delete_product_id):
+    from ms import db
+    from ms.core import Core
+    from ms.offersWriter import OffersWriter
+
+    assert client.get('/product/{}'.format(fixed_product_id)).get_json()['summary'] is None  # not synced yet
+    summary = {'best_price': 5, 'offer_count': 2, 'total_stock': 7, 'last_synced': 1.}
+    with app.app_context():
+        OffersWriter.upsert_summaries(db, [dict(summary, prod_id=fixed_product_id)])
+    Core.summary_cache.clear()  # summary written by sync is read after cache expires
+
+    assert client.get('/product/{}'.format(fixed_product_id)).get_json()['summary'] == summary
+    response = client.get('/products', query_string={'ids': '{},{}'.format(fixed_product_id, to_delete_product_id)})
+    assert [p['summary'] for p in response.get_json()] == [summary, None]
+
+
+def test_product_read_cached(client, app, fixed_product_id):
+    from ms import db
+    from sqlalchemy import event
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    client.get('/product/{}'.format(fixed_product_id))  # product and summary are read by one query
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            assert client.get('/product/{}'.format(fixed_product_id)).status_code == HTTP_OK
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+    assert statements == []
+
+
+def test_product_read_not_modified(client, fixed_product_id):
+    etag = client.get('/product/{}'.format(fixed_product_id)).headers['ETag']
+
+    response = client.get('/product/{}'.format(fixed_product_id), headers={'If-None-Match': etag})
+    assert response.status_code == HTTP_NOT_MODIFIED
+    assert response.data == b''
+
+
+def test_product_read_after_update(client, fixed_product_id):
+    client.get('/product/{}'.format(fixed_product_id))  # cache product
+    client.post('/product/{}'.format(fixed_product_id), json={PRODUCT_NAME: 'renamed', PRODUCT_DESCRIPTION: 'new'})
+
+    response = client.get('/product/{}'.format(fixed_product_id))
+    assert response.get_json()[PRODUCT_NAME] == 'renamed'
+
+
 def test_product_read_not_found(client):
     response = client.get('/product/{}'.format(9999))
     assert response.status_code == HTTP_NOT_FOUND
@@ -57,3 +109,402 @@ def test_product_delete(client, to_delete_product_id):
 def test_product_delete_not_found(client):
     response = client.delete('product/{}'.format(9999))
     assert response.status_code == HTTP_NOT_FOUND
+
+
+def test_sync_status_not_published(client):
+    response = client.get('/sync/status')
+    assert response.status_code == HTTP_NOT_FOUND
+
+
+def test_sync_status(client, app, monkeypatch):
+    from ms import db
+    from ms.OffersSyncJob import OffersSyncJob
+
+    monkeypatch.setattr(OffersSyncJob, 'db', db)
+    with app.app_context():
+        OffersSyncJob.publish_status(0.)
+
+    response = client.get('/sync/status')
+    assert response.status_code == HTTP_OK
+    assert 'queue_depth' in response.get_json()
+    assert response.get_json()['workers'][0]['worker'] == 'default'
+
+
+@pytest.fixture
+def product_with_offers(app, fixed_product_id):
+    from ms import db
+    from ms.offersWriter import OffersWriter
+
+    rows = [{'prod_id': fixed_product_id, 'remote_id': i, 'price': i % 4, 'items_in_stock': i} for i in range(10)]
+    with app.app_context():
+        OffersWriter.upsert(db, rows)
+    return fixed_product_id
+
+
+def test_offer_changes(client, product_with_offers):
+    changes = []
+    cursor = 0
+    while True:
+        response = client.get('/offers/changes', query_string={'since': cursor, 'limit': 4})
+        assert response.status_code == HTTP_OK
+        page = response.get_json()
+        changes.extend(page['changes'])
+        cursor = page['cursor']
+        if not page['has_more']:
+            break
+
+    assert [c['remote_id'] for c in changes] == list(range(10))
+    assert {c['change'] for c in changes} == {'insert'}
+    assert cursor == changes[-1]['seq']
+
+
+def test_product_delete_cascades(client, app, product_with_offers):
+    from ms.dbModels import Offer, OfferSummary
+
+    response = client.delete('product/{}'.format(product_with_offers))
+    assert response.status_code == HTTP_OK
+    with app.app_context():
+        assert Offer.query.filter_by(prod_id=product_with_offers).count() == 0
+        assert OfferSummary.query.filter_by(prod_id=product_with_offers).count() == 0
+    changes = client.get('/offers/changes', query_string={'limit': 100}).get_json()['changes']
+    assert [c['change'] for c in changes] == ['insert'] * 10 + ['delete'] * 10
+
+
+def test_offers_ingest(client, app, fixed_product_id, to_delete_product_id):
+    from ms.dbModels import Offer, OfferChange, OfferSummary, PriceHistoryChunk
+
+    offers = [{'id': 1, 'price': 10, 'items_in_stock': 2}, {'id': 2, 'price': 8, 'items_in_stock': 1}]
+    items = [
+        {'id': fixed_product_id, 'offers': offers, 'observed_at': 100.},
+        {'id': 9999, 'offers': offers},
+        {'id': to_delete_product_id, 'offers': [{'id': 1, 'price': 'free', 'items_in_stock': 1}]},
+        {'id': fixed_product_id, 'offers': []},
+    ]
+    response = client.post('/offers/ingest', json=items)
+    assert response.status_code == HTTP_OK
+    assert response.get_json() == [
+        {'id': fixed_product_id, 'status': HTTP_OK, 'changes': 2},
+        {'id': 9999, 'status': HTTP_NOT_FOUND},
+        {'id': to_delete_product_id, 'status': HTTP_BAD_REQUEST},
+        {'id': fixed_product_id, 'status': HTTP_BAD_REQUEST},  # duplicated in batch
+    ]
+    summary = client.get('/product/{}'.format(fixed_product_id)).get_json()['summary']
+    assert summary == {'best_price': 8, 'offer_count': 2, 'total_stock': 3, 'last_synced': 100.}
+
+    # the same push again is idempotent, older one is stale
+    response = client.post('/offers/ingest', json=items[:1])
+    assert response.get_json() == [{'id': fixed_product_id, 'status': HTTP_OK, 'changes': 0}]
+    response = client.post('/offers/ingest', json=[{'id': fixed_product_id, 'offers': [], 'observed_at': 50.}])
+    assert response.get_json() == [{'id': fixed_product_id, 'status': 409}]
+    with app.app_context():
+        assert Offer.query.filter_by(prod_id=fixed_product_id).count() == 2
+        assert OfferChange.query.count() == 2
+        assert PriceHistoryChunk.query.count() == 1
+
+    response = client.post('/offers/ingest', json=[{'id': fixed_product_id, 'offers': offers[1:]}])
+    assert response.get_json() == [{'id': fixed_product_id, 'status': HTTP_OK, 'changes': 1}]
+    with app.app_context():
+        assert OfferSummary.query.get(fixed_product_id).offer_count == 1
+
+
+def test_offers_ingest_bad_request(client):
+    assert client.post('/offers/ingest', json={'id': 1}).status_code == HTTP_BAD_REQUEST
+    assert client.post('/offers/ingest', json=[]).status_code == HTTP_BAD_REQUEST
+
+
+def test_offers_ingest_invalid_values(client, fixed_product_id, to_delete_product_id):
+    items = [
+        {'id': fixed_product_id, 'offers': [{'id': 1, 'price': 2 ** 31, 'items_in_stock': 1}]},
+        {'id': to_delete_product_id, 'offers': [], 'observed_at': True},
+        {'id': 2 ** 63, 'offers': []},
+    ]
+    response = client.post('/offers/ingest', json=items)
+    assert response.status_code == HTTP_OK
+    assert [item['status'] for item in response.get_json()] == [HTTP_BAD_REQUEST] * 3
+
+    response = client.post('/offers/ingest', content_type='application/json',
+                           data='[{{"id": {}, "offers": [], "observed_at": NaN}}]'.format(fixed_product_id))
+    assert response.get_json() == [{'id': fixed_product_id, 'status': HTTP_BAD_REQUEST}]
+
+
+def test_offers_ingest_failed_write_keeps_history(client, app, fixed_product_id, monkeypatch):
+    from ms.dbModels import PriceHistoryChunk
+    from ms.offersWriter import OffersWriter
+
+    items = [{'id': fixed_product_id, 'offers': [{'id': 1, 'price': 10, 'items_in_stock': 2}], 'observed_at': 100.}]
+    upsert_summaries = OffersWriter.upsert_summaries
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(OffersWriter, 'upsert_summaries', staticmethod(fail))
+    assert client.post('/offers/ingest', json=items).status_code == 500
+    monkeypatch.setattr(OffersWriter, 'upsert_summaries', staticmethod(upsert_summaries))
+    assert client.post('/offers/ingest', json=items).get_json()[0]['status'] == HTTP_OK
+    with app.app_context():
+        assert PriceHistoryChunk.query.one().samples == 1  # replay didn't duplicate history
+
+
+def test_offers_ingest_token(client, fixed_product_id, monkeypatch):
+    from ms import interface
+    monkeypatch.setattr(interface, 'INGEST_TOKEN', 'secret')
+    items = [{'id': fixed_product_id, 'offers': []}]
+
+    assert client.post('/offers/ingest', json=items).status_code == 401
+    response = client.post('/offers/ingest', json=items, headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == HTTP_OK
+
+
+def test_offer_changes_long_poll(client, product_with_offers):
+    from time import monotonic
+
+    cursor = client.get('/offers/changes').get_json()['cursor']
+    start = monotonic()
+    page = client.get('/offers/changes', query_string={'since': cursor, 'wait': 0.3}).get_json()
+    assert monotonic() - start >= 0.3
+    assert page == {'changes': [], 'cursor': cursor, 'has_more': False}
+
+
+def test_offer_changes_gone_after_retention(client, app, product_with_offers):
+    from ms import db
+    from ms.consts import HTTP_GONE
+    from ms.dbModels import OfferChange
+    from ms.retention import Retention
+
+    changes = client.get('/offers/changes').get_json()['changes']
+    with app.app_context():
+        OfferChange.query.filter(OfferChange.seq <= changes[4]['seq']).update({'changed_at': 1.})
+        db.session.commit()
+        assert Retention.prune_changes(db, before=2.) == 5
+
+    for since in (changes[0]['seq'], changes[3]['seq']):
+        assert client.get('/offers/changes', query_string={'since': since}).status_code == HTTP_GONE
+    page = client.get('/offers/changes', query_string={'since': changes[4]['seq']}).get_json()
+    assert page['changes'] == changes[5:]
+    assert client.get('/offers/changes').get_json()['changes'] == changes[5:]  # restart from the oldest kept
+
+
+@pytest.mark.parametrize('query', ({'since': -1}, {'since': 'x'}, {'since': 2 ** 70}, {'limit': 0}, {'wait': 31}))
+def test_offer_changes_bad_request(client, query):
+    assert client.get('/offers/changes', query_string=query).status_code == HTTP_BAD_REQUEST
+
+
+def test_product_offers_last_synced(client, app, product_with_offers):
+    from ms import db
+    from ms.offersWriter import OffersWriter
+
+    url = '/product/{}/offers'.format(product_with_offers)
+    assert client.get(url).get_json()['last_synced'] is None
+    with app.app_context():
+        OffersWriter.upsert_summaries(db, [{'prod_id': product_with_offers, 'best_price': 0, 'offer_count': 10,
+                                            'total_stock': 45, 'last_synced': 100.}])
+    assert client.get(url).get_json()['last_synced'] == 100.
+
+
+@pytest.mark.parametrize(('sort', 'order'), (('price', 'asc'), ('price', 'desc'), ('items_in_stock', 'desc')))
+def test_product_offers_pagination(client, product_with_offers, sort, order):
+    offers = []
+    cursor = None
+    while True:
+        query = {'sort': sort, 'order': order, 'limit': 3}
+        if cursor is not None:
+            query['cursor'] = cursor
+        response = client.get('/product/{}/offers'.format(product_with_offers), query_string=query)
+        assert response.status_code == HTTP_OK
+        page = response.get_json()
+        offers.extend(page['offers'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    assert len(offers) == 10
+    keys = [(offer[sort], offer['id']) for offer in offers]
+    assert keys == sorted(keys, reverse=(order == 'desc'))
+
+
+def test_product_offers_filter(client, product_with_offers):
+    response = client.get('/product/{}/offers'.format(product_with_offers),
+                          query_string={'min_stock': 5, 'max_price': 1})
+    offers = response.get_json()['offers']
+    assert offers and all(offer['items_in_stock'] >= 5 and offer['price'] <= 1 for offer in offers)
+
+
+@pytest.mark.parametrize('query', ({'sort': 'name'}, {'limit': 0}, {'limit': 'x'}, {'cursor': 'invalid'},
+                                   {'min_stock': 2 ** 70}, {'max_price': -2 ** 63 - 1}))
+def test_product_offers_bad_request(client, fixed_product_id, query):
+    response = client.get('/product/{}/offers'.format(fixed_product_id), query_string=query)
+    assert response.status_code == HTTP_BAD_REQUEST
+
+
+def test_product_offers_not_found(client):
+    response = client.get('/product/{}/offers'.format(9999))
+    assert response.status_code == HTTP_NOT_FOUND
+
+
+def test_products_register(client, app):
+    response = client.post('/products', json=[
+        {PRODUCT_NAME: 'batch 1', PRODUCT_DESCRIPTION: 'description'},
+        {PRODUCT_NAME: 'batch 2'},
+        {PRODUCT_NAME: 'batch 3', PRODUCT_DESCRIPTION: 'description'},
+        {PRODUCT_NAME: {'a': 1}, PRODUCT_DESCRIPTION: 'description'}
+    ])
+    assert response.status_code == HTTP_OK
+    assert [item['status'] for item in response.get_json()] == [HTTP_CREATED, HTTP_BAD_REQUEST, HTTP_CREATED,
+                                                               HTTP_BAD_REQUEST]
+
+    with app.app_context():
+        assert Product.query.filter(Product.name.like('batch %')).count() == 2
+
+
+@pytest.mark.parametrize('data', ({}, [], [{}] * 1001))
+def test_products_register_bad_request(client, data):
+    response = client.post('/products', json=data)
+    assert response.status_code == HTTP_BAD_REQUEST
+
+
+def test_products_read(client, fixed_product_id, to_delete_product_id):
+    response = client.get('/products', query_string={'ids': '{},9999,{}'.format(to_delete_product_id,
+                                                                               fixed_product_id)})
+    assert response.status_code == HTTP_OK
+    products = response.get_json()
+    assert [p['id'] for p in products] == [to_delete_product_id, 9999, fixed_product_id]
+    assert [p['status'] for p in products] == [HTTP_OK, HTTP_NOT_FOUND, HTTP_OK]
+    assert products[2][PRODUCT_NAME] == 'fixed'
+
+
+def test_products_read_bad_request(client):
+    response = client.get('/products', query_string={'ids': '1,x'})
+    assert response.status_code == HTTP_BAD_REQUEST
+
+
+def test_products_update(client, fixed_product_id):
+    response = client.put('/products', json=[
+        {'id': fixed_product_id, PRODUCT_NAME: 'renamed'},
+        {'id': 9999, PRODUCT_NAME: 'renamed'},
+        {'id': fixed_product_id},
+        {'id': fixed_product_id, PRODUCT_DESCRIPTION: 1},
+        {'id': True, PRODUCT_NAME: 'renamed'}
+    ])
+    assert response.status_code == HTTP_OK
+    assert [item['status'] for item in response.get_json()] == [HTTP_OK, HTTP_NOT_FOUND] + [HTTP_BAD_REQUEST] * 3
+    assert client.get('/product/{}'.format(fixed_product_id)).get_json()[PRODUCT_NAME] == 'renamed'
+
+
+def test_products_delete(client, to_delete_product_id):
+    response = client.delete('/products', json=[to_delete_product_id, 9999])
+    assert response.status_code == HTTP_OK
+    assert [item['status'] for item in response.get_json()] == [HTTP_OK, HTTP_NOT_FOUND]
+    assert client.get('/product/{}'.format(to_delete_product_id)).status_code == HTTP_NOT_FOUND
+
+
+def test_products_delete_bad_request(client, fixed_product_id):
+    response = client.delete('/products', json=[True])  # bool isn't id of product 1
+    assert response.status_code == HTTP_BAD_REQUEST
+    assert client.get('/product/{}'.format(fixed_product_id)).status_code == HTTP_OK
+
+
+def test_product_history(client, fixed_product_id):
+    response = client.get('/product/{}/history'.format(fixed_product_id), query_string={'from': 0, 'to': 100})
+    assert response.status_code == HTTP_OK
+    assert response.get_json()['count'] == 0
+
+
+@pytest.mark.parametrize('query', ({'from': 10, 'to': 0}, {'bucket': 0}, {'bucket': 'nan'}, {'bucket': 'inf'},
+                                   {'percentiles': '101'}, {'to': 'x'}))
+def test_product_history_bad_request(client, fixed_product_id, query):
+    response = client.get('/product/{}/history'.format(fixed_product_id), query_string=query)
+    assert response.status_code == HTTP_BAD_REQUEST
+
+
+def test_product_history_not_found(client):
+    response = client.get('/product/{}/history'.format(9999))
+    assert response.status_code == HTTP_NOT_FOUND
+
+
+def test_metrics(client, fixed_product_id):
+    client.get('/product/{}'.format(fixed_product_id))
+
+    response = client.get('/metrics')
+    assert response.status_code == HTTP_OK
+    assert response.content_type.startswith('text/plain')
+    text = response.get_data(as_text=True)
+    assert 'ms_http_request_duration_seconds_count{route="/product/<int:prod_id>",method="GET",status="200"}' in text
+    assert 'ms_db_query_duration_seconds_count{statement="SELECT"}' in text
+    assert 'ms_offers_ms_request_duration_seconds' in text
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_export(client, product_with_offers, to_delete_product_id, compress):
+    import gzip
+    import json
+
+    response = client.get('/export', query_string={'gzip': '1'} if compress else {})
+    assert response.status_code == HTTP_OK
+    assert response.mimetype == 'application/x-ndjson'
+
+    data = response.get_data()
+    if compress:
+        assert response.headers['Content-Encoding'] == 'gzip'
+        data = gzip.decompress(data)
+    products = [json.loads(line) for line in data.decode().splitlines()]
+
+    assert [p['id'] for p in products] == sorted([product_with_offers, to_delete_product_id])
+    offers = {p['id']: p['offers'] for p in products}
+    assert len(offers[product_with_offers]) == 10
+    assert offers[to_delete_product_id] == []
+
+
+def test_export_pages(app):
+    from ms import db
+    from ms.core import Core
+
+    with app.app_context():
+        db.session.add_all([Product(name='p', description='d') for _ in range(5)])
+        db.session.commit()
+        pages = list(Core.export_products(page_size=3))
+
+    assert [len(page) for page in pages] == [3, 3, 1]
+    ids = [p['id'] for page in pages for p in page]
+    assert ids == sorted(ids)
+
+
+def test_products_search(client):
+    client.post('/products', json=[
+        {PRODUCT_NAME: 'Red apple', PRODUCT_DESCRIPTION: 'sweet fruit'},
+        {PRODUCT_NAME: 'Apple juice', PRODUCT_DESCRIPTION: 'made of red apples'},
+        {PRODUCT_NAME: 'Banana', PRODUCT_DESCRIPTION: 'yellow fruit'}
+    ])
+
+    response = client.get('/products/search', query_string={'q': 'appl'})  # prefix match
+    assert response.status_code == HTTP_OK
+    names = [p['name'] for p in response.get_json()['products']]
+    assert sorted(names) == ['Apple juice', 'Red apple']
+
+    response = client.get('/products/search', query_string={'q': 'red fru'})  # all words must match
+    assert [p['name'] for p in response.get_json()['products']] == ['Red apple']
+    assert response.get_json()['products'][0]['summary'] is None  # not synced yet
+
+    response = client.get('/products/search', query_string={'q': 'fruit', 'limit': 1})
+    page = response.get_json()
+    assert len(page['products']) == 1 and page['next_offset'] == 1
+    response = client.get('/products/search', query_string={'q': 'fruit', 'limit': 1, 'offset': 1})
+    assert response.get_json()['next_offset'] is None
+
+
+def test_products_search_follows_changes(client, fixed_product_id, to_delete_product_id):
+    def found(q):
+        return [p['id'] for p in client.get('/products/search', query_string={'q': q}).get_json()['products']]
+
+    assert found('fixed') == [fixed_product_id]  # products existing before index was created
+    client.post('/product/{}'.format(fixed_product_id), json={PRODUCT_NAME: 'renamed', PRODUCT_DESCRIPTION: 'new'})
+    assert found('fixed') == []
+    assert found('renamed') == [fixed_product_id]
+
+    client.delete('/product/{}'.format(to_delete_product_id))
+    assert found('delete') == []
+
+
+@pytest.mark.parametrize('query', [{}, {'q': ' '}, {'q': 'a', 'limit': 0}, {'q': 'a', 'limit': 'x'}])
+def test_products_search_bad_request(client, query):
+    response = client.get('/products/search', query_string=query)
+    assert response.status_code == HTTP_BAD_REQUEST
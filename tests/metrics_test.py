@@ -0,0 +1,58 @@
+# tests of metrics.py
+import pytest
+
+from ms.metrics import Registry
+
+
+def test_histogram_render():
+    r = Registry()
+    h = r.histogram('latency_seconds', 'Latency.', ('route',), buckets=(0.1, 1.))
+    h.observe(0.05, '/a')
+    h.observe(0.5, '/a')
+    h.observe(5., '/a')
+
+    text = r.render()
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{route="/a",le="1"} 2' in text
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 3' in text
+    assert 'latency_seconds_count{route="/a"} 3' in text
+    assert 'latency_seconds_sum{route="/a"} 5.55' in text
+
+
+def test_snapshots_are_summed():
+    worker = Registry()
+    worker.counter('errors_total', 'Errors.', ('error',)).inc('timeout', amount=2)
+    api = Registry()
+    errors = api.counter('errors_total', 'Errors.', ('error',))
+    errors.inc('timeout')
+    errors.inc('connection')
+
+    text = api.render([worker.snapshot()])
+    assert 'errors_total{error="timeout"} 3' in text
+    assert 'errors_total{error="connection"} 1' in text
+
+
+def test_reset():
+    r = Registry()
+    c = r.counter('products_total', 'Products.')
+    c.inc()
+    r.reset()
+    assert r.render().splitlines() == ['# HELP products_total Products.', '# TYPE products_total counter']
+
+
+def test_db_query_timed_after_failed_query(monkeypatch):
+    from sqlalchemy import create_engine, text
+    from ms import metrics
+
+    histogram = Registry().histogram('query_seconds', 'Test.', ('statement',))
+    monkeypatch.setattr(metrics, 'DB_QUERY_SECONDS', histogram)
+    metrics.instrument_db()
+    engine = create_engine('sqlite://')
+    with engine.connect() as conn:
+        with pytest.raises(Exception):
+            conn.execute(text('SELECT * FROM missing'))
+        conn.execute(text('SELECT 1'))
+        assert 'ms_query_start' not in conn.info
+
+    assert sum(histogram.values[('SELECT',)][:-1]) == 1  # only the successful statement
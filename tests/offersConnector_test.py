@@ -1,12 +1,15 @@
 # tests of offersConnector.py
 import pytest
+import requests
+import time
+from time import monotonic
 
 from ms import offersConnector
 
 
 def test_simple():
     try:
-        offers = offersConnector.OffersConnector()
+        offers = offersConnector.OffersConnector(lambda: None, lambda token: None)
         offers.auth()
     except Exception as e:
         assert True, 'Authentication raised exception: \n{}'.format(e)
@@ -40,3 +43,172 @@ def test_simple():
         assert True, 'During getting offers of not existed product wasn''t raised NotFound Exception.'
         break
 
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, json, headers: dict = None):
+        self.status_code = status_code
+        self._json = json
+        self.text = str(json)
+        self.headers = headers or {}
+
+    def json(self):
+        return self._json
+
+
+def make_connector(monkeypatch, responses: list) -> offersConnector.OffersConnector:
+    monkeypatch.setattr(offersConnector, 'BACKOFF_BASE', 0.)
+    offers = offersConnector.OffersConnector(lambda: 'token', lambda token: None, retries=2, rate_limit_dir=None)
+    calls = iter(responses)
+
+    def call(url, **kwargs):
+        r = next(calls)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    monkeypatch.setattr(offers.session, 'get', call)
+    monkeypatch.setattr(offers.session, 'post', call)
+    return offers
+
+
+def test_product_offers_retry(monkeypatch):
+    offers = make_connector(monkeypatch, [
+        requests.ConnectionError('reset'),
+        FakeResponse(503, {}),
+        FakeResponse(200, [{'id': 1, 'price': 1, 'items_in_stock': 1}])
+    ])
+    assert offers.product_offers(1) == [{'id': 1, 'price': 1, 'items_in_stock': 1}]
+
+
+def test_register_retried_when_not_connected(monkeypatch):
+    from urllib3.exceptions import MaxRetryError, NewConnectionError
+    refused = requests.ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'refused')))
+    offers = make_connector(monkeypatch, [refused, requests.ConnectTimeout('timeout'), FakeResponse(201, {})])
+    offers.product_register(1, 'test', 'test description')
+
+
+@pytest.mark.parametrize('error', [requests.ReadTimeout('timeout'), requests.ConnectionError('reset')])
+def test_register_not_retried_after_sent(monkeypatch, error):
+    offers = make_connector(monkeypatch, [error, FakeResponse(201, {})])
+    with pytest.raises(offersConnector.OffersConnector.ERequestException):
+        offers.product_register(1, 'test', 'test description')  # request could be processed by service
+
+
+def test_product_offers_retries_exhausted(monkeypatch):
+    offers = make_connector(monkeypatch, [requests.Timeout('timeout')] * 3)
+    with pytest.raises(offersConnector.OffersConnector.ERequestException):
+        offers.product_offers(1)
+
+
+def test_product_offers_too_many_requests(monkeypatch):
+    offers = make_connector(monkeypatch, [
+        FakeResponse(429, {}, {'Retry-After': '0.1'}),
+        FakeResponse(200, [{'id': 1, 'price': 1, 'items_in_stock': 1}])
+    ])
+    start = monotonic()
+    assert offers.product_offers(1) == [{'id': 1, 'price': 1, 'items_in_stock': 1}]
+    assert monotonic() - start >= 0.1  # waited for Retry-After
+    assert offers.limiters[offersConnector.PRODUCT_OFFERS_SUB_URL].rate() < 1000.
+
+
+def test_product_offers_too_many_requests_exhausted(monkeypatch):
+    offers = make_connector(monkeypatch, [FakeResponse(429, {}, {'Retry-After': '0'})] * 3)
+    with pytest.raises(offersConnector.OffersConnector.ETooManyRequests):
+        offers.product_offers(1)
+
+
+def test_register_retried_on_too_many_requests(offers_service):
+    offers = offersConnector.OffersConnector(lambda: None, lambda token: None, rate_limit_dir=None)
+    offers.auth()
+    offers_service.throttle(2, retry_after=0)
+    offers.product_register(1004, 'test', 'test description')
+    assert 1004 in offers_service.registered
+
+
+def test_circuit_breaker(monkeypatch):
+    offers = make_connector(monkeypatch, [requests.ConnectionError('refused')] * 6 + [
+        FakeResponse(200, [{'id': 1, 'price': 1, 'items_in_stock': 1}])
+    ])
+    offers.breaker = offersConnector.CircuitBreaker(threshold=2, cooldown=0.1)
+
+    for _ in range(2):  # each call fails after 2 retries
+        with pytest.raises(offersConnector.OffersConnector.ERequestException):
+            offers.product_offers(1)
+    assert offers.breaker.state == offersConnector.CircuitBreaker.OPEN
+    with pytest.raises(offersConnector.OffersConnector.ECircuitOpen):
+        offers.product_offers(1)  # fails fast without request
+
+    time.sleep(0.1)
+    assert offers.product_offers(1) == [{'id': 1, 'price': 1, 'items_in_stock': 1}]  # trial call
+    assert offers.breaker.state == offersConnector.CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_trial_failure():
+    breaker = offersConnector.CircuitBreaker(threshold=1, cooldown=0.)
+    breaker.failure()
+    assert breaker.allow()
+    assert not breaker.allow()  # only one trial call
+    breaker.failure()
+    assert breaker.state == offersConnector.CircuitBreaker.OPEN
+
+
+def test_token_is_obtained_lazily(offers_service):
+    saved = []
+    offers = offersConnector.OffersConnector(lambda: None, saved.append)
+    assert offers.access_token is None
+
+    offers.product_register(1001, 'test', 'test description')
+    assert saved == [offers.access_token]
+
+
+def test_startup_without_offers_service(app):
+    from ms.core import Core
+    assert Core.offersMS is not None
+    assert Core.offersMS.access_token is None
+    assert Core.offersMS._session is None
+
+
+def test_token_refresh_on_unauthorized(offers_service):
+    store = {'token': None}
+    offers = offersConnector.OffersConnector(lambda: store['token'], lambda token: store.update(token=token))
+    offers.product_register(1002, 'test', 'test description')
+    old_token = store['token']
+
+    offers_service.expire_tokens()
+    offers.product_offers(1002)  # 401 is answered by refresh and retry
+    assert store['token'] != old_token
+
+
+def test_token_refresh_is_coalesced(offers_service):
+    import threading
+
+    store = {'token': None}
+    offers = offersConnector.OffersConnector(lambda: store['token'], lambda token: store.update(token=token))
+    offers.product_register(1003, 'test', 'test description')
+    offers_service.expire_tokens()
+    auths = offers_service.auths
+
+    threads = [threading.Thread(target=offers.product_offers, args=(1003,)) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert offers_service.auths == auths + 1
+
+
+def test_token_shared_by_store():
+    calls = []
+    manager = offersConnector.TokenManager(lambda: 'shared', lambda token: None, lambda: calls.append(1) or 'own')
+    assert manager.get() == 'shared'
+    assert manager.refresh(stale='shared') == 'own'  # shared token was rejected too
+    assert len(calls) == 1
+
+
+def test_token_store_of_app(app):
+    from ms import token_store
+
+    load, save = token_store(app)
+    save('first')
+    save('second')  # replaces stored token
+    assert load() == 'second'
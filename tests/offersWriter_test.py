@@ -0,0 +1,74 @@
+# tests of offersWriter.py
+import pytest
+
+from ms import db
+from ms.dbModels import Offer, OfferChange, OfferSummary
+from ms.offersWriter import OffersWriter, UPSERT_INDEX
+from ms.reconciliation import Reconciliation
+
+
+@pytest.mark.parametrize('native_upsert', (True, False))
+def test_upsert(app, fixed_product_id, monkeypatch, native_upsert):
+    if not native_upsert:
+        monkeypatch.setattr(OffersWriter, '_upsert_statement', staticmethod(lambda *args: None))
+
+    rows = [{'prod_id': fixed_product_id, 'remote_id': i, 'price': i, 'items_in_stock': 1} for i in range(10)]
+    with app.app_context():
+        assert OffersWriter.upsert(db, rows, chunk_size=3) == 10
+
+        rows[0]['price'] = 100
+        OffersWriter.upsert(db, rows[:1])
+
+        assert Offer.query.count() == 10
+        assert Offer.query.filter_by(remote_id=0).one().price == 100
+
+
+def test_create_index(app, fixed_product_id):
+    with app.app_context():
+        db.session.execute(db.text('DROP INDEX {}'.format(UPSERT_INDEX)))
+        db.session.add_all([Offer(prod_id=fixed_product_id, remote_id=1, price=price, items_in_stock=1)
+                            for price in (1, 2)])
+        db.session.commit()
+
+        assert OffersWriter.create_index(db) == 1
+        assert OffersWriter.create_index(db) == 0
+        assert Offer.query.one().price == 2
+        OffersWriter.upsert(db, [{'prod_id': fixed_product_id, 'remote_id': 1, 'price': 3, 'items_in_stock': 1}])
+        assert Offer.query.one().price == 3
+
+
+def test_delete(app, fixed_product_id):
+    rows = [{'prod_id': fixed_product_id, 'remote_id': i, 'price': i, 'items_in_stock': 1} for i in range(5)]
+    with app.app_context():
+        OffersWriter.upsert(db, rows)
+        ids = [offer.id for offer in Offer.query.limit(3)]
+
+        assert OffersWriter.delete(db, ids, chunk_size=2) == 3
+        assert Offer.query.count() == 2
+
+
+@pytest.mark.parametrize('native_upsert', (True, False))
+def test_upsert_summaries(app, fixed_product_id, monkeypatch, native_upsert):
+    if not native_upsert:
+        monkeypatch.setattr(OffersWriter, '_upsert_statement', staticmethod(lambda *args: None))
+
+    summary = {'prod_id': fixed_product_id, 'best_price': 5, 'offer_count': 2, 'total_stock': 7, 'last_synced': 1.}
+    with app.app_context():
+        OffersWriter.upsert_summaries(db, [summary])
+        OffersWriter.upsert_summaries(db, [dict(summary, best_price=None, offer_count=0, last_synced=2.)])
+
+        s = OfferSummary.query.get(fixed_product_id)
+        assert (s.best_price, s.offer_count, s.total_stock, s.last_synced) == (None, 0, 7, 2.)
+
+
+def test_changes_are_logged(app, fixed_product_id):
+    rows = [{'prod_id': fixed_product_id, 'remote_id': i, 'price': i, 'items_in_stock': 1} for i in range(3)]
+    with app.app_context():
+        OffersWriter.upsert(db, rows, chunk_size=2)
+        offer = Offer.query.filter_by(remote_id=0).one()
+        OffersWriter.write(db, [Reconciliation(
+            inserts=[], deletes=[Offer.query.filter_by(remote_id=1).one().id],
+            updates=[{'id': offer.id, 'prod_id': fixed_product_id, 'remote_id': 0, 'price': 7, 'items_in_stock': 2}])])
+
+        changes = [(c.remote_id, c.change, c.price) for c in OfferChange.query.order_by(OfferChange.seq)]
+        assert changes == [(0, 'insert', 0), (1, 'insert', 1), (2, 'insert', 2), (1, 'delete', None), (0, 'update', 7)]
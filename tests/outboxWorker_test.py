@@ -0,0 +1,101 @@
+# tests of outboxWorker.py
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import pytest
+
+from ms import db
+from ms.consts import PRODUCT_NAME, PRODUCT_DESCRIPTION
+from ms.dbModels import RegistrationOutbox
+from ms.offersConnector import OffersConnector
+from ms.outboxWorker import OutboxWorker
+
+
+class FakeOffersConnector:
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.registered = []
+
+    def product_register(self, prod_id: int, name: str, desc: str):
+        if self.error is not None:
+            raise self.error
+        self.registered.append(prod_id)
+
+
+@pytest.fixture
+def outbox(app, client, monkeypatch):
+    client.post('/product', json={PRODUCT_NAME: 'outbox', PRODUCT_DESCRIPTION: 'description'})
+    client.post('/products', json=[{PRODUCT_NAME: 'outbox batch', PRODUCT_DESCRIPTION: 'description'}] * 2)
+    with app.app_context():
+        # duplicated registration of the same product
+        db.session.add(RegistrationOutbox(prod_id=RegistrationOutbox.query.first().prod_id))
+        db.session.commit()
+    monkeypatch.setattr(OutboxWorker, 'db', db)
+    monkeypatch.setattr(OutboxWorker, 'offersMS', OutboxWorker.offersMS)  # drain() replaces it, restored after test
+
+
+def drain(app, connector) -> int:
+    OutboxWorker.offersMS = connector
+    with app.app_context(), ThreadPoolExecutor(max_workers=2) as executor:
+        return OutboxWorker.drain(executor)
+
+
+def test_drain(app, outbox):
+    connector = FakeOffersConnector()
+
+    assert drain(app, connector) == 4
+    assert len(connector.registered) == 3
+    with app.app_context():
+        assert RegistrationOutbox.query.count() == 0
+
+
+def test_drain_retry(app, outbox):
+    connector = FakeOffersConnector(OffersConnector.ERequestException('/products/register', Exception('timeout')))
+
+    assert drain(app, connector) == 4
+    assert drain(app, connector) == 0  # not due yet
+    with app.app_context():
+        entries = RegistrationOutbox.query.all()
+        assert len(entries) == 4 and all(entry.attempts == 1 for entry in entries)
+
+
+def test_drain_refused(app, outbox):
+    connector = FakeOffersConnector(OffersConnector.EBadRequest('/products/register', 400, 'already registered'))
+
+    drain(app, connector)
+    with app.app_context():
+        assert RegistrationOutbox.query.count() == 0
+
+
+def test_drain_claimed(app, outbox):
+    connector = FakeOffersConnector()
+    with app.app_context():
+        claimed = OutboxWorker.claim(time())  # claimed by another worker
+        assert len(claimed) == 4
+
+    assert drain(app, connector) == 0
+    assert connector.registered == []
+
+
+def test_drain_claims_all_rows_of_product(app, outbox, monkeypatch):
+    monkeypatch.setattr(OutboxWorker, 'batch_size', 1)
+    with app.app_context():
+        claimed = OutboxWorker.claim(time())
+        assert len(claimed) == 2 and claimed[0].prod_id == claimed[1].prod_id  # duplicated registration
+        assert OutboxWorker.claim(time())[0].prod_id != claimed[0].prod_id
+
+
+def test_run_survives_failed_batch(app, outbox, monkeypatch):
+    calls = []
+
+    def drain_once(executor):
+        calls.append(executor)
+        if len(calls) == 1:
+            raise RuntimeError('database is locked')
+        raise KeyboardInterrupt  # stops the loop
+
+    monkeypatch.setattr(OutboxWorker, 'drain', staticmethod(drain_once))
+    monkeypatch.setattr('ms.outboxWorker.sleep', lambda seconds: None)
+    with app.app_context(), pytest.raises(KeyboardInterrupt):
+        OutboxWorker.run(FakeOffersConnector(), db)
+    assert len(calls) == 2
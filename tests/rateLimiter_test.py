@@ -0,0 +1,72 @@
+# tests of rateLimiter.py
+from email.utils import formatdate
+from time import monotonic, time
+
+from ms import rateLimiter
+from ms.rateLimiter import RateLimiter, parse_retry_after
+
+
+def test_token_bucket():
+    limiter = RateLimiter(rate=20., burst=2.)
+    start = monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert monotonic() - start >= 0.15  # burst of 2, then 4 tokens at 20/s
+
+
+def test_unlimited():
+    limiter = RateLimiter(rate=0.)
+    for _ in range(1000):
+        assert limiter.acquire() == 0.
+
+
+def test_shared_by_path(tmp_path):
+    path = RateLimiter.shared_path(str(tmp_path), 'offers')
+    first = RateLimiter(rate=10., burst=1., path=path)
+    second = RateLimiter(rate=10., burst=1., path=path)
+
+    first.acquire()
+    assert second.acquire() > 0.05  # token was taken by the other limiter
+    first.throttle()
+    assert second.rate() < 10.
+
+
+def test_unusable_path_keeps_state_in_process(tmp_path):
+    limiter = RateLimiter(rate=10., burst=1., path=str(tmp_path))  # directory can't be opened as state file
+    assert limiter.acquire() == 0.
+    assert 0.05 < limiter.reserve() <= 0.1
+
+
+def test_throttle_and_recovery(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(rateLimiter, 'time', lambda: now[0])
+    limiter = RateLimiter(rate=100.)
+
+    limiter.throttle()
+    assert limiter.rate() == 50.
+    limiter.throttle()  # refusals of concurrent requests decrease rate once
+    assert limiter.rate() == 50.
+
+    now[0] += 10.
+    assert limiter.rate() == 50. + 10. * 100. * rateLimiter.RATE_RECOVERY
+    now[0] += 100.
+    assert limiter.rate() == 100.
+
+
+def test_reserve_does_not_block():
+    limiter = RateLimiter(rate=10., burst=1.)
+    assert limiter.reserve() == 0.
+    assert 0.05 < limiter.reserve() <= 0.1  # caller waits for the next token itself
+
+
+def test_retry_after_blocks():
+    limiter = RateLimiter(rate=0.)
+    limiter.throttle(retry_after=0.1)
+    assert limiter.acquire() >= 0.09
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('2') == 2.
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    assert 55. < parse_retry_after(formatdate(time() + 60., usegmt=True)) <= 60.
@@ -0,0 +1,36 @@
+# tests of reconciliation.py
+from ms.reconciliation import reconcile, offer_validation
+
+
+def test_reconcile():
+    local = [(1, 10, 100, 1), (2, 20, 200, 2), (3, 30, 300, 3), (4, 30, 300, 3)]
+    remote = [
+        {'id': 10, 'price': 100, 'items_in_stock': 1},  # unchanged
+        {'id': 20, 'price': 150, 'items_in_stock': 2},  # changed price
+        {'id': 40, 'price': 400, 'items_in_stock': 4},  # new
+        {'id': 40, 'price': 400, 'items_in_stock': 4},  # duplicate
+        {'id': 50, 'price': 500}  # invalid
+    ]
+
+    changes = reconcile(7, local, remote)
+
+    assert changes.inserts == [{'prod_id': 7, 'remote_id': 40, 'price': 400, 'items_in_stock': 4}]
+    assert changes.updates == [{'id': 2, 'prod_id': 7, 'remote_id': 20, 'price': 150, 'items_in_stock': 2}]
+    assert sorted(changes.deletes) == [3, 4]
+    assert changes.summary == {'prod_id': 7, 'best_price': 100, 'offer_count': 3, 'total_stock': 7}
+
+
+def test_offer_validation():
+    assert offer_validation({'id': 1, 'price': 0, 'items_in_stock': 2 ** 31 - 1})
+    for invalid in ({'id': 1, 'price': None, 'items_in_stock': 1}, {'id': 1, 'price': '10', 'items_in_stock': 1},
+                    {'id': 1, 'price': 2 ** 31, 'items_in_stock': 1}, {'id': 1, 'price': -1, 'items_in_stock': 1},
+                    {'id': 1, 'price': 1.5, 'items_in_stock': 1}, {'id': True, 'price': 1, 'items_in_stock': 1},
+                    [1, 2, 3]):
+        assert not offer_validation(invalid)
+
+
+def test_reconcile_no_changes():
+    local = [(1, 10, 100, 1)]
+    remote = [{'id': 10, 'price': 100, 'items_in_stock': 1}]
+
+    assert not reconcile(7, local, remote)
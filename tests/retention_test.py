@@ -0,0 +1,81 @@
+# tests of retention.py
+from time import time
+
+from ms import db
+from ms.consts import CHANGES_PRUNED
+from ms.dbModels import Product, Offer, OfferChange, OfferSummary, PriceHistoryChunk, Settings
+from ms.history import HistoryStore
+from ms.offersWriter import OffersWriter
+from ms.retention import Retention, DAY
+
+
+def add_offers(prod_id: int, count: int = 5) -> None:
+    OffersWriter.upsert(db, [{'prod_id': prod_id, 'remote_id': i, 'price': i, 'items_in_stock': 1}
+                             for i in range(count)])
+    OffersWriter.upsert_summaries(db, [{'prod_id': prod_id, 'best_price': 0, 'offer_count': count,
+                                        'total_stock': count, 'last_synced': 1.}])
+
+
+def test_compact_removes_rows_of_deleted_products(app, fixed_product_id, to_delete_product_id):
+    with app.app_context():
+        add_offers(fixed_product_id)
+        add_offers(to_delete_product_id)
+        HistoryStore.append(db, {to_delete_product_id: [(1., 0, 1, 1)]})
+        db.session.commit()
+        # deleted without cascade, e.g. sync wrote offers after product was deleted
+        Product.query.filter_by(id=to_delete_product_id).delete()
+        db.session.commit()
+
+        report = Retention.compact(db, changes_days=0, batch_size=2, pause=0.)
+
+        assert report['offers'] == 5
+        assert report['offer_summaries'] == 1
+        assert report['price_history'] == 1
+        assert report['offer_changes'] == 0
+        assert report['rows'] == 7
+        assert report['reclaimed_bytes'] is not None
+        assert Offer.query.filter_by(prod_id=to_delete_product_id).count() == 0
+        assert Offer.query.filter_by(prod_id=fixed_product_id).count() == 5
+        assert OfferSummary.query.count() == 1
+        assert OfferChange.query.filter_by(change='delete').count() == 5  # feed readers drop the offers
+
+
+def test_compact_prunes_old_changes_and_history(app, fixed_product_id):
+    with app.app_context():
+        add_offers(fixed_product_id, count=3)
+        HistoryStore.append(db, {fixed_product_id: [(1., 0, 1, 1)]})
+        db.session.commit()
+        OfferChange.query.filter(OfferChange.remote_id < 2).update({'changed_at': 1.})
+        db.session.commit()
+
+        report = Retention.compact(db, changes_days=1, history_days=1, batch_size=1, pause=0.)
+
+        assert report['offer_changes'] == 2
+        assert report['price_history'] == 1
+        assert [c.remote_id for c in OfferChange.query] == [2]
+        assert int(db.session.get(Settings, CHANGES_PRUNED).value) == OfferChange.query.one().seq - 1
+        assert PriceHistoryChunk.query.count() == 0
+        assert Retention.compact(db, changes_days=1, history_days=1, now=1. + DAY / 2)['rows'] == 0
+
+
+def test_prune_changes_keeps_changes_above_watermark(app, fixed_product_id, monkeypatch):
+    sweep = Retention._sweep
+
+    def sweep_after_write(*args, **kwargs):
+        add_offers(fixed_product_id, count=4)  # written after watermark was stored
+        return sweep(*args, **kwargs)
+
+    with app.app_context():
+        add_offers(fixed_product_id, count=3)
+        pruned = db.session.query(db.func.max(OfferChange.seq)).scalar()
+        monkeypatch.setattr(Retention, '_sweep', staticmethod(sweep_after_write))
+
+        assert Retention.prune_changes(db, before=time() + DAY, pause=0.) == 3
+        assert int(db.session.get(Settings, CHANGES_PRUNED).value) == pruned
+        assert [c.seq for c in OfferChange.query] == [pruned + i for i in range(1, 5)]  # visible to cursor at watermark
+
+
+def test_compact_command(runner):
+    result = runner.invoke(args=['compact', '--vacuum'])
+    assert result.exit_code == 0, result.output
+    assert 'rows: 0' in result.output
@@ -0,0 +1,30 @@
+# tests of storage.py
+import os
+
+from sqlalchemy import text
+
+from ms import create_app, db
+from ms import storage
+
+
+def test_engine_options():
+    assert storage.engine_options('sqlite:///:memory:') == {'connect_args': {'timeout': storage.SQLITE_BUSY_TIMEOUT}}
+    options = storage.engine_options('postgresql://localhost/ms')
+    assert options['pool_pre_ping'] is True
+    assert options['pool_size'] == storage.DB_POOL_SIZE
+
+
+def test_sqlite_pragmas(tmp_path):
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp_path, 'ms.db')})
+    with app.app_context():
+        assert db.session.execute(text('PRAGMA journal_mode')).scalar() == storage.SQLITE_JOURNAL_MODE.lower()
+        assert db.session.execute(text('PRAGMA busy_timeout')).scalar() == int(storage.SQLITE_BUSY_TIMEOUT * 1000)
+        assert db.session.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+        db.session.remove()
+        db.engine.dispose()
+
+
+def test_engine_options_can_be_overridden():
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+                      'SQLALCHEMY_ENGINE_OPTIONS': {}})
+    assert app.config['SQLALCHEMY_ENGINE_OPTIONS'] == {}
@@ -0,0 +1,58 @@
+# tests of syncLeases.py
+from ms import db
+from ms.dbModels import Product
+from ms.OffersSyncJob import OffersSyncJob
+from ms.syncLeases import SyncLeases
+
+
+def test_single_worker_owns_all(app):
+    with app.app_context():
+        worker = SyncLeases(db, buckets=8, ttl=30., owner='a')
+        assert worker.rebalance(now=0.) == set(range(8))
+
+
+def test_workers_split_buckets(app):
+    with app.app_context():
+        a = SyncLeases(db, buckets=8, ttl=30., owner='a')
+        b = SyncLeases(db, buckets=8, ttl=30., owner='b')
+        a.rebalance(now=0.)
+        assert b.rebalance(now=1.) == set()  # all buckets are leased by a
+
+        assert len(a.rebalance(now=2.)) == 4  # a releases buckets over its fair share
+        assert len(b.rebalance(now=3.)) == 4
+        assert a.owned.isdisjoint(b.owned)
+
+
+def test_takeover_of_dead_worker(app):
+    with app.app_context():
+        a = SyncLeases(db, buckets=8, ttl=30., owner='a')
+        b = SyncLeases(db, buckets=8, ttl=30., owner='b')
+        a.rebalance(now=0.)
+        b.rebalance(now=0.)
+        a.rebalance(now=1.)
+        b.rebalance(now=2.)
+
+        # a stopped heartbeating, its leases expire
+        assert b.rebalance(now=40.) == set(range(8))
+        assert a.renew(now=41.) == set()
+
+
+def test_release(app):
+    with app.app_context():
+        a = SyncLeases(db, buckets=8, ttl=30., owner='a')
+        b = SyncLeases(db, buckets=8, ttl=30., owner='b')
+        a.rebalance(now=0.)
+        a.release()
+        assert b.rebalance(now=1.) == set(range(8))
+
+
+def test_owned_products(app, monkeypatch):
+    with app.app_context():
+        db.session.add_all([Product(name='p', description='d') for _ in range(10)])
+        db.session.commit()
+        monkeypatch.setattr(OffersSyncJob, 'db', db)
+        monkeypatch.setattr(OffersSyncJob, 'leases', SyncLeases(db, buckets=2, ttl=30., owner='a'))
+        OffersSyncJob.leases.owned = {1}
+        products = OffersSyncJob.owned_products()
+        assert products and all(prod_id % 2 == 1 for prod_id in products)
+        assert OffersSyncJob.owns(3) and not OffersSyncJob.owns(4)
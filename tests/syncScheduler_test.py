@@ -0,0 +1,63 @@
+# tests of syncScheduler.py
+import pytest
+
+from ms.syncScheduler import SyncScheduler
+
+
+def test_new_products_are_due():
+    scheduler = SyncScheduler(min_interval=10., max_interval=100.)
+    scheduler.set_products([3, 1, 2], now=0.)
+
+    assert sorted(scheduler.pop_due(now=0.)) == [1, 2, 3]
+    assert scheduler.pop_due(now=1000.) == []  # products in progress aren't due
+
+
+def test_interval_adapts():
+    scheduler = SyncScheduler(min_interval=10., max_interval=100., backoff=2.)
+    scheduler.add(1, now=0.)
+    scheduler.pop_due(now=0.)
+
+    scheduler.reschedule(1, changed=False, now=0.)
+    assert scheduler.intervals[1] == 20.
+    assert scheduler.pop_due(now=15.) == []
+    assert scheduler.pop_due(now=25.) == [1]
+
+    scheduler.reschedule(1, changed=True, now=25.)
+    assert scheduler.intervals[1] == 10.
+
+
+def test_failed_product_is_retried():
+    scheduler = SyncScheduler(min_interval=10., max_interval=100., retry_interval=5.)
+    scheduler.add(1, now=0.)
+    scheduler.pop_due(now=0.)
+
+    scheduler.fail(1, now=0.)
+    assert scheduler.pop_due(now=6.) == [1]
+    scheduler.fail(1, now=6.)
+    assert scheduler.pop_due(now=12.) == []  # the second retry waits twice longer
+    assert scheduler.pop_due(now=18.) == [1]
+    assert scheduler.intervals[1] == 10.
+    assert scheduler.stats(now=18.)['failing'] == 1
+
+    scheduler.reschedule(1, changed=True, now=18.)
+    assert scheduler.stats(now=18.)['failing'] == 0
+
+
+def test_remove_product():
+    scheduler = SyncScheduler(min_interval=10.)
+    scheduler.set_products([1, 2], now=0.)
+    scheduler.set_products([2], now=0.)
+
+    assert scheduler.pop_due(now=0.) == [2]
+    assert scheduler.stats(now=0.)['products'] == 1
+
+
+@pytest.mark.parametrize('changed', (True, False))
+def test_interval_bounds(changed):
+    scheduler = SyncScheduler(min_interval=10., max_interval=40., backoff=2.)
+    scheduler.add(1, now=0.)
+    for _ in range(10):
+        scheduler.pop_due(now=1e9)
+        scheduler.reschedule(1, changed=changed, now=0.)
+
+    assert scheduler.intervals[1] == (10. if changed else 40.)